@@ -0,0 +1,159 @@
+"""Peak memory and step time of the shipped models for each net.checkpoint setting.
+
+python benchmarks/bench_checkpoint.py --device cuda
+
+The model is built from the config with ImageNet weights off and plain BN
+(single process), and trained on random inputs at the config batch and crop size.
+"""
+
+import copy
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+import torch
+import yaml
+from torch.nn import functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from u2pl.models.model_helper import ModelBuilder  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ALL = [
+    "layer1",
+    "layer2",
+    "layer3",
+    "layer4",
+    "aspp",
+    "head",
+    "classifier",
+    "representation",
+]
+
+
+def get_parser():
+    parser = ArgumentParser(description="net.checkpoint memory / step time")
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument(
+        "--configs",
+        type=str,
+        nargs="+",
+        default=[
+            os.path.join(ROOT, "experiments/pascal/732/ours/config.yaml"),
+            os.path.join(ROOT, "experiments/cityscapes/744/ours/config.yaml"),
+        ],
+    )
+    # comma separated net.checkpoint lists, "none" and "all" included
+    parser.add_argument(
+        "--settings",
+        type=str,
+        nargs="+",
+        default=[
+            "none",
+            "layer1",
+            "layer2",
+            "layer3",
+            "layer4",
+            "aspp",
+            "head",
+            "classifier",
+            "representation",
+            "layer1,layer2,layer3,layer4",
+            "all",
+        ],
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    return parser
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def build_model(net_cfg, setting, device):
+    net_cfg = copy.deepcopy(net_cfg)
+    net_cfg["sync_bn"] = False
+    net_cfg["encoder"]["kwargs"]["pretrained"] = False
+    if setting == "none":
+        net_cfg["checkpoint"] = []
+    elif setting == "all":
+        net_cfg["checkpoint"] = ALL
+    else:
+        net_cfg["checkpoint"] = setting.split(",")
+    return ModelBuilder(net_cfg).to(device).train()
+
+
+def train_step(model, image, target):
+    outs = model(image)
+    pred = F.interpolate(
+        outs["pred"], target.shape[1:], mode="bilinear", align_corners=True
+    )
+    loss = F.cross_entropy(pred, target, ignore_index=255)
+    if "rep" in outs:
+        loss = loss + 0 * outs["rep"].sum()
+    if "aux" in outs:
+        aux = F.interpolate(
+            outs["aux"], target.shape[1:], mode="bilinear", align_corners=True
+        )
+        loss = loss + model.loss_weight * F.cross_entropy(aux, target)
+    model.zero_grad(set_to_none=True)
+    loss.backward()
+
+
+def main():
+    args = get_parser().parse_args()
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+
+    print(
+        "{:<22} {:>5} {:>9} {:<32} {:>10} {:>10}".format(
+            "config", "batch", "crop", "net.checkpoint", "peak MB", "ms/step"
+        )
+    )
+    for path in args.configs:
+        cfg = yaml.load(open(path, "r"), Loader=yaml.Loader)
+        batch_size = cfg["dataset"]["batch_size"]
+        crop_h, crop_w = cfg["dataset"]["train"]["crop"]["size"]
+        num_classes = cfg["net"]["num_classes"]
+        name = os.path.relpath(os.path.dirname(path), os.path.join(ROOT, "experiments"))
+
+        image = torch.randn((batch_size, 3, crop_h, crop_w), device=device)
+        target = torch.randint(0, num_classes, (batch_size, crop_h, crop_w))
+        target = target.to(device)
+
+        for setting in args.settings:
+            model = build_model(cfg["net"], setting, device)
+            train_step(model, image, target)
+            sync(device)
+            if device.type == "cuda":
+                torch.cuda.reset_peak_memory_stats(device)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                train_step(model, image, target)
+            sync(device)
+            seconds = (time.perf_counter() - start) / args.repeat
+            peak = (
+                "{:.0f}".format(torch.cuda.max_memory_allocated(device) / 2**20)
+                if device.type == "cuda"
+                else "-"
+            )
+            print(
+                "{:<22} {:>5} {:>9} {:<32} {:>10} {:>10.1f}".format(
+                    name,
+                    batch_size,
+                    "{}x{}".format(crop_h, crop_w),
+                    setting,
+                    peak,
+                    seconds * 1000,
+                )
+            )
+            del model
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+
+
+if __name__ == "__main__":
+    main()
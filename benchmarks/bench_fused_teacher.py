@@ -0,0 +1,195 @@
+"""Time the fused (one-pass) and two-pass teacher steps and compare their outputs.
+
+python benchmarks/bench_fused_teacher.py --device cpu
+
+Both paths follow train_semi.py, in fp32 and without autocast. The two-pass path
+pseudo-labels the unlabeled images in eval mode, then reruns the teacher in train
+mode on the labeled plus mixed images. The fused path runs once on the labeled
+plus un-mixed images (fused_teacher_bn train or eval) and remaps its outputs
+through the mix mask. The teacher is a randomly initialized ResNet-50 DeepLabv3+,
+so the differences show the effect of the BN mode and of the remap, not accuracy.
+"""
+
+import copy
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from u2pl.dataset.augmentation import generate_unsup_data, mix_by_mask  # noqa: E402
+from u2pl.models.model_helper import ModelBuilder  # noqa: E402
+
+
+def get_parser():
+    parser = ArgumentParser(description="fused teacher pass timing")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--size", type=int, default=257)
+    parser.add_argument("--num_classes", type=int, default=21)
+    parser.add_argument(
+        "--apply_aug", type=str, default="cutmix", choices=["cutmix", "classmix"]
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    return parser
+
+
+def build_teacher(num_classes, device):
+    net_cfg = {
+        "num_classes": num_classes,
+        "sync_bn": False,
+        "encoder": {
+            "type": "u2pl.models.resnet.resnet50",
+            "kwargs": {
+                "pretrained": False,
+                "multi_grid": True,
+                "fpn": True,
+                "replace_stride_with_dilation": [False, True, True],
+            },
+        },
+        "decoder": {
+            "type": "u2pl.models.decoder.dec_deeplabv3_plus",
+            "kwargs": {"inner_planes": 256, "dilations": [12, 24, 36]},
+        },
+    }
+    teacher = ModelBuilder(net_cfg).to(device)
+    for p in teacher.parameters():
+        p.requires_grad = False
+    return teacher
+
+
+def pseudo_label(pred_u, size):
+    pred_u = F.interpolate(pred_u, size, mode="bilinear", align_corners=True)
+    logits_u, label_u = torch.max(F.softmax(pred_u, dim=1), dim=1)
+    return logits_u, label_u
+
+
+def set_mix_seed(seed):
+    # the same cutmix boxes / classmix draws in both paths
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def two_pass(teacher, image_l, image_u, mode, seed):
+    teacher.eval()
+    pred_u = teacher(image_u)["pred"].float()
+    logits_u, label_u = pseudo_label(pred_u, image_u.shape[2:])
+
+    set_mix_seed(seed)
+    image_u_aug, label_u, _, _ = generate_unsup_data(
+        image_u, label_u, logits_u, mode=mode, return_mask=True
+    )
+
+    teacher.train()
+    out_t = teacher(torch.cat((image_l, image_u_aug)))
+    return label_u, {key: out_t[key].float() for key in ("pred", "rep")}
+
+
+def fused(teacher, image_l, image_u, mode, seed, bn_mode):
+    num_labeled = len(image_l)
+    teacher.train(bn_mode == "train")
+    out_t = teacher(torch.cat((image_l, image_u)))
+    out_t = {key: out_t[key].float() for key in ("pred", "rep")}
+    logits_u, label_u = pseudo_label(out_t["pred"][num_labeled:], image_u.shape[2:])
+
+    set_mix_seed(seed)
+    _, label_u, _, mix_mask = generate_unsup_data(
+        image_u, label_u, logits_u, mode=mode, return_mask=True
+    )
+    out_t = {
+        key: torch.cat(
+            (out_t[key][:num_labeled], mix_by_mask(out_t[key][num_labeled:], mix_mask))
+        )
+        for key in out_t
+    }
+    return label_u, out_t
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_step(step, device, repeat):
+    """Mean seconds of a teacher step, after one warm-up call."""
+    step()
+    sync(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        step()
+    sync(device)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    args = get_parser().parse_args()
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+
+    teacher = build_teacher(args.num_classes, device)
+    shape = (args.batch_size, 3, args.size, args.size)
+    image_l = torch.randn(shape, device=device)
+    image_u = torch.randn(shape, device=device)
+    num_labeled = args.batch_size
+
+    with torch.no_grad():
+        # every path starts from the same teacher, BN train mode updates it
+        torch.manual_seed(1)
+        ref_label, ref_out = two_pass(
+            copy.deepcopy(teacher), image_l, image_u, args.apply_aug, seed=2
+        )
+        seconds = time_step(
+            lambda: two_pass(teacher, image_l, image_u, args.apply_aug, seed=2),
+            device,
+            args.repeat,
+        )
+        print(
+            "{:<20} {:>10} {:>12} {:>14} {:>14}".format(
+                "teacher step",
+                "ms/step",
+                "label agree",
+                "pred max diff",
+                "rep max diff",
+            )
+        )
+        print("{:<20} {:>10.1f}".format("two-pass", seconds * 1000))
+
+        for bn_mode in ("train", "eval"):
+            torch.manual_seed(1)
+            label, out = fused(
+                copy.deepcopy(teacher),
+                image_l,
+                image_u,
+                args.apply_aug,
+                seed=2,
+                bn_mode=bn_mode,
+            )
+            seconds = time_step(
+                lambda: fused(
+                    teacher, image_l, image_u, args.apply_aug, seed=2, bn_mode=bn_mode
+                ),
+                device,
+                args.repeat,
+            )
+            # mixed pseudo-labels and remapped teacher outputs of the unlabeled rows
+            agree = (label == ref_label).float().mean().item()
+            pred_diff = (out["pred"] - ref_out["pred"])[num_labeled:].abs().max()
+            rep_diff = (out["rep"] - ref_out["rep"])[num_labeled:].abs().max()
+            print(
+                "{:<20} {:>10.1f} {:>12.4f} {:>14.4f} {:>14.4f}".format(
+                    "fused bn={}".format(bn_mode),
+                    seconds * 1000,
+                    agree,
+                    pred_diff.item(),
+                    rep_diff.item(),
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Time the batched cutout / classmix masks against the former per-sample loop.
+
+python benchmarks/bench_mix_masks.py --device cpu
+"""
+
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.mix_masks_reference import (  # noqa: E402
+    old_generate_class_mask,
+    old_generate_cutout_mask,
+)
+from u2pl.dataset.augmentation import (  # noqa: E402
+    generate_class_mask,
+    generate_cutout_mask,
+)
+
+
+def get_parser():
+    parser = ArgumentParser(description="mix mask timing")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--size", type=int, default=513)
+    parser.add_argument("--num_classes", type=int, default=21)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[4, 8, 16, 32])
+    parser.add_argument("--repeat", type=int, default=10)
+    return parser
+
+
+def timeit(fn, device, repeat):
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    args = get_parser().parse_args()
+    device = torch.device(args.device)
+    img_size = [args.size, args.size]
+
+    print("{:<10} {:>5} {:>12} {:>12}".format("mask", "batch", "old ms", "new ms"))
+    for batch_size in args.batch_sizes:
+        labels = torch.randint(
+            0, args.num_classes, (batch_size, args.size, args.size), device=device
+        )
+        cases = {
+            "cutout": (
+                lambda: [
+                    old_generate_cutout_mask(img_size).to(device)
+                    for _ in range(batch_size)
+                ],
+                lambda: generate_cutout_mask(
+                    img_size, batch_size=batch_size, device=device
+                ),
+            ),
+            "classmix": (
+                lambda: [old_generate_class_mask(label) for label in labels],
+                lambda: generate_class_mask(labels),
+            ),
+        }
+        for name, (old, new) in cases.items():
+            print(
+                "{:<10} {:>5} {:>12.2f} {:>12.2f}".format(
+                    name,
+                    batch_size,
+                    timeit(old, device, args.repeat) * 1000,
+                    timeit(new, device, args.repeat) * 1000,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
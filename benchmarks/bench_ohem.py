@@ -0,0 +1,87 @@
+"""Time the OHEM criteria on random logits and targets.
+
+python benchmarks/bench_ohem.py --device cpu
+"""
+
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from u2pl.utils.loss_helper import (  # noqa: E402
+    OhemCrossEntropy2d,
+    OhemCrossEntropy2dKth,
+    OhemCrossEntropy2dTensor,
+)
+
+
+def get_parser():
+    parser = ArgumentParser(description="OHEM criterion timing")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--num_classes", type=int, default=19)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[513, 769])
+    parser.add_argument("--strides", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--min_kept", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    return parser
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_criterion(criterion, pred, target, repeat):
+    """Mean seconds of a forward + backward, after one warm-up call."""
+    for i in range(repeat + 1):
+        if i == 1:
+            sync(pred.device)
+            start = time.perf_counter()
+        pred.grad = None
+        criterion(pred, target).backward()
+    sync(pred.device)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    args = get_parser().parse_args()
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+
+    print("{:>5} {:<28} {:>10}".format("crop", "criterion", "ms/iter"))
+    for size in args.sizes:
+        shape = (args.batch_size, args.num_classes, size, size)
+        pred = torch.randn(shape, device=device).requires_grad_()
+        target = torch.randint(
+            0, args.num_classes, (args.batch_size, size, size), device=device
+        )
+        target[torch.rand(target.shape, device=device) < 0.1] = 255
+
+        criteria = [
+            ("OhemCrossEntropy2d", OhemCrossEntropy2d(255, 0.7, args.min_kept)),
+            (
+                "OhemCrossEntropy2dTensor",
+                OhemCrossEntropy2dTensor(255, 0.7, args.min_kept),
+            ),
+        ]
+        for stride in args.strides:
+            criteria.append(
+                (
+                    "OhemCrossEntropy2dKth s={}".format(stride),
+                    OhemCrossEntropy2dKth(255, 0.7, args.min_kept, stride=stride),
+                )
+            )
+
+        for name, criterion in criteria:
+            criterion = criterion.to(device)
+            seconds = time_criterion(criterion, pred, target, args.repeat)
+            print("{:>5} {:<28} {:>10.1f}".format(size, name, seconds * 1000))
+
+
+if __name__ == "__main__":
+    main()
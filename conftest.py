@@ -0,0 +1 @@
+# keeps the repository root importable (u2pl, tests.*) when running pytest
@@ -10,18 +10,20 @@ import torch.nn.parallel
 import torch.optim
 import torch.utils.data
 import yaml
-from PIL import Image
 
+from u2pl.dataset.evaluation import build_evalloader, eval_dset
+from u2pl.dataset.sampler import DistributedShardSampler
 from u2pl.models.model_helper import ModelBuilder
+from u2pl.utils.dist_helper import setup_distributed
 from u2pl.utils.utils import (
     AverageMeter,
+    SegMetric,
     check_makedirs,
-    colorize,
     convert_state_dict,
     create_cityscapes_label_colormap,
     create_pascal_label_colormap,
-    intersectionAndUnion,
 )
+from u2pl.utils.writer_helper import AsyncWriter, save_prediction
 
 
 # Setup Parser
@@ -55,6 +57,44 @@ def get_parser():
     parser.add_argument(
         "--crop", action="store_true", default=False, help="whether use crop evaluation"
     )
+    parser.add_argument(
+        "--crop_batch",
+        type=int,
+        default=8,
+        help="crops per forward in crop evaluation, bounds peak memory",
+    )
+    parser.add_argument(
+        "--image_batch",
+        type=int,
+        default=1,
+        help="images per loader batch, their crops are batched together",
+    )
+    parser.add_argument("--workers", type=int, default=4, help="loader workers")
+    parser.add_argument(
+        "--flip",
+        action="store_true",
+        default=False,
+        help="add horizontally flipped views to test-time augmentation",
+    )
+    parser.add_argument(
+        "--write_workers",
+        type=int,
+        default=4,
+        help="threads colorizing and saving predictions in the background",
+    )
+    parser.add_argument(
+        "--distributed",
+        action="store_true",
+        default=False,
+        help="shard the list over the ranks of a torchrun / slurm launch",
+    )
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument(
+        "--tta_report",
+        action="store_true",
+        default=False,
+        help="log latency and mIoU of every TTA level instead of saving results",
+    )
     return parser
 
 
@@ -74,6 +114,10 @@ def main():
     args = get_parser().parse_args()
     cfg = yaml.load(open(args.config, "r"), Loader=yaml.Loader)
     logger = get_logger()
+    if args.distributed:
+        rank, _ = setup_distributed(port=args.port)
+        if rank != 0:
+            logger.setLevel(logging.WARNING)
     logger.info(args)
 
     cfg_dset = cfg["dataset"]
@@ -91,27 +135,14 @@ def main():
 
     cfg_dset = cfg["dataset"]
     data_root, f_data_list = cfg_dset["val"]["data_root"], cfg_dset["val"]["data_list"]
-    data_list = []
-
     if "cityscapes" in data_root:
         colormap = create_cityscapes_label_colormap()
-        for line in open(f_data_list, "r"):
-            arr = [
-                line.strip(),
-                "gtFine/" + line.strip()[12:-15] + "gtFine_labelTrainIds.png",
-            ]
-            arr = [os.path.join(data_root, item) for item in arr]
-            data_list.append(arr)
-
     else:
         colormap = create_pascal_label_colormap()
-        for line in open(f_data_list, "r"):
-            arr = [
-                "JPEGImages/{}.jpg".format(line.strip()),
-                "SegmentationClassAug/{}.png".format(line.strip()),
-            ]
-            arr = [os.path.join(data_root, item) for item in arr]
-            data_list.append(arr)
+    dset = eval_dset(data_root, f_data_list, mean, std)
+    # every rank evaluates and writes its own disjoint shard of the list
+    sampler = DistributedShardSampler(dset) if args.distributed else None
+    loader = build_evalloader(dset, args.image_batch, args.workers, sampler=sampler)
 
     # Create network.
     args.use_auxloss = True if cfg["net"].get("aux_loss", False) else False
@@ -119,7 +150,7 @@ def main():
 
     cfg["net"]["sync_bn"] = False
     model = ModelBuilder(cfg["net"])
-    checkpoint = torch.load(args.model_path)
+    checkpoint = torch.load(args.model_path, map_location="cpu")
     key = "teacher_state" if "teacher_state" in checkpoint.keys() else "model_state"
     logger.info(f"=> load checkpoint[{key}]")
 
@@ -128,104 +159,206 @@ def main():
     model.cuda()
     logger.info("Load Model Done!")
     if "cityscapes" in cfg["dataset"]["type"]:
-        validate_city(
-            model,
-            num_classes,
-            data_list,
-            mean,
-            std,
-            args.base_size,
-            crop_h,
-            crop_w,
-            args.scales,
-            gray_folder,
-            color_folder,
-        )
+
+        def evaluate(scales, flip, writer=None):
+            return validate_city(
+                model,
+                num_classes,
+                loader,
+                args.base_size,
+                crop_h,
+                crop_w,
+                scales,
+                gray_folder,
+                color_folder,
+                crop_batch=args.crop_batch,
+                flip=flip,
+                writer=writer,
+            )
+
     else:
-        valiadte_whole(
-            model,
-            num_classes,
-            data_list,
-            mean,
-            std,
-            args.scales,
-            gray_folder,
-            color_folder,
-        )
+
+        def evaluate(scales, flip, writer=None):
+            return valiadte_whole(
+                model,
+                num_classes,
+                loader,
+                scales,
+                gray_folder,
+                color_folder,
+                flip=flip,
+                writer=writer,
+            )
+
+    if args.tta_report:
+        tta_report(lambda scales, flip: evaluate(scales, flip), args.scales, args.flip)
+    else:
+        with AsyncWriter(args.write_workers) as writer:
+            evaluate(args.scales, args.flip, writer)
     # cal_acc(data_list, gray_folder, num_classes)
 
 
 @torch.no_grad()
-def net_process(model, image):
+def net_process(model, image, flip=False):
+    """Logits at the input size; with ``flip`` the mirrored view rides in the
+    same batch and its logits are flipped back and added."""
     b, c, h, w = image.shape
-    # num_classes = cfg['net']['num_classes']
-    # output_all = torch.zeros((6, b, num_classes, h, w)).cuda()
-    input = image.cuda()
+    input = image
+    if flip:
+        input = torch.cat([input, torch.flip(input, [3])])
     output = model(input)["pred"]
     output = F.interpolate(output, (h, w), mode="bilinear", align_corners=True)
-    # output_all[0] = F.softmax(output, dim=1)
-    #
-    # output = model(torch.flip(input, [3]))["pred"]
-    # output = F.interpolate(output, (h, w), mode="bilinear", align_corners=True)
-    # output = F.softmax(output, dim=1)
-    # output_all[1] = torch.flip(output, [3])
-    #
-    # scales = [(961, 961), (841, 841), (721, 721), (641, 641)]
-    # for k, scale in enumerate(scales):
-    #     input_scale = F.interpolate(input, scale, mode="bilinear", align_corners=True)
-    #     output = model(input_scale)["pred"]
-    #     output = F.interpolate(output, (h, w), mode="bilinear", align_corners=True)
-    #     output_all[k + 2] = F.softmax(output, dim=1)
-    #
-    # output = torch.mean(output_all, dim=0)
+    if flip:
+        output = output[:b].add_(torch.flip(output[b:], [3]))
     return output
 
 
-def scale_crop_process(model, image, classes, crop_h, crop_w, h, w, stride_rate=2 / 3):
-    ori_h, ori_w = image.size()[-2:]
-    pad_h = max(crop_h - ori_h, 0)
-    pad_w = max(crop_w - ori_w, 0)
-    pad_h_half = int(pad_h / 2)
-    pad_w_half = int(pad_w / 2)
-    if pad_h > 0 or pad_w > 0:
-        border = (pad_w_half, pad_w - pad_w_half, pad_h_half, pad_h - pad_h_half)
-        image = F.pad(image, border, mode="constant", value=0.0)
-    new_h, new_w = image.size()[-2:]
-    stride_h = int(np.ceil(crop_h * stride_rate))
-    stride_w = int(np.ceil(crop_w * stride_rate))
-    grid_h = int(np.ceil(float(new_h - crop_h) / stride_h) + 1)
-    grid_w = int(np.ceil(float(new_w - crop_w) / stride_w) + 1)
-    prediction_crop = torch.zeros((1, classes, new_h, new_w), dtype=torch.float).cuda()
-    count_crop = torch.zeros((new_h, new_w), dtype=torch.float).cuda()
-    for index_h in range(0, grid_h):
-        for index_w in range(0, grid_w):
-            s_h = index_h * stride_h
-            e_h = min(s_h + crop_h, new_h)
-            s_h = e_h - crop_h
-            s_w = index_w * stride_w
-            e_w = min(s_w + crop_w, new_w)
-            s_w = e_w - crop_w
-            image_crop = image[:, :, s_h:e_h, s_w:e_w].contiguous()
-            count_crop[s_h:e_h, s_w:e_w] += 1
-
-            with torch.no_grad():
-                prediction_crop[:, :, s_h:e_h, s_w:e_w] += net_process(
-                    model, image_crop
+def tta_levels(scales, flip):
+    """Increasing TTA settings: the first n scales, then the same with flips."""
+    levels = []
+    for n in range(1, len(scales) + 1):
+        levels.append((scales[:n], False))
+        if flip:
+            levels.append((scales[:n], True))
+    return levels
+
+
+class SlidingWindowEngine(object):
+    """Multi-scale sliding-window inference in crop mini-batches.
+
+    The crops of every (image, scale) job handed to ``run`` are collected and
+    pushed through the model ``crop_batch`` at a time, so ``crop_batch`` bounds
+    the forward memory (a flipped view counts against it). Logits are
+    scatter-added back into each job and divided by an overlap-count map that
+    is computed once per padded size. Everything stays on the device of the
+    job images.
+    """
+
+    def __init__(
+        self,
+        model,
+        classes,
+        crop_h,
+        crop_w,
+        crop_batch=1,
+        stride_rate=2 / 3,
+        flip=False,
+    ):
+        self.model = model
+        self.classes = classes
+        self.crop_h, self.crop_w = crop_h, crop_w
+        self.flip = flip
+        self.crop_batch = max(crop_batch // 2, 1) if flip else crop_batch
+        self.stride_h = int(np.ceil(crop_h * stride_rate))
+        self.stride_w = int(np.ceil(crop_w * stride_rate))
+        self._counts = {}
+
+    def _windows(self, new_h, new_w):
+        grid_h = int(np.ceil(float(new_h - self.crop_h) / self.stride_h) + 1)
+        grid_w = int(np.ceil(float(new_w - self.crop_w) / self.stride_w) + 1)
+        windows = []
+        for index_h in range(0, grid_h):
+            for index_w in range(0, grid_w):
+                e_h = min(index_h * self.stride_h + self.crop_h, new_h)
+                e_w = min(index_w * self.stride_w + self.crop_w, new_w)
+                windows.append((e_h - self.crop_h, e_w - self.crop_w))
+        return windows
+
+    def _count(self, new_h, new_w, device):
+        if (new_h, new_w) not in self._counts:
+            count_crop = torch.zeros((new_h, new_w), dtype=torch.float, device=device)
+            for s_h, s_w in self._windows(new_h, new_w):
+                count_crop[s_h : s_h + self.crop_h, s_w : s_w + self.crop_w] += 1
+            self._counts[(new_h, new_w)] = count_crop
+        return self._counts[(new_h, new_w)]
+
+    def run(self, jobs, num_outputs):
+        """``jobs`` holds (image [1, C, H, W], output index, (h, w)) tuples; the
+        predictions of jobs sharing an output index are summed at size (h, w)."""
+        outputs = [None] * num_outputs
+        states, crops = [], []
+        for image, out_idx, size in jobs:
+            ori_h, ori_w = image.size()[-2:]
+            pad_h = max(self.crop_h - ori_h, 0)
+            pad_w = max(self.crop_w - ori_w, 0)
+            pad_h_half = int(pad_h / 2)
+            pad_w_half = int(pad_w / 2)
+            if pad_h > 0 or pad_w > 0:
+                border = (
+                    pad_w_half,
+                    pad_w - pad_w_half,
+                    pad_h_half,
+                    pad_h - pad_h_half,
                 )
+                image = F.pad(image, border, mode="constant", value=0.0)
+            new_h, new_w = image.size()[-2:]
+            windows = self._windows(new_h, new_w)
+            crops += [(len(states), s_h, s_w) for s_h, s_w in windows]
+            states.append(
+                {
+                    "image": image,
+                    "prediction": torch.zeros(
+                        (1, self.classes, new_h, new_w),
+                        dtype=torch.float,
+                        device=image.device,
+                    ),
+                    "remaining": len(windows),
+                    "box": (pad_h_half, pad_w_half, ori_h, ori_w),
+                    "out_idx": out_idx,
+                    "size": size,
+                }
+            )
 
-    prediction_crop /= count_crop
-    prediction_crop = prediction_crop[
-        :, :, pad_h_half : pad_h_half + ori_h, pad_w_half : pad_w_half + ori_w
-    ]
-    prediction = F.interpolate(
-        prediction_crop, size=(h, w), mode="bilinear", align_corners=True
+        for start in range(0, len(crops), self.crop_batch):
+            chunk = crops[start : start + self.crop_batch]
+            image_crop = torch.cat(
+                [
+                    states[k]["image"][
+                        :, :, s_h : s_h + self.crop_h, s_w : s_w + self.crop_w
+                    ]
+                    for k, s_h, s_w in chunk
+                ]
+            )
+            prediction = net_process(self.model, image_crop, flip=self.flip)
+            for logits, (k, s_h, s_w) in zip(prediction, chunk):
+                state = states[k]
+                state["prediction"][
+                    0, :, s_h : s_h + self.crop_h, s_w : s_w + self.crop_w
+                ] += logits
+                state["remaining"] -= 1
+                if state["remaining"] == 0:
+                    self._finish(state, outputs)
+                    states[k] = None
+        return outputs
+
+    def _finish(self, state, outputs):
+        prediction_crop = state["prediction"]
+        prediction_crop /= self._count(
+            *prediction_crop.shape[-2:], prediction_crop.device
+        )
+        pad_h_half, pad_w_half, ori_h, ori_w = state["box"]
+        prediction_crop = prediction_crop[
+            :, :, pad_h_half : pad_h_half + ori_h, pad_w_half : pad_w_half + ori_w
+        ]
+        prediction = F.interpolate(
+            prediction_crop, size=state["size"], mode="bilinear", align_corners=True
+        )[0]
+        if outputs[state["out_idx"]] is None:
+            outputs[state["out_idx"]] = prediction
+        else:
+            outputs[state["out_idx"]] += prediction
+
+
+def scale_crop_process(model, image, classes, crop_h, crop_w, h, w, stride_rate=2 / 3):
+    engine = SlidingWindowEngine(
+        model, classes, crop_h, crop_w, stride_rate=stride_rate
     )
-    return prediction[0]
+    return engine.run([(image, 0, (h, w))], 1)[0]
 
 
-def scale_whole_process(model, image, h, w):
+def scale_whole_process(model, image, h, w, flip=False):
     with torch.no_grad():
-        prediction = net_process(model, image)
+        prediction = net_process(model, image, flip=flip)
     prediction = F.interpolate(
         prediction, size=(h, w), mode="bilinear", align_corners=True
     )
@@ -235,96 +368,114 @@ def scale_whole_process(model, image, h, w):
 def validate_city(
     model,
     classes,
-    data_list,
-    mean,
-    std,
+    loader,
     base_size,
     crop_h,
     crop_w,
     scales,
     gray_folder,
     color_folder,
+    crop_batch=1,
+    flip=False,
+    writer=None,
 ):
     global colormap
     logger.info(">>>>>>>>>>>>>>>> Start Crop Evaluation >>>>>>>>>>>>>>>>")
     data_time = AverageMeter()
     batch_time = AverageMeter()
-    intersection_meter = AverageMeter()
-    union_meter = AverageMeter()
+    metric = SegMetric(classes, device=torch.cuda.current_device())
 
+    engine = SlidingWindowEngine(
+        model, classes, crop_h, crop_w, crop_batch=crop_batch, flip=flip
+    )
+
+    dset = loader.dataset
+    num_images = len(loader.sampler)
+    i = 0
     model.eval()
     end = time.time()
-    for i, (input_pth, label_path) in enumerate(data_list):
+    for images, labels, indices in loader:
         data_time.update(time.time() - end)
-        image = Image.open(input_pth).convert("RGB")
-        image = np.asarray(image).astype(np.float32)
-        label = Image.open(label_path).convert("L")
-        label = np.asarray(label).astype(np.uint8)
-
-        image = (image - mean) / std
-        image = torch.Tensor(image).permute(2, 0, 1)
-        image = image.contiguous().unsqueeze(dim=0)
-        h, w = image.size()[-2:]
-        prediction = torch.zeros((classes, h, w), dtype=torch.float).cuda()
-        for scale in scales:
-            long_size = round(scale * base_size)
-            new_h = long_size
-            new_w = long_size
-            if h > w:
-                new_w = round(long_size / float(h) * w)
-            else:
-                new_h = round(long_size / float(w) * h)
-            image_scale = F.interpolate(
-                image, size=(new_h, new_w), mode="bilinear", align_corners=True
-            )
-            prediction += scale_crop_process(
-                model, image_scale, classes, crop_h, crop_w, h, w
-            )
-        prediction = torch.max(prediction, dim=0)[1].cpu().numpy()
-        batch_time.update(time.time() - end)
-        end = time.time()
-        if (i + 1) % 10 == 0:
-            logger.info(
-                "Test: [{}/{}] "
-                "Data {data_time.val:.3f} ({data_time.avg:.3f}) "
-                "Batch {batch_time.val:.3f} ({batch_time.avg:.3f}).".format(
-                    i + 1, len(data_list), data_time=data_time, batch_time=batch_time
+        jobs = []
+        for k, image in enumerate(images):
+            image = image.cuda(non_blocking=True).unsqueeze(dim=0)
+            h, w = image.size()[-2:]
+            for scale in scales:
+                long_size = round(scale * base_size)
+                new_h = long_size
+                new_w = long_size
+                if h > w:
+                    new_w = round(long_size / float(h) * w)
+                else:
+                    new_h = round(long_size / float(w) * h)
+                image_scale = F.interpolate(
+                    image, size=(new_h, new_w), mode="bilinear", align_corners=True
                 )
-            )
-        gray = np.uint8(prediction)
-        color = colorize(gray, colormap)
-
-        image_path, _ = data_list[i]
-        image_name = image_path.split("/")[-1].split(".")[0]
-        color_path = os.path.join(color_folder, image_name + ".png")
-        color.save(color_path)
-
-        intersection, union, target = intersectionAndUnion(gray, label, classes)
-        intersection_meter.update(intersection)
-        union_meter.update(union)
+                jobs.append((image_scale, k, (h, w)))
+
+        predictions = engine.run(jobs, len(images))
+        for prediction, label, index in zip(predictions, labels, indices):
+            i += 1
+            prediction = torch.max(prediction, dim=0)[1]
+            metric.update(prediction, label)
+            prediction = prediction.cpu().numpy()
+            batch_time.update((time.time() - end) / len(images))
+            if i % 10 == 0:
+                logger.info(
+                    "Test: [{}/{}] "
+                    "Data {data_time.val:.3f} ({data_time.avg:.3f}) "
+                    "Batch {batch_time.val:.3f} ({batch_time.avg:.3f}).".format(
+                        i,
+                        num_images,
+                        data_time=data_time,
+                        batch_time=batch_time,
+                    )
+                )
+            gray = np.uint8(prediction)
+            if writer is not None:
+                image_path = dset.image_path(index)
+                image_name = image_path.split("/")[-1].split(".")[0]
+                color_path = os.path.join(color_folder, image_name + ".png")
+                writer.submit(save_prediction, gray, colormap, color_path=color_path)
+        end = time.time()
 
-    iou_class = intersection_meter.sum / (union_meter.sum + 1e-10)
+    metric.all_reduce()
+    iou_class = metric.iou().cpu().numpy()
     for i, iou in enumerate(iou_class):
         logger.info(" * class [{}] IoU {:.2f}".format(i, iou * 100))
     logger.info(" * mIoU {:.2f}".format(np.mean(iou_class) * 100))
     logger.info("<<<<<<<<<<<<<<<<< End Crop Evaluation <<<<<<<<<<<<<<<<<")
+    return np.mean(iou_class), batch_time.avg
+
+
+def iter_samples(loader):
+    for batch in loader:
+        yield from zip(*batch)
 
 
 def valiadte_whole(
-    model, classes, data_list, mean, std, scales, gray_folder, color_folder
+    model,
+    classes,
+    loader,
+    scales,
+    gray_folder,
+    color_folder,
+    flip=False,
+    writer=None,
 ):
     logger.info(">>>>>>>>>>>>>>>> Start Evaluation >>>>>>>>>>>>>>>>")
     data_time = AverageMeter()
     batch_time = AverageMeter()
+    metric = SegMetric(classes, device=torch.cuda.current_device())
+    dset = loader.dataset
+    num_images = len(loader.sampler)
+    i = 0
     model.eval()
     end = time.time()
-    for i, (input_pth, _) in enumerate(data_list):
+    for image, label, index in iter_samples(loader):
+        i += 1
         data_time.update(time.time() - end)
-        image = Image.open(input_pth).convert("RGB")
-        image = np.asarray(image).astype(np.float32)
-        image = (image - mean) / std
-        image = torch.Tensor(image).permute(2, 0, 1)
-        image = image.contiguous().unsqueeze(dim=0)
+        image = image.cuda(non_blocking=True).unsqueeze(dim=0)
         h, w = image.size()[-2:]
         prediction = torch.zeros((classes, h, w), dtype=torch.float).cuda()
         for scale in scales:
@@ -333,32 +484,55 @@ def valiadte_whole(
             image_scale = F.interpolate(
                 image, size=(new_h, new_w), mode="bilinear", align_corners=True
             )
-            prediction += scale_whole_process(model, image_scale, h, w)
-        prediction = (
-            torch.max(prediction, dim=0)[1].cpu().numpy()
-        )  ##############attention###############
+            prediction += scale_whole_process(model, image_scale, h, w, flip=flip)
+        prediction = torch.max(prediction, dim=0)[1]
+        metric.update(prediction, label)
+        prediction = prediction.cpu().numpy()
         batch_time.update(time.time() - end)
         end = time.time()
-        if (i + 1) % 10 == 0:
+        if i % 10 == 0:
             logger.info(
                 "Test: [{}/{}] "
                 "Data {data_time.val:.3f} ({data_time.avg:.3f}) "
                 "Batch {batch_time.val:.3f} ({batch_time.avg:.3f}).".format(
-                    i + 1, len(data_list), data_time=data_time, batch_time=batch_time
+                    i, num_images, data_time=data_time, batch_time=batch_time
                 )
             )
+        gray = np.uint8(prediction)
+        if writer is None:
+            continue
         check_makedirs(gray_folder)
         check_makedirs(color_folder)
-        gray = np.uint8(prediction)
-        color = colorize(gray,colormap)
-        image_path, _ = data_list[i]
+        image_path = dset.image_path(index)
         image_name = image_path.split("/")[-1].split(".")[0]
         gray_path = os.path.join(gray_folder, image_name + ".png")
         color_path = os.path.join(color_folder, image_name + ".png")
-        gray = Image.fromarray(gray)
-        gray.save(gray_path)
-        color.save(color_path)
+        writer.submit(save_prediction, gray, colormap, gray_path, color_path)
+
+    metric.all_reduce()
+    iou_class = metric.iou().cpu().numpy()
+    logger.info(" * mIoU {:.2f}".format(np.mean(iou_class) * 100))
     logger.info("<<<<<<<<<<<<<<<<< End  Evaluation <<<<<<<<<<<<<<<<<")
+    return np.mean(iou_class), batch_time.avg
+
+
+def tta_report(evaluate, scales, flip):
+    """Run ``evaluate(scales, flip)`` for every TTA level and log its cost."""
+    rows = []
+    for level_scales, level_flip in tta_levels(scales, flip):
+        miou, latency = evaluate(level_scales, level_flip)
+        rows.append((level_scales, level_flip, latency, miou))
+
+    logger.info(" * TTA report")
+    logger.info(
+        " * {:<32} {:<5} {:>10} {:>7}".format("scales", "flip", "s/img", "mIoU")
+    )
+    for level_scales, level_flip, latency, miou in rows:
+        logger.info(
+            " * {:<32} {:<5} {:>10.3f} {:>7.2f}".format(
+                str(level_scales), str(level_flip), latency, miou * 100
+            )
+        )
 
 
 if __name__ == "__main__":
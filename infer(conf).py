@@ -18,6 +18,7 @@ import yaml
 from PIL import Image
 from tqdm import tqdm
 
+from u2pl.dataset.evaluation import build_color_lut, build_evalloader, eval_dset
 from u2pl.models.model_helper import ModelBuilder
 from u2pl.utils.utils import (
     AverageMeter,
@@ -29,9 +30,10 @@ from u2pl.utils.utils import (
 
 
 def confusion_matrix(cm, y_true, y_pred):
-    for y_t, y_p in zip(y_true, y_pred):
-        cm[y_t][y_p] += 1
-
+    num_classes = cm.shape[0]
+    cm += torch.bincount(
+        y_true.flatten() * num_classes + y_pred.flatten(), minlength=num_classes**2
+    ).view(num_classes, num_classes)
     return cm
 
 
@@ -48,6 +50,14 @@ def get_parser():
     parser.add_argument(
         "--save_folder", type=str, default="npy", help="results save folder"
     )
+    parser.add_argument(
+        "--gt_root",
+        type=str,
+        default="/Data1/jbchae/U2PL/data/VOC2012/SegmentationClass",
+        help="folder of the RGB palette ground truth",
+    )
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=4)
     return parser
 
 
@@ -81,27 +91,10 @@ def main():
     print(f"Write confusion matrix at {cm_fname}")
 
     # data_root, f_data_list = cfg_dset["val"]["data_root"], cfg_dset["val"]["data_list"]
-    data_list = []
-
     if "cityscapes" in cfg_dset["type"]:
         data_root, f_data_list = "data/cityscapes", "data/splits/cityscapes/val.txt"
-        for line in open(f_data_list, "r"):
-            arr = [
-                line.strip(),
-                "gtFine/" + line.strip()[12:-15] + "gtFine_labelTrainIds.png",
-            ]
-            arr = [os.path.join(data_root, item) for item in arr]
-            data_list.append(arr)
-
     else:
         data_root, f_data_list = "data/VOC2012", "data/splits/pascal/val.txt"
-        for line in open(f_data_list, "r"):
-            arr = [
-                "JPEGImages/{}.jpg".format(line.strip()),
-                "SegmentationClassAug/{}.png".format(line.strip()),
-            ]
-            arr = [os.path.join(data_root, item) for item in arr]
-            data_list.append(arr)
 
     # Create network.
     args.use_auxloss = True if cfg["net"].get("aux_loss", False) else False
@@ -145,54 +138,29 @@ def main():
     ]
 
     model.eval()
-    cm = np.zeros(shape=(21, 21))
-    for image_path, label_path in tqdm(data_list):
-        image_name = image_path.split("/")[-1]
-
-        org_image = Image.open(image_path).convert("RGB")
-        org_image = np.asarray(org_image).astype(np.float32)
-        h, w, _ = org_image.shape
-        image = (org_image - mean) / std
-        image = torch.Tensor(image).permute(2, 0, 1)
-        image = image.unsqueeze(dim=0)
-        image = F.interpolate(image, input_scale, mode="bilinear", align_corners=True)
-
-        gt_pil = Image.open(
-            os.path.join(
-                "/Data1/jbchae/U2PL/data/VOC2012/SegmentationClass",
-                os.path.splitext(image_name)[0] + ".png",
+    dataset = eval_dset(
+        data_root,
+        f_data_list,
+        mean,
+        std,
+        input_size=input_scale,
+        gt_root=args.gt_root,
+        lut=build_color_lut(colormap),
+    )
+    loader = build_evalloader(dataset, args.batch_size, args.workers)
+    cm = torch.zeros((21, 21), dtype=torch.long).cuda()
+    for images, gts, _ in tqdm(loader):
+        images = torch.stack([image.cuda(non_blocking=True) for image in images])
+        outputs = net_process(model, images)
+        for output, gt in zip(outputs, gts):
+            gt = gt.long().cuda(non_blocking=True)
+            output = F.interpolate(
+                output.unsqueeze(0), gt.shape, mode="bilinear", align_corners=True
             )
-        ).convert("RGB")
-        gt = np.asarray(gt_pil).astype("uint8")
-
-        output = net_process(model, image)
-        output = F.interpolate(output, (h, w), mode="bilinear", align_corners=True)
-        mask = torch.argmax(output, dim=1).squeeze().cpu().numpy()
-
-        # color_mask = Image.fromarray(colorful(mask, colormap))
-        # color_mask.save(os.path.join(color_folder, image_name))
-        color_mask, labels = colorful(mask, colormap)
-
-        gt_arr = list()
-        for row in gt:
-            for pixel in row:
-                try:
-                    gt_arr.append(np.argwhere((colormap == pixel).all(axis=1))[0][0])
-                except:
-                    gt_arr.append(0)
-
-        color_mask_arr = list()
-        for row in color_mask:
-            for pixel in row:
-                try:
-                    color_mask_arr.append(
-                        np.argwhere((colormap == pixel).all(axis=1))[0][0]
-                    )
-                except:
-                    color_mask_arr.append(0)
-
-        cm = confusion_matrix(cm=cm, y_true=gt_arr, y_pred=color_mask_arr)
+            mask = torch.argmax(output, dim=1).squeeze(0)
+            cm = confusion_matrix(cm=cm, y_true=gt, y_pred=mask)
 
+    cm = cm.cpu().numpy().astype(np.float64)
     np.save(cm_fname, cm)
 
 
@@ -4,8 +4,8 @@ import sys
 import time
 from argparse import ArgumentParser
 
+from matplotlib.figure import Figure
 from matplotlib.gridspec import GridSpec
-import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 import numpy as np
 import torch
@@ -18,6 +18,7 @@ import yaml
 from PIL import Image
 from tqdm import tqdm
 
+from u2pl.dataset.evaluation import build_evalloader, eval_dset
 from u2pl.models.model_helper import ModelBuilder
 from u2pl.utils.utils import (
     AverageMeter,
@@ -26,6 +27,7 @@ from u2pl.utils.utils import (
     convert_state_dict,
     intersectionAndUnion,
 )
+from u2pl.utils.writer_helper import AsyncWriter
 
 
 # Setup Parser
@@ -41,6 +43,20 @@ def get_parser():
     parser.add_argument(
         "--save_folder", type=str, default="viewer", help="results save folder"
     )
+    parser.add_argument(
+        "--gt_root",
+        type=str,
+        default="/Data1/jbchae/U2PL/data/VOC2012/SegmentationClass",
+        help="folder of the RGB palette ground truth",
+    )
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--write_workers",
+        type=int,
+        default=4,
+        help="processes rendering and saving figures in the background",
+    )
     return parser
 
 
@@ -85,27 +101,10 @@ def main():
     os.makedirs(color_folder, exist_ok=True)
 
     # data_root, f_data_list = cfg_dset["val"]["data_root"], cfg_dset["val"]["data_list"]
-    data_list = []
-
     if "cityscapes" in cfg_dset["type"]:
         data_root, f_data_list = "data/cityscapes", "data/splits/cityscapes/val.txt"
-        for line in open(f_data_list, "r"):
-            arr = [
-                line.strip(),
-                "gtFine/" + line.strip()[12:-15] + "gtFine_labelTrainIds.png",
-            ]
-            arr = [os.path.join(data_root, item) for item in arr]
-            data_list.append(arr)
-
     else:
         data_root, f_data_list = "data/VOC2012", "data/splits/pascal/val.txt"
-        for line in open(f_data_list, "r"):
-            arr = [
-                "JPEGImages/{}.jpg".format(line.strip()),
-                "SegmentationClassAug/{}.png".format(line.strip()),
-            ]
-            arr = [os.path.join(data_root, item) for item in arr]
-            data_list.append(arr)
 
     # Create network.
     args.use_auxloss = True if cfg["net"].get("aux_loss", False) else False
@@ -149,63 +148,71 @@ def main():
     ]
 
     model.eval()
-    for image_path, label_path in tqdm(data_list):
-        image_name = image_path.split("/")[-1]
-
-        org_image = Image.open(image_path).convert("RGB")
-        org_image = np.asarray(org_image).astype(np.float32)
-        h, w, _ = org_image.shape
-        image = (org_image - mean) / std
-        image = torch.Tensor(image).permute(2, 0, 1)
-        image = image.unsqueeze(dim=0)
-        image = F.interpolate(image, input_scale, mode="bilinear", align_corners=True)
-
-        gt = Image.open(
-            os.path.join(
-                "/Data1/jbchae/U2PL/data/VOC2012/SegmentationClass",
-                os.path.splitext(image_name)[0] + ".png",
-            )
-        ).convert("RGB")
-        gt = np.asarray(gt).astype("uint8")
-
-        output = net_process(model, image)
-        output = F.interpolate(output, (h, w), mode="bilinear", align_corners=True)
-        mask = torch.argmax(output, dim=1).squeeze().cpu().numpy()
-
-        # color_mask = Image.fromarray(colorful(mask, colormap))
-        # color_mask.save(os.path.join(color_folder, image_name))
-        color_mask, labels = colorful(mask, colormap)
-
-        fig = plt.figure()
-
-        gs = GridSpec(2, 2)
-
-        ax1 = fig.add_subplot(gs[0, :])
-        ax1.imshow(org_image.astype("uint8"))
-        ax1.axis("off")
-
-        ax2 = fig.add_subplot(gs[1, 0])
-        ax2.imshow(gt)
-        ax2.axis("off")
-
-        ax3 = fig.add_subplot(gs[1, 1])
-        ax3.imshow(color_mask.astype("uint8"))
-        ax3.axis("off")
-
-        norm_colormap = colormap / 255.0
-        fig.legend(
-            handles=[
-                mpatches.Patch(color=norm_colormap[label], label=f"{label_names[label]}")  # type: ignore
-                for label in labels
-            ]
-        )
-
-        fig.tight_layout()
-
-        fig.savefig(os.path.join(color_folder, image_name))
-        plt.cla()
-        plt.clf()
-        plt.close()
+    dataset = eval_dset(
+        data_root,
+        f_data_list,
+        mean,
+        std,
+        input_size=input_scale,
+        gt_root=args.gt_root,
+        return_raw=True,
+    )
+    loader = build_evalloader(dataset, args.batch_size, args.workers)
+    with AsyncWriter(args.write_workers, processes=True) as writer:
+        for images, gts, indices, org_images in tqdm(loader):
+            images = torch.stack([image.cuda(non_blocking=True) for image in images])
+            outputs = net_process(model, images)
+            for output, gt, index, org_image in zip(outputs, gts, indices, org_images):
+                image_name = dataset.image_path(index).split("/")[-1]
+                h, w, _ = org_image.shape
+                output = F.interpolate(
+                    output.unsqueeze(0), (h, w), mode="bilinear", align_corners=True
+                )
+                mask = torch.argmax(output, dim=1).squeeze().cpu().numpy()
+
+                writer.submit(
+                    render_figure,
+                    os.path.join(color_folder, image_name),
+                    org_image,
+                    gt.numpy(),
+                    mask,
+                    colormap,
+                    label_names,
+                )
+
+
+def render_figure(path, image, gt, mask, colormap, label_names):
+    # figures are built with the object API so that no pyplot state is shared
+    # between writer workers
+    color_mask, labels = colorful(mask, colormap)
+
+    fig = Figure()
+
+    gs = GridSpec(2, 2)
+
+    ax1 = fig.add_subplot(gs[0, :])
+    ax1.imshow(image)
+    ax1.axis("off")
+
+    ax2 = fig.add_subplot(gs[1, 0])
+    ax2.imshow(gt)
+    ax2.axis("off")
+
+    ax3 = fig.add_subplot(gs[1, 1])
+    ax3.imshow(color_mask.astype("uint8"))
+    ax3.axis("off")
+
+    norm_colormap = colormap / 255.0
+    fig.legend(
+        handles=[
+            mpatches.Patch(color=norm_colormap[label], label=f"{label_names[label]}")  # type: ignore
+            for label in labels
+        ]
+    )
+
+    fig.tight_layout()
+
+    fig.savefig(path)
 
 
 def colorful(mask, colormap):
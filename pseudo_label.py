@@ -0,0 +1,83 @@
+import logging
+from argparse import ArgumentParser
+
+import torch
+import torch.nn.functional as F
+import yaml
+from tqdm import tqdm
+
+from u2pl.dataset.evaluation import build_evalloader, eval_dset
+from u2pl.dataset.pseudo_label import PseudoLabelStore, quantize_prediction
+from u2pl.models.model_helper import ModelBuilder
+from u2pl.utils.utils import convert_state_dict
+
+
+# Setup Parser
+def get_parser():
+    parser = ArgumentParser(description="Offline teacher pseudo-labeling")
+    parser.add_argument("--config", type=str, default="config.yaml")
+    parser.add_argument(
+        "--model_path",
+        type=str,
+        default="checkpoints/ckpt_best.pth",
+        help="checkpoint holding the teacher",
+    )
+    parser.add_argument(
+        "--store",
+        type=str,
+        default="pseudo_label",
+        help="output folder, set it as dataset.train.pseudo_label for training",
+    )
+    parser.add_argument("--workers", type=int, default=4)
+    return parser
+
+
+def get_logger():
+    logger_name = "main-logger"
+    logger = logging.getLogger(logger_name)
+    logger.setLevel(logging.INFO)
+    handler = logging.StreamHandler()
+    fmt = "[%(asctime)s %(levelname)s %(filename)s line %(lineno)d %(process)d] %(message)s"
+    handler.setFormatter(logging.Formatter(fmt))
+    logger.addHandler(handler)
+    return logger
+
+
+def main():
+    args = get_parser().parse_args()
+    cfg = yaml.load(open(args.config, "r"), Loader=yaml.Loader)
+    logger = get_logger()
+    logger.info(args)
+
+    cfg_dset = cfg["dataset"]
+    data_root = cfg_dset["train"]["data_root"]
+    # the unlabeled split, as picked by the semi-supervised loaders
+    data_list = cfg_dset["train"]["data_list"].replace("labeled.txt", "unlabeled.txt")
+    dset = eval_dset(data_root, data_list, cfg_dset["mean"], cfg_dset["std"])
+    loader = build_evalloader(dset, 1, args.workers)
+
+    cfg["net"]["sync_bn"] = False
+    model = ModelBuilder(cfg["net"])
+    checkpoint = torch.load(args.model_path, map_location="cpu")
+    key = "teacher_state" if "teacher_state" in checkpoint.keys() else "model_state"
+    logger.info(f"=> load checkpoint[{key}]")
+    model.load_state_dict(convert_state_dict(checkpoint[key]), strict=False)
+    model.cuda()
+    model.eval()
+
+    @torch.no_grad()
+    def predict():
+        for images, _, indices in tqdm(loader):
+            image = images[0].cuda(non_blocking=True).unsqueeze(0)
+            h, w = image.shape[-2:]
+            pred = model(image)["pred"]
+            pred = F.interpolate(pred, (h, w), mode="bilinear", align_corners=True)
+            prob = F.softmax(pred.float(), dim=1)[0]
+            yield dset.image_path(indices[0]), quantize_prediction(prob)
+
+    PseudoLabelStore.build(args.store, predict(), cfg["net"]["num_classes"])
+    logger.info("Wrote pseudo-labels of {} images to {}".format(len(dset), args.store))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""The former per-sample mix mask generators, the reference of
+tests/test_mix_masks.py and benchmarks/bench_mix_masks.py."""
+
+import numpy as np
+import torch
+
+
+def old_generate_cutout_mask(img_size, ratio=2):
+    # the former per-sample implementation
+    cutout_area = img_size[0] * img_size[1] / ratio
+
+    w = np.random.randint(img_size[1] / ratio + 1, img_size[1])
+    h = np.round(cutout_area / w)
+
+    x_start = np.random.randint(0, img_size[1] - w + 1)
+    y_start = np.random.randint(0, img_size[0] - h + 1)
+
+    x_end = int(x_start + w)
+    y_end = int(y_start + h)
+
+    mask = torch.ones(img_size)
+    mask[y_start:y_end, x_start:x_end] = 0
+    return mask.long()
+
+
+def old_generate_class_mask(pseudo_labels):
+    # the former per-sample implementation
+    labels = torch.unique(pseudo_labels)
+    labels_select = labels[torch.randperm(len(labels))][: len(labels) // 2]
+
+    mask = (pseudo_labels.unsqueeze(-1) == labels_select).any(-1)
+    return mask.float()
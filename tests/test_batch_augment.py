@@ -0,0 +1,142 @@
+import math
+import random
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+stats = pytest.importorskip("scipy.stats")
+pytest.importorskip("cv2")
+
+from u2pl.dataset import augmentation as psp_trsform  # noqa: E402
+
+IGNORE = 255
+CLASSES = [3, 7, 12]
+SIZES = [64, 56]
+CROP = [48, 48]
+RAND_RESIZE = [0.5, 2.0]
+RAND_ROTATION = [-10.0, 10.0]
+NUM_SAMPLES = 400
+# independent seeds, a p-value this low would flag a real difference
+MIN_P_VALUE = 1e-3
+
+
+def make_sample(i):
+    """Square uint8 image whose channels are ramps of the source column and
+    row, and a label of vertical class bands."""
+    size = SIZES[i % len(SIZES)]
+    ramp = 3 * torch.arange(size) + 10
+    image = torch.stack(
+        (
+            ramp.view(1, -1).expand(size, size),
+            ramp.view(-1, 1).expand(size, size),
+            torch.full((size, size), 10),
+        )
+    ).to(torch.uint8)
+    band = torch.tensor(CLASSES)[torch.arange(size) * len(CLASSES) // size]
+    label = band.view(1, -1).expand(size, size).clone()
+    return image, label
+
+
+def per_sample(samples):
+    trs_form = psp_trsform.Compose(
+        [
+            psp_trsform.Normalize(mean=[0.0, 0.0, 0.0], std=[1.0, 1.0, 1.0]),
+            psp_trsform.RandResize(RAND_RESIZE),
+            psp_trsform.RandRotate(RAND_ROTATION, ignore_label=IGNORE),
+            psp_trsform.RandomHorizontalFlip(),
+            psp_trsform.Crop(CROP, crop_type="rand", ignore_label=IGNORE),
+        ]
+    )
+    images, labels = [], []
+    for image, label in samples:
+        image, label = trs_form(image[None].float(), label[None, None].float())
+        images.append(image[0])
+        labels.append(label[0, 0].long())
+    return torch.stack(images), torch.stack(labels)
+
+
+def batched(samples):
+    augment = psp_trsform.BatchAugment(
+        [0.0, 0.0, 0.0],
+        [1.0, 1.0, 1.0],
+        CROP,
+        crop_type="rand",
+        rand_resize=RAND_RESIZE,
+        rand_rotation=RAND_ROTATION,
+        flip=True,
+        ignore_label=IGNORE,
+    )
+    return augment(*psp_trsform.pad_collate(samples))
+
+
+def measure(image, label):
+    """Scale, flip, rotation angle, ignore and crop padding fractions of one
+    augmented sample, read back from the source coordinate ramps."""
+    # central differences where the whole 3x3 neighbourhood is source content
+    content = torch.zeros(label.shape, dtype=torch.bool)
+    content[1:-1, 1:-1] = True
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            shifted = torch.roll(label, (dy, dx), dims=(0, 1))
+            content &= (shifted != IGNORE) & (shifted != 0)
+    src = image[:2] / 3
+    d_dx = (torch.roll(src, -1, 2) - torch.roll(src, 1, 2)) / 2
+    d_dy = (torch.roll(src, -1, 1) - torch.roll(src, 1, 1)) / 2
+    # jacobian of the source (x, y) in output (x, y), (1 / scale) R^-1 F
+    jac = np.array(
+        [
+            [d_dx[0][content].median().item(), d_dy[0][content].median().item()],
+            [d_dx[1][content].median().item(), d_dy[1][content].median().item()],
+        ]
+    )
+    det = np.linalg.det(jac)
+    flipped = det < 0
+    if flipped:
+        jac = jac @ np.diag([-1.0, 1.0])
+    return {
+        "scale": 1 / math.sqrt(abs(det)),
+        "flip": flipped,
+        "angle": math.degrees(math.atan2(jac[1, 0], jac[0, 0])),
+        "ignore": (label == IGNORE).float().mean().item(),
+        "padding": (label == 0).float().mean().item(),
+    }
+
+
+def test_matches_per_sample_distributions():
+    samples = [make_sample(i) for i in range(NUM_SAMPLES)]
+
+    np.random.seed(0)
+    torch.manual_seed(0)
+    random.seed(0)
+    old_images, old_labels = per_sample(samples)
+    random.seed(1)
+    new_images, new_labels = batched(samples)
+
+    assert new_images.shape == old_images.shape == (NUM_SAMPLES, 3) + tuple(CROP)
+    assert new_labels.shape == old_labels.shape == (NUM_SAMPLES,) + tuple(CROP)
+    assert new_labels.dtype == torch.long
+
+    # nearest sampling: existing classes, the rotation fill or the crop padding
+    allowed = set(CLASSES) | {IGNORE, 0}
+    assert set(old_labels.unique().tolist()) <= allowed
+    assert set(new_labels.unique().tolist()) <= allowed
+
+    old = [measure(*sample) for sample in zip(old_images, old_labels)]
+    new = [measure(*sample) for sample in zip(new_images, new_labels)]
+
+    scales = [m["scale"] for m in new]
+    assert RAND_RESIZE[0] * 0.95 <= min(scales) <= max(scales) <= RAND_RESIZE[1] * 1.05
+    angles = [m["angle"] for m in new]
+    assert min(angles) >= RAND_ROTATION[0] - 1 and max(angles) <= RAND_ROTATION[1] + 1
+
+    for key in ("scale", "angle", "ignore", "padding"):
+        _, p_value = stats.ks_2samp([m[key] for m in old], [m[key] for m in new])
+        assert p_value > MIN_P_VALUE, key
+
+    flips = [
+        [sum(m["flip"] for m in ms), NUM_SAMPLES - sum(m["flip"] for m in ms)]
+        for ms in (old, new)
+    ]
+    _, p_value, _, _ = stats.chi2_contingency(np.array(flips))
+    assert p_value > MIN_P_VALUE
@@ -0,0 +1,120 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+nn = torch.nn
+F = torch.nn.functional
+
+from u2pl.models.base import frozen_bn_stats  # noqa: E402
+from u2pl.models.model_helper import ModelBuilder  # noqa: E402
+
+CHECKPOINT = [
+    "layer1",
+    "layer2",
+    "layer3",
+    "layer4",
+    "aspp",
+    "head",
+    "classifier",
+    "representation",
+]
+
+
+def net_cfg():
+    # experiments/pascal/*/ours, ResNet-50 without ImageNet weights and plain BN
+    return {
+        "num_classes": 21,
+        "sync_bn": False,
+        "encoder": {
+            "type": "u2pl.models.resnet.resnet50",
+            "kwargs": {
+                "pretrained": False,
+                "multi_grid": True,
+                "zero_init_residual": True,
+                "fpn": True,
+                "replace_stride_with_dilation": [False, True, True],
+            },
+        },
+        "decoder": {
+            "type": "u2pl.models.decoder.dec_deeplabv3_plus",
+            "kwargs": {"inner_planes": 256, "dilations": [12, 24, 36]},
+        },
+    }
+
+
+def bn_buffers(model):
+    return {
+        name: buf.clone()
+        for name, buf in model.named_buffers()
+        if name.endswith(("running_mean", "running_var", "num_batches_tracked"))
+    }
+
+
+def train_step(model, image, target):
+    outs = model(image)
+    pred = F.interpolate(
+        outs["pred"], target.shape[1:], mode="bilinear", align_corners=True
+    )
+    loss = F.cross_entropy(pred, target) + outs["rep"].pow(2).mean()
+    model.zero_grad(set_to_none=True)
+    loss.backward()
+    return outs
+
+
+def test_matches_without_checkpoint():
+    torch.manual_seed(0)
+    model = ModelBuilder(net_cfg()).train()
+    cp_model = copy.deepcopy(model)
+    cp_model._set_checkpoint(CHECKPOINT)
+    assert cp_model.decoder.aspp.use_checkpoint
+    assert all(block.use_checkpoint for block in cp_model.encoder.layer3)
+    assert not getattr(model.decoder.aspp, "use_checkpoint", False)
+    start = bn_buffers(model)
+
+    gen = torch.Generator().manual_seed(0)
+    for step in range(1, 3):
+        image = torch.randn((2, 3, 65, 65), generator=gen)
+        target = torch.randint(0, 21, (2, 65, 65), generator=gen)
+
+        # same dropout masks in both runs, the checkpoint replays the RNG state
+        torch.manual_seed(step)
+        outs = train_step(model, image, target)
+        torch.manual_seed(step)
+        cp_outs = train_step(cp_model, image, target)
+
+        for key in ("pred", "rep"):
+            torch.testing.assert_close(cp_outs[key], outs[key])
+        grads = dict(model.named_parameters())
+        for name, param in cp_model.named_parameters():
+            torch.testing.assert_close(param.grad, grads[name].grad, msg=name)
+
+        # the recomputation leaves the running statistics alone
+        buffers, cp_buffers = bn_buffers(model), bn_buffers(cp_model)
+        for name, buf in cp_buffers.items():
+            torch.testing.assert_close(buf, buffers[name], msg=name)
+            if name.endswith("num_batches_tracked"):
+                assert buf.item() == start[name].item() + step, name
+            elif name.endswith("running_mean") and step == 1:
+                assert not torch.equal(buf, start[name]), name
+
+
+def test_frozen_bn_stats():
+    bn = nn.BatchNorm2d(4, momentum=0.3).train()
+    x = torch.randn(2, 4, 5, 5)
+    bn(x)
+    mean, var = bn.running_mean.clone(), bn.running_var.clone()
+
+    with frozen_bn_stats(nn.Sequential(bn)):
+        out = bn(x)
+        bn(x)
+    torch.testing.assert_close(bn.running_mean, mean)
+    torch.testing.assert_close(bn.running_var, var)
+    assert bn.num_batches_tracked.item() == 1
+    assert bn.momentum == 0.3
+    # still normalized with the batch statistics
+    torch.testing.assert_close(out, F.batch_norm(x, None, None, training=True))
+
+    bn(x)
+    assert not torch.equal(bn.running_mean, mean)
+    assert bn.num_batches_tracked.item() == 2
@@ -0,0 +1,242 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+F = torch.nn.functional
+
+from u2pl.utils.loss_helper import compute_contra_memobank_loss  # noqa: E402
+from u2pl.utils.utils import MemoryBank, draw_index, label_onehot  # noqa: E402
+
+NUM_CLASSES = 4
+NUM_FEAT = 8
+QUEUE_SIZE = 30
+CFG = {
+    "current_class_threshold": 0.3,
+    "current_class_negative_threshold": 1,
+    "low_rank": 1,
+    "high_rank": 3,
+    "temperature": 0.5,
+    "num_queries": 5,
+    "num_negatives": 6,
+}
+
+
+def old_dequeue_and_enqueue(keys, queue, queue_size):
+    # former list queue of a single process: keys in insertion order
+    queue[0] = torch.cat((queue[0], keys), dim=0)[-queue_size:]
+    return keys.shape[0]
+
+
+def old_compute_contra_memobank_loss(
+    rep,
+    label_l,
+    label_u,
+    prob_l,
+    prob_u,
+    low_mask,
+    high_mask,
+    cfg,
+    memobank,
+    rep_teacher,
+    anchor_rows,
+    negative_rows,
+):
+    """The former per-class loop, on the CPU and with the ``torch.randint``
+    draws replaced by the rows in ``anchor_rows`` / ``negative_rows``."""
+    current_class_threshold = cfg["current_class_threshold"]
+    current_class_negative_threshold = cfg["current_class_negative_threshold"]
+    low_rank, high_rank = cfg["low_rank"], cfg["high_rank"]
+    temp = cfg["temperature"]
+    num_queries = cfg["num_queries"]
+    num_negatives = cfg["num_negatives"]
+
+    num_feat = rep.shape[1]
+    num_segments = label_l.shape[1]
+
+    low_valid_pixel = torch.cat((label_l, label_u), dim=0) * low_mask
+    high_valid_pixel = torch.cat((label_l, label_u), dim=0) * high_mask
+
+    rep = rep.permute(0, 2, 3, 1)
+    rep_teacher = rep_teacher.permute(0, 2, 3, 1)
+
+    seg_feat_low_entropy_list = []
+    seg_num_list = []
+    seg_proto_list = []
+
+    _, prob_indices_l = torch.sort(prob_l, 1, True)
+    prob_indices_l = prob_indices_l.permute(0, 2, 3, 1)
+    _, prob_indices_u = torch.sort(prob_u, 1, True)
+    prob_indices_u = prob_indices_u.permute(0, 2, 3, 1)
+
+    prob = torch.cat((prob_l, prob_u), dim=0)
+
+    valid_classes = []
+    new_keys = []
+    for i in range(num_segments):
+        low_valid_pixel_seg = low_valid_pixel[:, i]
+        high_valid_pixel_seg = high_valid_pixel[:, i]
+
+        prob_seg = prob[:, i, :, :]
+        rep_mask_low_entropy = (
+            prob_seg > current_class_threshold
+        ) * low_valid_pixel_seg.bool()
+        rep_mask_high_entropy = (
+            prob_seg < current_class_negative_threshold
+        ) * high_valid_pixel_seg.bool()
+
+        seg_feat_low_entropy_list.append(rep[rep_mask_low_entropy])
+        seg_proto_list.append(
+            torch.mean(
+                rep_teacher[low_valid_pixel_seg.bool()].detach(), dim=0, keepdim=True
+            )
+        )
+
+        class_mask_u = torch.sum(
+            prob_indices_u[:, :, :, low_rank:high_rank].eq(i), dim=3
+        ).bool()
+        class_mask_l = torch.sum(prob_indices_l[:, :, :, :low_rank].eq(i), dim=3).bool()
+        class_mask = torch.cat(
+            (class_mask_l * (label_l[:, i] == 0), class_mask_u), dim=0
+        )
+        negative_mask = rep_mask_high_entropy * class_mask
+
+        keys = rep_teacher[negative_mask].detach()
+        new_keys.append(old_dequeue_and_enqueue(keys, memobank[i], QUEUE_SIZE))
+
+        if low_valid_pixel_seg.sum() > 0:
+            seg_num_list.append(int(low_valid_pixel_seg.sum().item()))
+            valid_classes.append(i)
+
+    if len(seg_num_list) <= 1:
+        return new_keys, torch.tensor(0.0) * rep.sum()
+
+    reco_loss = torch.tensor(0.0)
+    seg_proto = torch.cat(seg_proto_list)
+    valid_seg = len(seg_num_list)
+
+    slot = 0
+    for i in range(valid_seg):
+        if (
+            len(seg_feat_low_entropy_list[i]) > 0
+            and memobank[valid_classes[i]][0].shape[0] > 0
+        ):
+            seg_low_entropy_idx = anchor_rows[slot]
+            anchor_feat = seg_feat_low_entropy_list[i][seg_low_entropy_idx].clone()
+        else:
+            reco_loss = reco_loss + 0 * rep.sum()
+            continue
+
+        with torch.no_grad():
+            negative_feat = memobank[valid_classes[i]][0].clone()
+            high_entropy_idx = negative_rows[slot]
+            negative_feat = negative_feat[high_entropy_idx]
+            negative_feat = negative_feat.reshape(num_queries, num_negatives, num_feat)
+            positive_feat = (
+                seg_proto[i].unsqueeze(0).unsqueeze(0).repeat(num_queries, 1, 1)
+            )
+            all_feat = torch.cat((positive_feat, negative_feat), dim=1)
+        slot += 1
+
+        seg_logits = torch.cosine_similarity(anchor_feat.unsqueeze(1), all_feat, dim=2)
+        reco_loss = reco_loss + F.cross_entropy(
+            seg_logits / temp, torch.zeros(num_queries).long()
+        )
+
+    return new_keys, reco_loss / valid_seg
+
+
+def make_step(gen, num_labeled=2, num_unlabeled=2, size=6):
+    batch = num_labeled + num_unlabeled
+
+    def rand(*shape):
+        return torch.rand(shape, generator=gen)
+
+    rep = torch.randn((batch, NUM_FEAT, size, size), generator=gen)
+    rep_teacher = torch.randn((batch, NUM_FEAT, size, size), generator=gen)
+    prob = F.softmax(
+        3 * torch.randn((batch, NUM_CLASSES, size, size), generator=gen), 1
+    )
+    label = torch.randint(0, NUM_CLASSES, (batch, size, size), generator=gen)
+    label[rand(batch, size, size) < 0.1] = 255
+    return {
+        "rep": rep,
+        "rep_teacher": rep_teacher,
+        "prob_l": prob[:num_labeled],
+        "prob_u": prob[num_labeled:],
+        "label_l": label[:num_labeled],
+        "label_u": label[num_labeled:],
+        "low_mask": rand(batch, size, size) < 0.7,
+        "high_mask": rand(batch, size, size) < 0.7,
+    }
+
+
+def test_matches_per_class_loop():
+    torch.manual_seed(0)
+    gen = torch.Generator().manual_seed(0)
+    memobank = MemoryBank([QUEUE_SIZE] * NUM_CLASSES, num_feat=NUM_FEAT, device="cpu")
+    old_memobank = [[torch.zeros((0, NUM_FEAT))] for _ in range(NUM_CLASSES)]
+
+    # enough steps for every class queue to wrap around
+    for _ in range(6):
+        step = make_step(gen)
+        draws = []
+
+        def recording_draw_index(high, num_samples):
+            idx = draw_index(high, num_samples)
+            draws.append(idx)
+            return idx
+
+        rep = step["rep"].clone().requires_grad_()
+        new_keys, loss = compute_contra_memobank_loss(
+            rep,
+            step["label_l"],
+            step["label_u"],
+            step["prob_l"],
+            step["prob_u"],
+            step["low_mask"],
+            step["high_mask"],
+            CFG,
+            memobank,
+            step["rep_teacher"],
+            draw_index=recording_draw_index,
+        )
+        # anchors are drawn first, memory bank negatives second
+        anchor_rows, negative_rows = draws if draws else ([], [])
+
+        old_rep = step["rep"].clone().requires_grad_()
+        old_new_keys, old_loss = old_compute_contra_memobank_loss(
+            old_rep,
+            label_onehot(step["label_l"], NUM_CLASSES),
+            label_onehot(step["label_u"], NUM_CLASSES),
+            step["prob_l"],
+            step["prob_u"],
+            step["low_mask"].unsqueeze(1).float(),
+            step["high_mask"].unsqueeze(1).float(),
+            CFG,
+            old_memobank,
+            step["rep_teacher"],
+            anchor_rows,
+            negative_rows,
+        )
+
+        assert new_keys == old_new_keys
+        torch.testing.assert_close(loss, old_loss)
+        if loss.requires_grad:
+            loss.backward()
+            old_loss.backward()
+            torch.testing.assert_close(rep.grad, old_rep.grad)
+
+    assert min(memobank.queue_fill) == QUEUE_SIZE
+
+
+def test_sample_reads_insertion_order():
+    memobank = MemoryBank([4], num_feat=1, device="cpu")
+    keys = torch.arange(6, dtype=torch.float).unsqueeze(1)
+    memobank.enqueue(keys[:3], [3])
+    # wraps around, the oldest key now sits at the write pointer
+    memobank.enqueue(keys[3:], [3])
+
+    def first(high, num_samples):
+        return torch.arange(num_samples).expand(high.shape[0], num_samples)
+
+    keys = memobank.sample([0], 4, draw_index=first)
+    assert keys.flatten().tolist() == [2.0, 3.0, 4.0, 5.0]
@@ -0,0 +1,36 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+F = torch.nn.functional
+
+from u2pl.utils.utils import downsample_label  # noqa: E402
+
+
+def reference(label, size):
+    # nearest interpolation of the label values, exact in float32 up to 2 ** 24
+    out = F.interpolate(label.float().unsqueeze(1), size=size, mode="nearest")
+    return out.squeeze(1).to(label.dtype)
+
+
+@pytest.mark.parametrize(
+    "in_size, out_size",
+    [
+        ((513, 513), (65, 65)),
+        ((769, 769), (97, 97)),
+        ((513, 769), (65, 97)),
+        ((321, 481), (41, 61)),
+        ((7, 5), (3, 4)),
+        ((33, 33), (65, 65)),
+        ((65, 97), (65, 97)),
+    ],
+)
+@pytest.mark.parametrize("dtype", [torch.long, torch.uint8, torch.bool])
+def test_matches_nearest_interpolate(in_size, out_size, dtype):
+    gen = torch.Generator().manual_seed(0)
+    high = 2 if dtype == torch.bool else 256
+    label = torch.randint(0, high, (2,) + in_size, generator=gen).to(dtype)
+
+    out = downsample_label(label, out_size)
+
+    assert out.dtype == dtype
+    assert torch.equal(out, reference(label, out_size))
@@ -0,0 +1,89 @@
+from collections import Counter
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+stats = pytest.importorskip("scipy.stats")
+
+from tests.mix_masks_reference import (  # noqa: E402
+    old_generate_class_mask,
+    old_generate_cutout_mask,
+)
+from u2pl.dataset.augmentation import (  # noqa: E402
+    generate_class_mask,
+    generate_cutout_mask,
+)
+
+NUM_DRAWS = 20000
+# seeded draws, a p-value this low would flag a real difference in distribution
+MIN_P_VALUE = 1e-3
+
+
+def same_distribution(old, new):
+    """Chi-square test of two samples of hashable outcomes."""
+    keys = list(set(old) | set(new))
+    table = np.array([[old[k] for k in keys], [new[k] for k in keys]])
+    if table.shape[1] == 1:
+        return True
+    _, p_value, _, _ = stats.chi2_contingency(table)
+    return p_value > MIN_P_VALUE
+
+
+def boxes(masks):
+    """(y_start, x_start, h, w) of the zero rectangle of every (H, W) mask."""
+    inside = masks == 0
+    rows, cols = inside.any(dim=2), inside.any(dim=1)
+    y_start, x_start = rows.int().argmax(dim=1), cols.int().argmax(dim=1)
+    h, w = rows.sum(dim=1), cols.sum(dim=1)
+    return torch.stack((y_start, x_start, h, w), dim=1).tolist()
+
+
+@pytest.mark.parametrize("ratio", [2, 3])
+def test_cutout_mask_distribution(ratio):
+    img_size = (33, 41)
+    np.random.seed(0)
+    old = torch.stack(
+        [old_generate_cutout_mask(img_size, ratio) for _ in range(NUM_DRAWS)]
+    )
+    new = generate_cutout_mask(img_size, ratio, batch_size=NUM_DRAWS)
+
+    # every mask zeroes a single rectangle
+    assert new.shape == (NUM_DRAWS,) + img_size
+    old_boxes, new_boxes = boxes(old), boxes(new)
+    area = torch.tensor(new_boxes)[:, 2:].prod(dim=1)
+    assert torch.equal((new == 0).sum(dim=(1, 2)), area)
+
+    # size and position histograms
+    for i in range(4):
+        assert same_distribution(
+            Counter(box[i] for box in old_boxes), Counter(box[i] for box in new_boxes)
+        )
+
+
+def test_class_mask_distribution():
+    torch.manual_seed(0)
+    # samples with 1, 3, 4 and 5 distinct values, the ignore label included
+    values = [[7], [0, 3, 255], [1, 2, 5, 9], [0, 4, 6, 11, 255]]
+    pseudo_labels = torch.stack(
+        [torch.tensor(v * (60 // len(v))).view(6, 10) for v in values]
+    )
+
+    old = [Counter() for _ in values]
+    new = [Counter() for _ in values]
+    chunk = 500
+    for _ in range(10):
+        new_masks = generate_class_mask(pseudo_labels.repeat(chunk, 1, 1))
+        for i, label in enumerate(pseudo_labels):
+            for j in range(chunk):
+                old_mask = old_generate_class_mask(label)
+                old[i][frozenset(label[old_mask.bool()].tolist())] += 1
+                new_mask = new_masks[j * len(values) + i]
+                new[i][frozenset(label[new_mask.bool()].tolist())] += 1
+
+    for i, v in enumerate(values):
+        # always half of the present values, and only present ones
+        for subset in new[i]:
+            assert len(subset) == len(v) // 2 and subset <= set(v)
+        # frequencies of the selected class subsets
+        assert same_distribution(old[i], new[i])
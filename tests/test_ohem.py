@@ -0,0 +1,55 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from u2pl.utils.loss_helper import (  # noqa: E402
+    OhemCrossEntropy2dKth,
+    OhemCrossEntropy2dTensor,
+)
+
+NUM_CLASSES = 19
+IGNORE = 255
+
+
+def make_inputs(seed, ignore_ratio=0.3, size=(2, 33, 41)):
+    gen = torch.Generator().manual_seed(seed)
+    pred = 2 * torch.randn((size[0], NUM_CLASSES) + size[1:], generator=gen)
+    target = torch.randint(0, NUM_CLASSES, size, generator=gen)
+    target[torch.rand(size, generator=gen) < ignore_ratio] = IGNORE
+    return pred, target
+
+
+def loss_and_grad(criterion, pred, target):
+    pred = pred.clone().requires_grad_()
+    loss = criterion(pred, target)
+    loss.backward()
+    return loss, pred.grad
+
+
+@pytest.mark.parametrize(
+    "thresh, min_kept",
+    [
+        # the min_kept-th probability raises the threshold
+        (0.1, 1000),
+        # the threshold itself keeps more than min_kept pixels
+        (0.7, 100),
+        (0.7, 0),
+        # fewer valid pixels than min_kept, all of them are kept
+        (0.1, 100000),
+    ],
+)
+@pytest.mark.parametrize("use_weight", [False, True])
+def test_kth_matches_tensor(thresh, min_kept, use_weight):
+    pred, target = make_inputs(0)
+    assert min_kept != 100000 or (target != IGNORE).sum() < min_kept
+
+    reference = OhemCrossEntropy2dTensor(IGNORE, thresh, min_kept, use_weight)
+    kth = OhemCrossEntropy2dKth(IGNORE, thresh, min_kept, use_weight, stride=1)
+
+    ref_loss, ref_grad = loss_and_grad(reference, pred, target)
+    loss, grad = loss_and_grad(kth, pred, target)
+
+    # the gradient is zero outside the kept pixels
+    assert torch.equal(grad.abs().sum(1) > 0, ref_grad.abs().sum(1) > 0)
+    torch.testing.assert_close(loss, ref_loss)
+    torch.testing.assert_close(grad, ref_grad)
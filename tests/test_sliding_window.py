@@ -0,0 +1,119 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+np = pytest.importorskip("numpy")
+F = torch.nn.functional
+
+from eval import SlidingWindowEngine  # noqa: E402
+
+CLASSES = 5
+CROP = (24, 20)
+SCALES = [0.75, 1.0, 1.25]
+# heights and widths that are not multiples of the window stride, one below
+# the crop size to exercise the padding
+IMAGE_SIZES = [(37, 53), (50, 41), (17, 29), (64, 48)]
+
+
+class StubModel(torch.nn.Module):
+    """Strided conv "segmentation" model with a {"pred": logits} output."""
+
+    def __init__(self):
+        super(StubModel, self).__init__()
+        self.conv = torch.nn.Conv2d(3, CLASSES, 5, stride=2, padding=2)
+
+    def forward(self, x):
+        return {"pred": self.conv(x)}
+
+
+def old_net_process(model, image):
+    b, c, h, w = image.shape
+    output = model(image)["pred"]
+    return F.interpolate(output, (h, w), mode="bilinear", align_corners=True)
+
+
+def old_scale_crop_process(model, image, classes, crop_h, crop_w, h, w):
+    # the former per-crop loop, on the CPU
+    stride_rate = 2 / 3
+    ori_h, ori_w = image.size()[-2:]
+    pad_h = max(crop_h - ori_h, 0)
+    pad_w = max(crop_w - ori_w, 0)
+    pad_h_half = int(pad_h / 2)
+    pad_w_half = int(pad_w / 2)
+    if pad_h > 0 or pad_w > 0:
+        border = (pad_w_half, pad_w - pad_w_half, pad_h_half, pad_h - pad_h_half)
+        image = F.pad(image, border, mode="constant", value=0.0)
+    new_h, new_w = image.size()[-2:]
+    stride_h = int(np.ceil(crop_h * stride_rate))
+    stride_w = int(np.ceil(crop_w * stride_rate))
+    grid_h = int(np.ceil(float(new_h - crop_h) / stride_h) + 1)
+    grid_w = int(np.ceil(float(new_w - crop_w) / stride_w) + 1)
+    prediction_crop = torch.zeros((1, classes, new_h, new_w), dtype=torch.float)
+    count_crop = torch.zeros((new_h, new_w), dtype=torch.float)
+    for index_h in range(0, grid_h):
+        for index_w in range(0, grid_w):
+            s_h = index_h * stride_h
+            e_h = min(s_h + crop_h, new_h)
+            s_h = e_h - crop_h
+            s_w = index_w * stride_w
+            e_w = min(s_w + crop_w, new_w)
+            s_w = e_w - crop_w
+            image_crop = image[:, :, s_h:e_h, s_w:e_w].contiguous()
+            count_crop[s_h:e_h, s_w:e_w] += 1
+            prediction_crop[:, :, s_h:e_h, s_w:e_w] += old_net_process(
+                model, image_crop
+            )
+
+    prediction_crop /= count_crop
+    prediction_crop = prediction_crop[
+        :, :, pad_h_half : pad_h_half + ori_h, pad_w_half : pad_w_half + ori_w
+    ]
+    prediction = F.interpolate(
+        prediction_crop, size=(h, w), mode="bilinear", align_corners=True
+    )
+    return prediction[0]
+
+
+def scaled(image, scale):
+    # the multi-scale resize of validate_city, with base_size = the long side
+    h, w = image.shape[-2:]
+    long_size = round(scale * max(h, w))
+    if h > w:
+        size = (long_size, round(long_size / float(h) * w))
+    else:
+        size = (round(long_size / float(w) * h), long_size)
+    return F.interpolate(image, size=size, mode="bilinear", align_corners=True)
+
+
+@pytest.mark.parametrize("crop_batch", [1, 3, 8])
+@pytest.mark.parametrize("image_batch", [1, 2, 4])
+@torch.no_grad()
+def test_matches_per_crop_loop(crop_batch, image_batch):
+    torch.manual_seed(0)
+    model = StubModel().eval()
+    images = [torch.randn((1, 3) + size) for size in IMAGE_SIZES]
+
+    expected = []
+    for image in images:
+        h, w = image.shape[-2:]
+        expected.append(
+            sum(
+                old_scale_crop_process(
+                    model, scaled(image, scale), CLASSES, CROP[0], CROP[1], h, w
+                )
+                for scale in SCALES
+            )
+        )
+
+    engine = SlidingWindowEngine(model, CLASSES, CROP[0], CROP[1], crop_batch)
+    outputs = []
+    for start in range(0, len(images), image_batch):
+        batch = images[start : start + image_batch]
+        jobs = [
+            (scaled(image, scale), k, tuple(image.shape[-2:]))
+            for k, image in enumerate(batch)
+            for scale in SCALES
+        ]
+        outputs += engine.run(jobs, len(batch))
+
+    for output, reference in zip(outputs, expected):
+        torch.testing.assert_close(output, reference, rtol=1e-5, atol=1e-5)
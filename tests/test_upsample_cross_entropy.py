@@ -0,0 +1,66 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+F = torch.nn.functional
+
+from u2pl.utils.loss_helper import upsample_cross_entropy  # noqa: E402
+
+IGNORE = 255
+
+
+def make_inputs(seed, in_size=(6, 5), out_size=(23, 19), batch=2, classes=5):
+    gen = torch.Generator().manual_seed(seed)
+    logits = torch.randn((batch, classes) + in_size, generator=gen)
+    target = torch.randint(0, classes, (batch,) + out_size, generator=gen)
+    ignored = torch.rand((batch,) + out_size, generator=gen) < 0.2
+    target[ignored] = IGNORE
+    # a fully ignored band of rows
+    target[:, : out_size[0] // 3] = IGNORE
+    return logits, target
+
+
+def reference(logits, target, weight, align_corners):
+    up = F.interpolate(
+        logits, target.shape[1:], mode="bilinear", align_corners=align_corners
+    )
+    return F.cross_entropy(up, target, weight=weight, ignore_index=IGNORE)
+
+
+@pytest.mark.parametrize("align_corners", [True, False])
+@pytest.mark.parametrize("weighted", [False, True])
+@pytest.mark.parametrize("chunk_rows", [1, 7, 23])
+def test_matches_interpolate_cross_entropy(align_corners, weighted, chunk_rows):
+    logits, target = make_inputs(0)
+    weight = torch.rand(logits.shape[1]) + 0.5 if weighted else None
+
+    ref_logits = logits.clone().requires_grad_()
+    ref_loss = reference(ref_logits, target, weight, align_corners)
+    ref_loss.backward()
+
+    logits.requires_grad_()
+    loss = upsample_cross_entropy(
+        logits,
+        target,
+        weight=weight,
+        ignore_index=IGNORE,
+        align_corners=align_corners,
+        chunk_rows=chunk_rows,
+    )
+    loss.backward()
+
+    torch.testing.assert_close(loss, ref_loss, rtol=1e-5, atol=1e-6)
+    torch.testing.assert_close(logits.grad, ref_logits.grad, rtol=1e-4, atol=1e-6)
+
+
+@pytest.mark.parametrize("align_corners", [True, False])
+def test_gradcheck(align_corners):
+    logits, target = make_inputs(1, in_size=(3, 4), out_size=(9, 7), classes=3)
+    logits = logits.double().requires_grad_()
+    weight = torch.tensor([0.5, 1.0, 2.0], dtype=torch.double)
+
+    def loss_fn(x):
+        return upsample_cross_entropy(
+            x, target, weight=weight, align_corners=align_corners, chunk_rows=2
+        )
+
+    assert torch.autograd.gradcheck(loss_fn, (logits,))
@@ -16,23 +16,31 @@ import torch.nn.functional as F
 import yaml
 from tensorboardX import SummaryWriter
 
-from u2pl.dataset.augmentation import generate_unsup_data
+from u2pl.dataset.augmentation import generate_unsup_data, mix_by_mask
 from u2pl.dataset.builder import get_loader
 from u2pl.models.model_helper import ModelBuilder
-from u2pl.utils.dist_helper import setup_distributed
+from u2pl.utils.amp_helper import AMPHelper
+from u2pl.utils.ckpt_helper import CheckpointSaver, load_checkpoint
+from u2pl.utils.dist_helper import get_device, setup_distributed
+from u2pl.utils.ema_helper import build_ema_teacher
 from u2pl.utils.loss_helper import (
     compute_contra_memobank_loss,
+    compute_entropy,
+    compute_percentiles,
     compute_unsupervised_loss,
     get_criterion,
+    resize_logits,
 )
 from u2pl.utils.lr_helper import get_optimizer, get_scheduler
 from u2pl.utils.utils import (
     AverageMeter,
+    MemoryBank,
+    SegMetric,
+    downsample_label,
+    get_loss_size,
     get_rank,
     get_world_size,
     init_log,
-    intersectionAndUnion,
-    label_onehot,
     load_state,
     set_random_seed,
 )
@@ -64,6 +72,10 @@ def main():
     cudnn.benchmark = True
 
     rank, word_size = setup_distributed(port=args.port)
+    device = get_device()
+    if device.type != "cuda":
+        # SyncBatchNorm only runs on GPUs
+        cfg["net"]["sync_bn"] = False
 
     if rank == 0:
         logger.info("{}".format(pprint.pformat(cfg)))
@@ -92,9 +104,14 @@ def main():
     if cfg["net"].get("sync_bn", True):
         model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
 
-    model.cuda()
+    model.to(device)
 
-    sup_loss_fn = get_criterion(cfg)
+    sup_loss_fn = get_criterion(cfg).to(device)
+
+    cfg_unsup = cfg["trainer"].get("unsupervised", {})
+    if cfg_unsup.get("fused_teacher", False) and cfg_unsup.get("apply_aug") == "cutout":
+        # the fused pass sees the un-cut images, the cut region has no remap
+        raise ValueError("trainer.unsupervised.fused_teacher does not support cutout")
 
     train_loader_sup, train_loader_unsup, val_loader = get_loader(cfg, seed=seed)
 
@@ -116,20 +133,22 @@ def main():
     optimizer = get_optimizer(params_list, cfg_optim)
 
     local_rank = int(os.environ["LOCAL_RANK"])
+    device_ids = [local_rank] if device.type == "cuda" else None
+    output_device = local_rank if device.type == "cuda" else None
     model = torch.nn.parallel.DistributedDataParallel(
         model,
-        device_ids=[local_rank],
-        output_device=local_rank,
+        device_ids=device_ids,
+        output_device=output_device,
         find_unused_parameters=False,
     )
 
     # Teacher model
     model_teacher = ModelBuilder(cfg["net"])
-    model_teacher = model_teacher.cuda()
+    model_teacher = model_teacher.to(device)
     model_teacher = torch.nn.parallel.DistributedDataParallel(
         model_teacher,
-        device_ids=[local_rank],
-        output_device=local_rank,
+        device_ids=device_ids,
+        output_device=output_device,
         find_unused_parameters=False,
     )
 
@@ -146,16 +165,24 @@ def main():
             "No checkpoint found in '{}'".format(lastest_model)
         else:
             print(f"Resume model from: '{lastest_model}'")
+            checkpoint = load_checkpoint(lastest_model)
             best_prec, last_epoch = load_state(
-                lastest_model, model, optimizer=optimizer, key="model_state"
+                lastest_model,
+                model,
+                optimizer=optimizer,
+                key="model_state",
+                checkpoint=checkpoint,
             )
-            _, _ = load_state(
-                lastest_model, model_teacher, optimizer=optimizer, key="teacher_state"
+            load_state(
+                lastest_model, model_teacher, key="teacher_state", checkpoint=checkpoint
             )
+            del checkpoint
 
     elif cfg["saver"].get("pretrain", False):
-        load_state(cfg["saver"]["pretrain"], model, key="model_state")
-        load_state(cfg["saver"]["pretrain"], model_teacher, key="teacher_state")
+        checkpoint = load_checkpoint(cfg["saver"]["pretrain"])
+        for net, key in ((model, "model_state"), (model_teacher, "teacher_state")):
+            load_state(cfg["saver"]["pretrain"], net, key=key, checkpoint=checkpoint)
+        del checkpoint
 
     optimizer_start = get_optimizer(params_list, cfg_optim)
     lr_scheduler = get_scheduler(
@@ -163,15 +190,13 @@ def main():
     )
 
     # build class-wise memory bank
-    memobank = []
-    queue_ptrlis = []
-    queue_size = []
-    for i in range(cfg["net"]["num_classes"]):
-        memobank.append([torch.zeros(0, 256)])
-        queue_size.append(30000)
-        queue_ptrlis.append(torch.zeros(1, dtype=torch.long))
+    queue_size = [30000] * cfg["net"]["num_classes"]
     # for background class?
     queue_size[0] = 50000
+    memobank = MemoryBank(queue_size, num_feat=256, device=device)
+
+    ema_teacher = build_ema_teacher(model, model_teacher, cfg["net"])
+    amp = AMPHelper(cfg_trainer.get("amp", None), device_type=device.type)
 
     # build prototype
     prototype = torch.zeros(
@@ -181,14 +206,17 @@ def main():
             1,
             256,
         )
-    ).cuda()
+    ).to(device)
+
+    # checkpoints are written in the background while training goes on
+    saver = CheckpointSaver()
 
     # Start to train model
     for epoch in range(last_epoch, cfg_trainer["epochs"]):
         # Training
         train(
             model,
-            model_teacher,
+            ema_teacher,
             optimizer,
             lr_scheduler,
             sup_loss_fn,
@@ -198,8 +226,7 @@ def main():
             tb_logger,
             logger,
             memobank,
-            queue_ptrlis,
-            queue_size,
+            amp,
         )
 
         # Validation
@@ -208,9 +235,9 @@ def main():
                 logger.info("start evaluation")
 
             if epoch < cfg["trainer"].get("sup_only_epoch", 1):
-                prec = validate(model, val_loader, epoch, logger)
+                prec = validate(model, val_loader, epoch, logger, amp)
             else:
-                prec = validate(model_teacher, val_loader, epoch, logger)
+                prec = validate(ema_teacher, val_loader, epoch, logger, amp)
 
             if rank == 0:
                 state = {
@@ -220,18 +247,22 @@ def main():
                     "teacher_state": model_teacher.state_dict(),
                     "best_miou": best_prec,
                 }
+                links = []
                 if prec > best_prec:
                     early_stopping_cnt = 0
                     best_prec = prec
-                    torch.save(
-                        state, osp.join(cfg["saver"]["snapshot_dir"], f"ckpt_best_{best_prec * 100:0.2f}.pth")
+                    links.append(
+                        osp.join(cfg["saver"]["snapshot_dir"], f"ckpt_best_{best_prec * 100:0.2f}.pth")
                     )
                 else:
                     early_stopping_cnt += 1
                     if early_stopping_cnt > early_stopping_patience:
                         break
 
-                torch.save(state, osp.join(cfg["saver"]["snapshot_dir"], "ckpt.pth"))
+                # the best checkpoint is a link to the same file, not a second write
+                saver.save(
+                    state, osp.join(cfg["saver"]["snapshot_dir"], "ckpt.pth"), links
+                )
 
                 logger.info(
                     "\033[31m * Currently, the best val result is: {:.2f}\033[0m".format(
@@ -240,10 +271,12 @@ def main():
                 )
                 tb_logger.add_scalar("mIoU val", prec, epoch)
 
+    saver.close()
+
 
 def train(
     model,
-    model_teacher,
+    ema_teacher,
     optimizer,
     lr_scheduler,
     sup_loss_fn,
@@ -253,11 +286,17 @@ def train(
     tb_logger,
     logger,
     memobank,
-    queue_ptrlis,
-    queue_size,
+    amp,
 ):
     global prototype
     ema_decay_origin = cfg["net"]["ema_decay"]
+    device = get_device()
+    # pseudo-labels read from the store written by pseudo_label.py
+    stored_targets = bool(cfg["dataset"]["train"].get("pseudo_label", False))
+    # losses at a lower resolution than the crop, see get_loss_size
+    loss_stride = cfg["trainer"].get("loss_stride", None)
+    # rows per band of the chunked upsample + cross entropy, 0 disables it
+    chunk_rows = cfg["trainer"].get("chunked_upsample", 0)
 
     model.train()
 
@@ -290,101 +329,167 @@ def train(
 
         image_l, label_l = next(loader_l_iter)
         batch_size, h, w = label_l.size()
-        image_l, label_l = image_l.cuda(), label_l.cuda()
+        image_l, label_l = image_l.to(device), label_l.to(device)
 
-        image_u, _ = next(loader_u_iter)
-        image_u = image_u.cuda()
+        image_u, target_u = next(loader_u_iter)
+        image_u = image_u.to(device)
+        if stored_targets:
+            target_u = target_u.to(device)
 
         # only for Pascal
         if epoch < cfg["trainer"].get("sup_only_epoch", 1):
             contra_flag = "none"
-            # forward
-            outs = model(image_l)
-            pred, rep = outs["pred"], outs["rep"]
-            pred = F.interpolate(pred, (h, w), mode="bilinear", align_corners=True)
-
-            # supervised loss
-            if "aux_loss" in cfg["net"].keys():
-                aux = outs["aux"]
-                aux = F.interpolate(aux, (h, w), mode="bilinear", align_corners=True)
-                sup_loss = sup_loss_fn([pred, aux], label_l)
-            else:
-                sup_loss = sup_loss_fn(pred, label_l)
+            with amp.autocast():
+                # forward
+                outs = model(image_l)
+                pred, rep = outs["pred"], outs["rep"]
+                loss_h, loss_w = get_loss_size(loss_stride, (h, w), pred.shape[2:])
+                label_l = downsample_label(label_l, (loss_h, loss_w))
+                pred = resize_logits(pred, (loss_h, loss_w), chunk_rows)
+
+                # supervised loss
+                if "aux_loss" in cfg["net"].keys():
+                    aux = resize_logits(outs["aux"], (loss_h, loss_w), chunk_rows)
+                    sup_loss = sup_loss_fn([pred, aux], label_l)
+                else:
+                    sup_loss = sup_loss_fn(pred, label_l)
 
-            model_teacher.train()
-            _ = model_teacher(image_l)
+            ema_teacher.train()
+            with amp.autocast():
+                _ = ema_teacher(image_l)
 
             unsup_loss = 0 * rep.sum()
             contra_loss = 0 * rep.sum()
         else:
             if epoch == cfg["trainer"].get("sup_only_epoch", 1):
                 # copy student parameters to teacher
-                with torch.no_grad():
-                    for t_params, s_params in zip(
-                        model_teacher.parameters(), model.parameters()
-                    ):
-                        t_params.data = s_params.data
+                ema_teacher.copy_()
 
             # generate pseudo labels first
-            model_teacher.eval()
-            pred_u_teacher = model_teacher(image_u)["pred"]
-            pred_u_teacher = F.interpolate(
-                pred_u_teacher, (h, w), mode="bilinear", align_corners=True
-            )
-            pred_u_teacher = F.softmax(pred_u_teacher, dim=1)
-            logits_u_aug, label_u_aug = torch.max(pred_u_teacher, dim=1)
+            num_labeled = len(image_l)
+            fused_teacher = cfg["trainer"]["unsupervised"].get("fused_teacher", False)
+            fused_teacher = fused_teacher and not stored_targets
+            if stored_targets:
+                label_u_aug = target_u[:, 0].long()
+                logits_u_aug = target_u[:, 1]
+                entropy_u = target_u[:, 2]
+            elif fused_teacher:
+                # a single teacher pass over the labeled and the un-augmented
+                # unlabeled images, fused_teacher_bn picks the BN mode used for it
+                if (
+                    cfg["trainer"]["unsupervised"].get("fused_teacher_bn", "train")
+                    == "eval"
+                ):
+                    ema_teacher.eval()
+                else:
+                    ema_teacher.train()
+                with torch.no_grad(), amp.autocast():
+                    out_t = ema_teacher(torch.cat((image_l, image_u)))
+                out_t = {key: out_t[key].float() for key in ("pred", "rep")}
+                pred_u_teacher = out_t["pred"][num_labeled:]
+            else:
+                ema_teacher.eval()
+                with amp.autocast():
+                    pred_u_teacher = ema_teacher(image_u)["pred"].float()
+            if not stored_targets:
+                pred_u_teacher = F.interpolate(
+                    pred_u_teacher, (h, w), mode="bilinear", align_corners=True
+                )
+                pred_u_large_teacher = pred_u_teacher
+                pred_u_teacher = F.softmax(pred_u_teacher, dim=1)
+                logits_u_aug, label_u_aug = torch.max(pred_u_teacher, dim=1)
 
             # apply strong data augmentation: cutout, cutmix, or classmix
+            mix_mask = None
             if np.random.uniform(0, 1) < 0.5 and cfg["trainer"]["unsupervised"].get(
                 "apply_aug", False
             ):
-                image_u_aug, label_u_aug, logits_u_aug = generate_unsup_data(
+                image_u_aug, label_u_aug, logits_u_aug, mix_mask = generate_unsup_data(
                     image_u,
                     label_u_aug.clone(),
                     logits_u_aug.clone(),
                     mode=cfg["trainer"]["unsupervised"]["apply_aug"],
+                    return_mask=True,
                 )
             else:
                 image_u_aug = image_u
+            if stored_targets:
+                entropy_u = mix_by_mask(entropy_u, mix_mask)
 
             # forward
-            num_labeled = len(image_l)
             image_all = torch.cat((image_l, image_u_aug))
-            outs = model(image_all)
-
-            # Prediction & Representation
-            pred_all, rep_all = outs["pred"], outs["rep"]
-            pred_l, pred_u = pred_all[:num_labeled], pred_all[num_labeled:]
-            pred_l_large = F.interpolate(
-                pred_l, size=(h, w), mode="bilinear", align_corners=True
-            )
-            pred_u_large = F.interpolate(
-                pred_u, size=(h, w), mode="bilinear", align_corners=True
-            )
-
-            # supervised loss
-            if "aux_loss" in cfg["net"].keys():
-                aux = outs["aux"][:num_labeled]
-                aux = F.interpolate(aux, (h, w), mode="bilinear", align_corners=True)
-                sup_loss = sup_loss_fn([pred_l_large, aux], label_l.clone())
-            else:
-                sup_loss = sup_loss_fn(pred_l_large, label_l.clone())
+            with amp.autocast():
+                outs = model(image_all)
+
+                # Prediction & Representation
+                pred_all, rep_all = outs["pred"], outs["rep"]
+                pred_l, pred_u = pred_all[:num_labeled], pred_all[num_labeled:]
+                loss_h, loss_w = get_loss_size(loss_stride, (h, w), pred_all.shape[2:])
+                pred_l_large = resize_logits(pred_l, (loss_h, loss_w), chunk_rows)
+                pred_u_large = resize_logits(pred_u, (loss_h, loss_w), chunk_rows)
+
+                # labels and pseudo-labels follow the loss resolution
+                label_l = downsample_label(label_l, (loss_h, loss_w))
+                label_u_aug = downsample_label(label_u_aug, (loss_h, loss_w))
+                logits_u_aug = downsample_label(logits_u_aug, (loss_h, loss_w))
+                if stored_targets:
+                    entropy_u = downsample_label(entropy_u, (loss_h, loss_w))
+
+                # supervised loss
+                if "aux_loss" in cfg["net"].keys():
+                    aux = outs["aux"][:num_labeled]
+                    aux = resize_logits(aux, (loss_h, loss_w), chunk_rows)
+                    sup_loss = sup_loss_fn([pred_l_large, aux], label_l.clone())
+                else:
+                    sup_loss = sup_loss_fn(pred_l_large, label_l.clone())
 
-            # teacher forward
-            model_teacher.train()
+            # teacher forward, with stored pseudo-labels only the contrastive
+            # loss still needs it
+            contrastive = cfg["trainer"].get("contrastive", False)
             with torch.no_grad():
-                out_t = model_teacher(image_all)
-                pred_all_teacher, rep_all_teacher = out_t["pred"], out_t["rep"]
-                prob_all_teacher = F.softmax(pred_all_teacher, dim=1)
-                prob_l_teacher, prob_u_teacher = (
-                    prob_all_teacher[:num_labeled],
-                    prob_all_teacher[num_labeled:],
-                )
+                if stored_targets and not contrastive:
+                    pass
+                elif fused_teacher:
+                    # remap the pseudo-labeling pass through the mixing mask
+                    out_t = {
+                        key: torch.cat(
+                            (
+                                out_t[key][:num_labeled],
+                                mix_by_mask(out_t[key][num_labeled:], mix_mask),
+                            )
+                        )
+                        for key in ("pred", "rep")
+                    }
+                else:
+                    ema_teacher.train()
+                    with amp.autocast():
+                        out_t = ema_teacher(image_all)
+                    out_t = {key: out_t[key].float() for key in ("pred", "rep")}
+                if contrastive:
+                    pred_all_teacher, rep_all_teacher = out_t["pred"], out_t["rep"]
+                    prob_all_teacher = F.softmax(pred_all_teacher, dim=1)
+                    prob_l_teacher, prob_u_teacher = (
+                        prob_all_teacher[:num_labeled],
+                        prob_all_teacher[num_labeled:],
+                    )
 
-                pred_u_teacher = pred_all_teacher[num_labeled:]
-                pred_u_large_teacher = F.interpolate(
-                    pred_u_teacher, size=(h, w), mode="bilinear", align_corners=True
-                )
+                if stored_targets:
+                    pred_u_large_teacher = None
+                elif fused_teacher:
+                    pred_u_large_teacher = F.interpolate(
+                        mix_by_mask(pred_u_large_teacher, mix_mask),
+                        size=(loss_h, loss_w),
+                        mode="bilinear",
+                        align_corners=True,
+                    )
+                else:
+                    pred_u_teacher = out_t["pred"][num_labeled:]
+                    pred_u_large_teacher = F.interpolate(
+                        pred_u_teacher,
+                        size=(loss_h, loss_w),
+                        mode="bilinear",
+                        align_corners=True,
+                    )
 
             # unsupervised loss
             drop_percent = cfg["trainer"]["unsupervised"].get("drop_percent", 100)
@@ -392,87 +497,70 @@ def train(
                 1 - epoch / cfg["trainer"]["epochs"]
             )
             drop_percent = 100 - percent_unreliable
+
+            # entropy and every percentile threshold of this step in one pass
+            percents = [drop_percent]
+            if cfg["trainer"].get("contrastive", False):
+                alpha_t = cfg["trainer"]["contrastive"]["low_entropy_threshold"] * (
+                    1 - epoch / cfg["trainer"]["epochs"]
+                )
+                percents += [alpha_t, 100 - alpha_t]
+            with torch.no_grad():
+                if stored_targets:
+                    entropy = entropy_u
+                else:
+                    entropy = compute_entropy(
+                        torch.softmax(pred_u_large_teacher, dim=1)
+                    )
+                thresh = compute_percentiles(
+                    entropy,
+                    label_u_aug != 255,
+                    percents,
+                    mode=cfg["trainer"]["unsupervised"].get("percentile_mode", "exact"),
+                    bins=cfg["trainer"]["unsupervised"].get("percentile_bins", 1000),
+                )
+
             unsup_loss = compute_unsupervised_loss(
                 pred_u_large,
                 label_u_aug.clone(),
                 drop_percent,
-                pred_u_large_teacher.detach(),
+                pred_u_large_teacher,
+                entropy=entropy,
+                thresh=thresh[0],
+                chunk_rows=chunk_rows or 64,
             ) * cfg["trainer"]["unsupervised"].get("loss_weight", 1)
 
             # contrastive loss using unreliable pseudo labels
             # contra_flag = "none"
-            if cfg["trainer"].get("contrastive", False):
+            if contrastive:
                 cfg_contra = cfg["trainer"]["contrastive"]
                 contra_flag = f"{cfg_contra['low_rank']}:{cfg_contra['high_rank']}"
-                alpha_t = cfg_contra["low_entropy_threshold"] * (
-                    1 - epoch / cfg["trainer"]["epochs"]
-                )
 
                 with torch.no_grad():
-                    prob = torch.softmax(pred_u_large_teacher, dim=1)
-                    entropy = -torch.sum(prob * torch.log(prob + 1e-10), dim=1)
-
-                    low_thresh = np.percentile(
-                        entropy[label_u_aug != 255].cpu().numpy().flatten(), alpha_t
-                    )
-                    low_entropy_mask = (
-                        entropy.le(low_thresh).float() * (label_u_aug != 255).bool()
+                    low_thresh, high_thresh = thresh[1], thresh[2]
+                    valid_l, valid_u = label_l != 255, label_u_aug != 255
+                    low_entropy_mask = entropy.le(low_thresh) & valid_u
+                    high_entropy_mask = entropy.ge(high_thresh) & valid_u
+
+                    # labels and masks are picked at the feature resolution,
+                    # the same pixels a nearest interpolation would keep
+                    feat_size = pred_all.shape[2:]
+                    low_mask_all = downsample_label(
+                        torch.cat((valid_l, low_entropy_mask)), feat_size
                     )
 
-                    high_thresh = np.percentile(
-                        entropy[label_u_aug != 255].cpu().numpy().flatten(),
-                        100 - alpha_t,
-                    )
-                    high_entropy_mask = (
-                        entropy.ge(high_thresh).float() * (label_u_aug != 255).bool()
-                    )
-
-                    low_mask_all = torch.cat(
-                        (
-                            (label_l.unsqueeze(1) != 255).float(),
-                            low_entropy_mask.unsqueeze(1),
-                        )
-                    )
-
-                    low_mask_all = F.interpolate(
-                        low_mask_all, size=pred_all.shape[2:], mode="nearest"
-                    )
-                    # down sample
-
                     if cfg_contra.get("negative_high_entropy", True):
                         contra_flag += " high"
-                        high_mask_all = torch.cat(
-                            (
-                                (label_l.unsqueeze(1) != 255).float(),
-                                high_entropy_mask.unsqueeze(1),
-                            )
-                        )
+                        high_mask_all = torch.cat((valid_l, high_entropy_mask))
                     else:
                         contra_flag += " low"
                         high_mask_all = torch.cat(
-                            (
-                                (label_l.unsqueeze(1) != 255).float(),
-                                torch.ones(logits_u_aug.shape)
-                                .float()
-                                .unsqueeze(1)
-                                .cuda(),
-                            ),
+                            (valid_l, torch.ones_like(high_entropy_mask))
                         )
-                    high_mask_all = F.interpolate(
-                        high_mask_all, size=pred_all.shape[2:], mode="nearest"
-                    )  # down sample
-
-                    # down sample and concat
-                    label_l_small = F.interpolate(
-                        label_onehot(label_l, cfg["net"]["num_classes"]),
-                        size=pred_all.shape[2:],
-                        mode="nearest",
-                    )
-                    label_u_small = F.interpolate(
-                        label_onehot(label_u_aug, cfg["net"]["num_classes"]),
-                        size=pred_all.shape[2:],
-                        mode="nearest",
-                    )
+                    high_mask_all = downsample_label(high_mask_all, feat_size)
+
+                    label_l_small = downsample_label(label_l, feat_size)
+                    label_u_small = downsample_label(label_u_aug, feat_size)
                 #
                 # if cfg_contra.get("binary", False):
                 #     contra_flag += " BCE"
@@ -484,24 +572,20 @@ def train(
                 #         prob_all_teacher.detach(),
                 #         cfg_contra,
                 #         memobank,
-                #         queue_ptrlis,
-                #         queue_size,
                 #         rep_all_teacher.detach(),
                 #     )
                 # else:
                 #    if not cfg_contra.get("anchor_ema", False):
                 new_keys, contra_loss = compute_contra_memobank_loss(
                     rep_all,
-                    label_l_small.long(),
-                    label_u_small.long(),
+                    label_l_small,
+                    label_u_small,
                     prob_l_teacher.detach(),
                     prob_u_teacher.detach(),
                     low_mask_all,
                     high_mask_all,
                     cfg_contra,
                     memobank,
-                    queue_ptrlis,
-                    queue_size,
                     rep_all_teacher.detach(),
                 )
                 #    else:
@@ -515,8 +599,6 @@ def train(
                 #            high_mask_all,
                 #            cfg_contra,
                 #            memobank,
-                #            queue_ptrlis,
-                #            queue_size,
                 #            rep_all_teacher.detach(),
                 #            prototype,
                 #        )
@@ -533,29 +615,19 @@ def train(
 
         loss = sup_loss + unsup_loss + contra_loss
 
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        amp.step(loss, optimizer)
 
         # update teacher model with EMA
         if epoch >= cfg["trainer"].get("sup_only_epoch", 1):
-            with torch.no_grad():
-                ema_decay = min(
-                    1
-                    - 1
-                    / (
-                        i_iter
-                        - len(loader_l) * cfg["trainer"].get("sup_only_epoch", 1)
-                        + 1
-                    ),
-                    ema_decay_origin,
-                )
-                for t_params, s_params in zip(
-                    model_teacher.parameters(), model.parameters()
-                ):
-                    t_params.data = (
-                        ema_decay * t_params.data + (1 - ema_decay) * s_params.data
-                    )
+            ema_decay = min(
+                1
+                - 1
+                / (
+                    i_iter - len(loader_l) * cfg["trainer"].get("sup_only_epoch", 1) + 1
+                ),
+                ema_decay_origin,
+            )
+            ema_teacher.update(ema_decay)
 
         # gather all loss from different gpus
         reduced_sup_loss = sup_loss.clone().detach()
@@ -607,9 +679,11 @@ def validate(
     data_loader,
     epoch,
     logger,
+    amp,
 ):
     model.eval()
     data_loader.sampler.set_epoch(epoch)
+    device = get_device()
 
     num_classes, ignore_label = (
         cfg["net"]["num_classes"],
@@ -617,15 +691,14 @@ def validate(
     )
     rank, world_size = dist.get_rank(), dist.get_world_size()
 
-    intersection_meter = AverageMeter()
-    union_meter = AverageMeter()
+    metric = SegMetric(num_classes, ignore_label, device=device)
 
     for step, batch in enumerate(data_loader):
         images, labels = batch
-        images = images.cuda()
-        labels = labels.long().cuda()
+        images = images.to(device)
+        labels = labels.long().to(device)
 
-        with torch.no_grad():
+        with torch.no_grad(), amp.autocast():
             outs = model(images)
 
         # get the output produced by model_teacher
@@ -633,33 +706,25 @@ def validate(
         output = F.interpolate(
             output, labels.shape[1:], mode="bilinear", align_corners=True
         )
-        output = output.data.max(1)[1].cpu().numpy()
-        target_origin = labels.cpu().numpy()
-
-        # start to calculate miou
-        intersection, union, target = intersectionAndUnion(
-            output, target_origin, num_classes, ignore_label
-        )
+        output = output.data.max(1)[1]
 
-        # gather all validation information
-        reduced_intersection = torch.from_numpy(intersection).cuda()
-        reduced_union = torch.from_numpy(union).cuda()
-        reduced_target = torch.from_numpy(target).cuda()
+        # accumulate the confusion matrix on device
+        metric.update(output, labels)
 
-        dist.all_reduce(reduced_intersection)
-        dist.all_reduce(reduced_union)
-        dist.all_reduce(reduced_target)
-
-        intersection_meter.update(reduced_intersection.cpu().numpy())
-        union_meter.update(reduced_union.cpu().numpy())
-
-    iou_class = intersection_meter.sum / (union_meter.sum + 1e-10)
+    # gather all validation information
+    metric.all_reduce()
+    iou_class = metric.iou().cpu().numpy()
     mIoU = np.mean(iou_class)
 
     if rank == 0:
         for i, iou in enumerate(iou_class):
             logger.info(" * class [{}] IoU {:.2f}".format(i, iou * 100))
         logger.info(" * epoch {} mIoU {:.2f}".format(epoch, mIoU * 100))
+        logger.info(
+            " * epoch {} aAcc {:.2f} fwIoU {:.2f}".format(
+                epoch, metric.accuracy().item() * 100, metric.fwiou().item() * 100
+            )
+        )
 
     return mIoU
 
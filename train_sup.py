@@ -17,15 +17,19 @@ from tensorboardX import SummaryWriter
 
 from u2pl.dataset.builder import get_loader
 from u2pl.models.model_helper import ModelBuilder
-from u2pl.utils.dist_helper import setup_distributed
-from u2pl.utils.loss_helper import get_criterion
+from u2pl.utils.amp_helper import AMPHelper
+from u2pl.utils.ckpt_helper import CheckpointSaver
+from u2pl.utils.dist_helper import get_device, setup_distributed
+from u2pl.utils.loss_helper import get_criterion, resize_logits
 from u2pl.utils.lr_helper import get_optimizer, get_scheduler
 from u2pl.utils.utils import (
     AverageMeter,
+    SegMetric,
+    downsample_label,
+    get_loss_size,
     get_rank,
     get_world_size,
     init_log,
-    intersectionAndUnion,
     load_state,
     set_random_seed,
 )
@@ -52,6 +56,10 @@ def main():
     cudnn.benchmark = True
 
     rank, word_size = setup_distributed(port=args.port)
+    device = get_device()
+    if device.type != "cuda":
+        # SyncBatchNorm only runs on GPUs
+        cfg["net"]["sync_bn"] = False
 
     if rank == 0:
         logger.info("{}".format(pprint.pformat(cfg)))
@@ -80,17 +88,19 @@ def main():
     if cfg["net"].get("sync_bn", True):
         model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
 
-    model.cuda()
+    model.to(device)
 
     local_rank = int(os.environ["LOCAL_RANK"])
+    device_ids = [local_rank] if device.type == "cuda" else None
+    output_device = local_rank if device.type == "cuda" else None
     model = torch.nn.parallel.DistributedDataParallel(
         model,
-        device_ids=[local_rank],
-        output_device=local_rank,
+        device_ids=device_ids,
+        output_device=output_device,
         find_unused_parameters=False,
     )
 
-    criterion = get_criterion(cfg)
+    criterion = get_criterion(cfg).to(device)
 
     train_loader_sup, val_loader = get_loader(cfg, seed=seed)
 
@@ -134,6 +144,9 @@ def main():
     )
 
     # Start to train model
+    amp = AMPHelper(cfg_trainer.get("amp", None), device_type=device.type)
+    saver = CheckpointSaver()
+
     for epoch in range(last_epoch, cfg_trainer["epochs"]):
         # Training
         train(
@@ -144,10 +157,11 @@ def main():
             train_loader_sup,
             epoch,
             tb_logger,
+            amp,
         )
 
         # Validation and store checkpoint
-        prec = validate(model, val_loader, epoch)
+        prec = validate(model, val_loader, epoch, amp)
 
         if rank == 0:
             state = {
@@ -157,14 +171,14 @@ def main():
                 "best_miou": best_prec,
             }
 
+            links = []
             if prec > best_prec:
                 best_prec = prec
                 state["best_miou"] = prec
-                torch.save(
-                    state, osp.join(cfg["saver"]["snapshot_dir"], "ckpt_best.pth")
-                )
+                links.append(osp.join(cfg["saver"]["snapshot_dir"], "ckpt_best.pth"))
 
-            torch.save(state, osp.join(cfg["saver"]["snapshot_dir"], "ckpt.pth"))
+            # the best checkpoint is a link to the same file, not a second write
+            saver.save(state, osp.join(cfg["saver"]["snapshot_dir"], "ckpt.pth"), links)
 
             logger.info(
                 "\033[31m * Currently, the best val result is: {:.2f}\033[0m".format(
@@ -173,6 +187,8 @@ def main():
             )
             tb_logger.add_scalar("mIoU val", prec, epoch)
 
+    saver.close()
+
 
 def train(
     model,
@@ -182,11 +198,13 @@ def train(
     data_loader,
     epoch,
     tb_logger,
+    amp,
 ):
     model.train()
 
     data_loader.sampler.set_epoch(epoch)
     data_loader_iter = iter(data_loader)
+    device = get_device()
 
     rank, world_size = dist.get_rank(), dist.get_world_size()
 
@@ -195,6 +213,9 @@ def train(
     batch_times = AverageMeter(10)
     learning_rates = AverageMeter(10)
 
+    loss_stride = cfg["trainer"].get("loss_stride", None)
+    chunk_rows = cfg["trainer"].get("chunked_upsample", 0)
+
     batch_end = time.time()
     for step in range(len(data_loader)):
         batch_start = time.time()
@@ -207,21 +228,21 @@ def train(
 
         image, label = next(data_loader_iter)
         batch_size, h, w = label.size()
-        image, label = image.cuda(), label.cuda()
-        outs = model(image)
-        pred = outs["pred"]
-        pred = F.interpolate(pred, (h, w), mode="bilinear", align_corners=True)
-
-        if "aux_loss" in cfg["net"].keys():
-            aux = outs["aux"]
-            aux = F.interpolate(aux, (h, w), mode="bilinear", align_corners=True)
-            loss = criterion([pred, aux], label)
-        else:
-            loss = criterion(pred, label)
-
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        image, label = image.to(device), label.to(device)
+        with amp.autocast():
+            outs = model(image)
+            pred = outs["pred"]
+            loss_size = get_loss_size(loss_stride, (h, w), pred.shape[2:])
+            label = downsample_label(label, loss_size)
+            pred = resize_logits(pred, loss_size, chunk_rows)
+
+            if "aux_loss" in cfg["net"].keys():
+                aux = resize_logits(outs["aux"], loss_size, chunk_rows)
+                loss = criterion([pred, aux], label)
+            else:
+                loss = criterion(pred, label)
+
+        amp.step(loss, optimizer)
 
         # gather all loss from different gpus
         reduced_loss = loss.clone().detach()
@@ -255,9 +276,11 @@ def validate(
     model,
     data_loader,
     epoch,
+    amp,
 ):
     model.eval()
     data_loader.sampler.set_epoch(epoch)
+    device = get_device()
 
     num_classes, ignore_label = (
         cfg["net"]["num_classes"],
@@ -265,48 +288,39 @@ def validate(
     )
     rank, world_size = dist.get_rank(), dist.get_world_size()
 
-    intersection_meter = AverageMeter()
-    union_meter = AverageMeter()
+    metric = SegMetric(num_classes, ignore_label, device=device)
 
     for step, batch in enumerate(data_loader):
         images, labels = batch
-        images = images.cuda()
-        labels = labels.long().cuda()
+        images = images.to(device)
+        labels = labels.long().to(device)
         batch_size, h, w = labels.shape
 
-        with torch.no_grad():
+        with torch.no_grad(), amp.autocast():
             outs = model(images)
 
         # get the output produced by model_teacher
         output = outs["pred"]
         output = F.interpolate(output, (h, w), mode="bilinear", align_corners=True)
-        output = output.data.max(1)[1].cpu().numpy()
-        target_origin = labels.cpu().numpy()
+        output = output.data.max(1)[1]
 
-        # start to calculate miou
-        intersection, union, target = intersectionAndUnion(
-            output, target_origin, num_classes, ignore_label
-        )
-
-        # gather all validation information
-        reduced_intersection = torch.from_numpy(intersection).cuda()
-        reduced_union = torch.from_numpy(union).cuda()
-        reduced_target = torch.from_numpy(target).cuda()
-
-        dist.all_reduce(reduced_intersection)
-        dist.all_reduce(reduced_union)
-        dist.all_reduce(reduced_target)
+        # accumulate the confusion matrix on device
+        metric.update(output, labels)
 
-        intersection_meter.update(reduced_intersection.cpu().numpy())
-        union_meter.update(reduced_union.cpu().numpy())
-
-    iou_class = intersection_meter.sum / (union_meter.sum + 1e-10)
+    # gather all validation information
+    metric.all_reduce()
+    iou_class = metric.iou().cpu().numpy()
     mIoU = np.mean(iou_class)
 
     if rank == 0:
         for i, iou in enumerate(iou_class):
             logger.info(" * class [{}] IoU {:.2f}".format(i, iou * 100))
         logger.info(" * epoch {} mIoU {:.2f}".format(epoch, mIoU * 100))
+        logger.info(
+            " * epoch {} aAcc {:.2f} fwIoU {:.2f}".format(
+                epoch, metric.accuracy().item() * 100, metric.fwiou().item() * 100
+            )
+        )
 
     return mIoU
 
@@ -11,6 +11,8 @@ from scipy.ndimage import gaussian_filter
 from torch import nn
 from torch.nn import functional as F
 
+from ..utils.dist_helper import get_device
+
 
 class Compose(object):
     """
@@ -70,17 +72,22 @@ class ToTensor(object):
             )
         if len(image.shape) == 2:
             image = np.expand_dims(image, axis=2)
-        if not len(label.shape) == 2:
+        if not len(label.shape) in [2, 3]:
             raise (
                 RuntimeError(
-                    "segtransforms.ToTensor() only handle np.ndarray labellabel with 2 dims.\n"
+                    "segtransforms.ToTensor() only handle np.ndarray labellabel with 2 dims"
+                    " (or 3 for stacked label planes).\n"
                 )
             )
 
         image = torch.from_numpy(image.transpose((2, 0, 1))[np.newaxis])
         if not isinstance(image, torch.FloatTensor):
             image = image.float()
-        label = torch.from_numpy(label[np.newaxis, np.newaxis])
+        if len(label.shape) == 3:
+            # H x W x K planes, e.g. pseudo-labels with confidence and entropy
+            label = torch.from_numpy(label.transpose((2, 0, 1))[np.newaxis].copy())
+        else:
+            label = torch.from_numpy(label[np.newaxis, np.newaxis])
         if not isinstance(label, torch.FloatTensor):
             label = label.float()
         return image, label
@@ -468,74 +475,315 @@ class Cutmix(object):
         return img, label, masks
 
 
-def generate_cutout_mask(img_size, ratio=2):
+class ToTensorRaw(object):
+    """Keep image & label as uint8 tensors (1 x C x H x W), used with BatchAugment."""
+
+    def __call__(self, image, label):
+        image = torch.from_numpy(np.ascontiguousarray(np.asarray(image)))
+        label = torch.from_numpy(np.ascontiguousarray(np.asarray(label)))
+        return image.permute(2, 0, 1).unsqueeze(0), label[None, None]
+
+
+def pad_collate(batch):
+    """Stack raw samples of different sizes into zero padded uint8/long batches."""
+    max_h = max(image.shape[1] for image, _ in batch)
+    max_w = max(image.shape[2] for image, _ in batch)
+    images = torch.zeros((len(batch), 3, max_h, max_w), dtype=torch.uint8)
+    labels = torch.zeros((len(batch), max_h, max_w), dtype=torch.long)
+    sizes = torch.zeros((len(batch), 2), dtype=torch.long)
+    for i, (image, label) in enumerate(batch):
+        h, w = image.shape[1:]
+        images[i, :, :h, :w] = image
+        labels[i, :h, :w] = label
+        sizes[i, 0], sizes[i, 1] = h, w
+    return images, labels, sizes
+
+
+class BatchAugment(object):
+    """
+    Batched counterpart of the Normalize, Resize, RandResize, RandRotate,
+    RandomGaussianBlur, RandomHorizontalFlip and Crop pipeline.
+
+    The random parameters are drawn per sample exactly like the per-sample
+    transforms do, composed into one affine map per sample and applied with a
+    single affine_grid + grid_sample (nearest for labels). Pixels that fall
+    outside the source image get 0 in the normalized image. In the label they
+    get ``ignore_label`` when rotated out, like RandRotate, and 0 when they are
+    crop padding, like Crop.
+    """
+
+    def __init__(
+        self,
+        mean,
+        std,
+        crop_size,
+        crop_type="rand",
+        resize=None,
+        rand_resize=None,
+        rand_rotation=None,
+        blur=False,
+        flip=False,
+        ignore_label=255,
+    ):
+        self.mean = torch.tensor(mean, dtype=torch.float).view(1, -1, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float).view(1, -1, 1, 1)
+        self.crop_h, self.crop_w = crop_size
+        self.crop_type = crop_type
+        self.resize = resize
+        self.rand_resize = rand_resize
+        self.rand_rotation = rand_rotation
+        self.blur = GaussianBlur(radius=2) if blur else None
+        self.flip = flip
+        self.ignore_label = ignore_label
+
+    def _sample_theta(self, h0, w0, max_h, max_w):
+        """Affine map from crop coordinates to the padded source, plus crop offsets."""
+        h, w = (h0, w0) if self.resize is None else self.resize
+        if self.rand_resize is not None:
+            if random.random() < 0.5:
+                scale = (
+                    self.rand_resize[0] + (1.0 - self.rand_resize[0]) * random.random()
+                )
+            else:
+                scale = 1.0 + (self.rand_resize[1] - 1.0) * random.random()
+            h, w = int(h * scale), int(w * scale)
+
+        rotate = np.eye(3)
+        if self.rand_rotation is not None:
+            angle = (
+                self.rand_rotation[0]
+                + (self.rand_rotation[1] - self.rand_rotation[0]) * random.random()
+            )
+            rotate[:2] = cv2.getRotationMatrix2D((0, 0), angle, 1)
+
+        flip = np.eye(3)
+        if self.flip and random.random() < 0.5:
+            flip[0, 0] = -1
+
+        pad_h, pad_w = max(self.crop_h - h, 0), max(self.crop_w - w, 0)
+        if self.crop_type == "rand":
+            h_off = random.randint(0, h + pad_h - self.crop_h)
+            w_off = random.randint(0, w + pad_w - self.crop_w)
+        else:
+            h_off = (h + pad_h - self.crop_h) // 2
+            w_off = (w + pad_w - self.crop_w) // 2
+        off_y, off_x = h_off - pad_h // 2, w_off - pad_w // 2
+
+        # crop normalized -> crop pixel -> resized pixel -> resized normalized
+        to_pixel = np.array(
+            [
+                [self.crop_w / 2, 0, self.crop_w / 2 - 0.5 + off_x],
+                [0, self.crop_h / 2, self.crop_h / 2 - 0.5 + off_y],
+                [0, 0, 1],
+            ]
+        )
+        to_norm = np.array([[2 / w, 0, 1 / w - 1], [0, 2 / h, 1 / h - 1], [0, 0, 1]])
+        # source normalized -> padded batch normalized
+        to_batch = np.array(
+            [
+                [w0 / max_w, 0, w0 / max_w - 1],
+                [0, h0 / max_h, h0 / max_h - 1],
+                [0, 0, 1],
+            ]
+        )
+        theta = to_batch @ rotate @ flip @ to_norm @ to_pixel
+        return theta[:2], (off_y, off_x, h, w)
+
+    def __call__(self, image, label, sizes):
+        batch_size, _, max_h, max_w = image.shape
+        device = image.device
+
+        thetas, boxes = [], []
+        for h0, w0 in sizes.tolist():
+            theta, box = self._sample_theta(h0, w0, max_h, max_w)
+            thetas.append(theta)
+            boxes.append(box)
+        theta = torch.tensor(np.stack(thetas), dtype=torch.float, device=device)
+        boxes = torch.tensor(boxes, dtype=torch.long, device=device)
+        sizes = sizes.to(device)
+
+        # zero the batch padding after normalization, like out-of-image pixels
+        rows = torch.arange(max_h, device=device).view(1, -1, 1)
+        cols = torch.arange(max_w, device=device).view(1, 1, -1)
+        inside = (rows < sizes[:, 0].view(-1, 1, 1)) & (
+            cols < sizes[:, 1].view(-1, 1, 1)
+        )
+        image = (image.float() - self.mean.to(device)) / self.std.to(device)
+        image = image * inside.unsqueeze(1)
+        label = (label.float() + 1) * inside
+
+        grid = F.affine_grid(
+            theta,
+            (batch_size, 1, self.crop_h, self.crop_w),
+            align_corners=False,
+        )
+        image = F.grid_sample(image, grid, mode="bilinear", align_corners=False)
+        label = F.grid_sample(
+            label.unsqueeze(1), grid, mode="nearest", align_corners=False
+        ).squeeze(1)
+        label = label.long() - 1
+        label[label < 0] = self.ignore_label
+
+        # crop padding
+        rows = torch.arange(self.crop_h, device=device).view(1, -1, 1)
+        cols = torch.arange(self.crop_w, device=device).view(1, 1, -1)
+        rows = rows + boxes[:, 0].view(-1, 1, 1)
+        cols = cols + boxes[:, 1].view(-1, 1, 1)
+        valid = (
+            (rows >= 0)
+            & (rows < boxes[:, 2].view(-1, 1, 1))
+            & (cols >= 0)
+            & (cols < boxes[:, 3].view(-1, 1, 1))
+        )
+
+        if self.blur is not None:
+            self.blur = self.blur.to(device)
+            apply = torch.tensor(
+                [random.random() < 0.5 for _ in range(batch_size)], device=device
+            ).view(-1, 1, 1, 1)
+            with torch.no_grad():
+                image = torch.where(apply, self.blur(image), image)
+
+        image = image * valid.unsqueeze(1)
+        label[~valid] = 0
+        return image, label
+
+
+def build_batch_augment(cfg):
+    assert cfg.get("crop", False), "batch_aug needs a crop size"
+    return BatchAugment(
+        cfg["mean"],
+        cfg["std"],
+        cfg["crop"]["size"],
+        crop_type=cfg["crop"]["type"],
+        resize=cfg.get("resize", None),
+        rand_resize=cfg.get("rand_resize", None),
+        rand_rotation=cfg.get("rand_rotation", None),
+        blur=cfg.get("GaussianBlur", False),
+        flip=cfg.get("flip", False),
+        ignore_label=cfg["ignore_label"],
+    )
+
+
+class BatchAugLoader(object):
+    """DataLoader wrapper that runs BatchAugment on the training device."""
+
+    def __init__(self, loader, augment):
+        self.loader = loader
+        self.augment = augment
+        self.sampler = loader.sampler
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        device = get_device()
+        for image, label, sizes in self.loader:
+            yield self.augment(
+                image.to(device, non_blocking=True),
+                label.to(device, non_blocking=True),
+                sizes,
+            )
+
+
+def generate_cutout_mask(img_size, ratio=2, batch_size=1, device=None):
+    """(batch_size, H, W) masks that are 0 inside one random rectangle per sample.
+
+    The rectangles are drawn for the whole batch at once, each with the same
+    distribution as the former per-sample draw.
+    """
     cutout_area = img_size[0] * img_size[1] / ratio
 
-    w = np.random.randint(img_size[1] / ratio + 1, img_size[1])
-    h = np.round(cutout_area / w)
+    w = np.random.randint(img_size[1] / ratio + 1, img_size[1], size=batch_size)
+    h = np.round(cutout_area / w).astype(np.int64)
 
     x_start = np.random.randint(0, img_size[1] - w + 1)
     y_start = np.random.randint(0, img_size[0] - h + 1)
 
-    x_end = int(x_start + w)
-    y_end = int(y_start + h)
-
-    mask = torch.ones(img_size)
-    mask[y_start:y_end, x_start:x_end] = 0
-    return mask.long()
+    box = torch.from_numpy(
+        np.stack((y_start, y_start + h, x_start, x_start + w), axis=1).astype(np.int64)
+    ).to(device)
+    rows = torch.arange(img_size[0], device=device).view(1, -1, 1)
+    cols = torch.arange(img_size[1], device=device).view(1, 1, -1)
+    inside = (
+        (rows >= box[:, 0].view(-1, 1, 1))
+        & (rows < box[:, 1].view(-1, 1, 1))
+        & (cols >= box[:, 2].view(-1, 1, 1))
+        & (cols < box[:, 3].view(-1, 1, 1))
+    )
+    return (~inside).long()
 
 
 def generate_class_mask(pseudo_labels):
-    labels = torch.unique(pseudo_labels)  # all unique labels
-    labels_select = labels[torch.randperm(len(labels))][
-        : len(labels) // 2
-    ]  # randomly select half of labels
+    """(B, H, W) masks covering a random half of the classes present in each sample."""
+    batch_size = pseudo_labels.shape[0]
+    labels = pseudo_labels.reshape(batch_size, -1).long()
+
+    # presence of every label value (ignore index included) in each sample
+    num_values = int(labels.max()) + 1
+    present = torch.zeros(
+        (batch_size, num_values), dtype=torch.bool, device=pseudo_labels.device
+    )
+    present.scatter_(1, labels, True)
+
+    # a random permutation of the present labels, absent ones are ranked last
+    scores = torch.rand(present.shape, device=pseudo_labels.device)
+    scores[~present] = 2
+    rank = scores.argsort(dim=1).argsort(dim=1)
+    labels_select = present & (rank < (present.sum(dim=1, keepdim=True) // 2))
 
-    mask = (pseudo_labels.unsqueeze(-1) == labels_select).any(-1)
+    mask = labels_select.gather(1, labels).view_as(pseudo_labels)
     return mask.float()
 
 
-def generate_unsup_data(data, target, logits, mode="cutout"):
+def generate_unsup_data(data, target, logits, mode="cutout", return_mask=False):
     batch_size, _, im_h, im_w = data.shape
     device = data.device
 
-    new_data = []
-    new_target = []
-    new_logits = []
-    for i in range(batch_size):
-        if mode == "cutout":
-            mix_mask = generate_cutout_mask([im_h, im_w], ratio=2).to(device)
-            target[i][(1 - mix_mask).bool()] = 255
-
-            new_data.append((data[i] * mix_mask).unsqueeze(0))
-            new_target.append(target[i].unsqueeze(0))
-            new_logits.append((logits[i] * mix_mask).unsqueeze(0))
-            continue
-
-        if mode == "cutmix":
-            mix_mask = generate_cutout_mask([im_h, im_w]).to(device)
-        if mode == "classmix":
-            mix_mask = generate_class_mask(target[i]).to(device)
-
-        new_data.append(
-            (
-                data[i] * mix_mask + data[(i + 1) % batch_size] * (1 - mix_mask)
-            ).unsqueeze(0)
-        )
-        new_target.append(
-            (
-                target[i] * mix_mask + target[(i + 1) % batch_size] * (1 - mix_mask)
-            ).unsqueeze(0)
+    if mode == "cutout":
+        mix_mask = generate_cutout_mask(
+            [im_h, im_w], ratio=2, batch_size=batch_size, device=device
         )
-        new_logits.append(
-            (
-                logits[i] * mix_mask + logits[(i + 1) % batch_size] * (1 - mix_mask)
-            ).unsqueeze(0)
+        new_target = target.masked_fill((1 - mix_mask).bool(), 255)
+        new_data = data * mix_mask.unsqueeze(1)
+        new_logits = logits * mix_mask
+        if return_mask:
+            # cutout moves no pixels between samples, but a teacher pass on the
+            # un-cut images cannot be remapped to it (no fused_teacher)
+            return new_data, new_target.long(), new_logits, None
+        return new_data, new_target.long(), new_logits
+
+    if mode == "cutmix":
+        mix_mask = generate_cutout_mask(
+            [im_h, im_w], batch_size=batch_size, device=device
         )
+    if mode == "classmix":
+        mix_mask = generate_class_mask(target)
 
-    new_data, new_target, new_logits = (
-        torch.cat(new_data),
-        torch.cat(new_target),
-        torch.cat(new_logits),
-    )
+    # sample i is mixed with sample (i + 1) % batch_size
+    keep = mix_mask.bool()
+    new_data = torch.where(keep.unsqueeze(1), data, data.roll(-1, dims=0))
+    new_target = torch.where(keep, target, target.roll(-1, dims=0))
+    new_logits = torch.where(keep, logits, logits.roll(-1, dims=0))
+
+    if return_mask:
+        return new_data, new_target.long(), new_logits, mix_mask.float()
     return new_data, new_target.long(), new_logits
+
+
+def mix_by_mask(x, mix_mask):
+    """Apply the cutmix/classmix mixing of generate_unsup_data to any (B, ...) map.
+
+    ``mix_mask`` is the (B, H, W) mask returned with ``return_mask=True``; it is
+    resized with nearest interpolation when ``x`` has a different resolution.
+    """
+    if mix_mask is None:
+        return x
+    if mix_mask.shape[-2:] != x.shape[-2:]:
+        mix_mask = F.interpolate(
+            mix_mask.unsqueeze(1), size=x.shape[-2:], mode="nearest"
+        ).squeeze(1)
+    mix_mask = mix_mask.to(x.dtype)
+    if x.dim() == 4:
+        mix_mask = mix_mask.unsqueeze(1)
+    return x * mix_mask + x.roll(-1, dims=0) * (1 - mix_mask)
@@ -0,0 +1,129 @@
+import hashlib
+import logging
+import os
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Dataset
+
+
+class DecodedStore(object):
+    """Decoded image/label pairs packed into two uint8 files.
+
+    ``images.bin`` and ``labels.bin`` hold the raw HxWx3 / HxW arrays back to
+    back, ``index.npz`` their keys, offsets and shapes. The files are memory
+    mapped lazily (after the DataLoader workers fork) in copy-on-write mode so
+    that ``get`` returns writable zero-copy views.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        index = np.load(os.path.join(root, "index.npz"))
+        self.keys = {key: i for i, key in enumerate(index["keys"].tolist())}
+        self.img_offset, self.img_shape = index["img_offset"], index["img_shape"]
+        self.lbl_offset, self.lbl_shape = index["lbl_offset"], index["lbl_shape"]
+        self.images = None
+        self.labels = None
+
+    @staticmethod
+    def exists(root):
+        return os.path.exists(os.path.join(root, "index.npz"))
+
+    @staticmethod
+    def build(root, samples, loader):
+        """Decode every (image_path, label_path) of ``samples`` once with ``loader``."""
+        os.makedirs(root, exist_ok=True)
+        keys, img_offset, img_shape, lbl_offset, lbl_shape = [], [], [], [], []
+        img_pos, lbl_pos = 0, 0
+        with open(os.path.join(root, "images.bin"), "wb") as f_img, open(
+            os.path.join(root, "labels.bin"), "wb"
+        ) as f_lbl:
+            for image_path, label_path in samples:
+                image = np.ascontiguousarray(loader(image_path, "RGB"), dtype=np.uint8)
+                label = np.ascontiguousarray(loader(label_path, "L"), dtype=np.uint8)
+                f_img.write(image.tobytes())
+                f_lbl.write(label.tobytes())
+
+                keys.append(image_path)
+                img_offset.append(img_pos)
+                img_shape.append(image.shape)
+                lbl_offset.append(lbl_pos)
+                lbl_shape.append(label.shape)
+                img_pos += image.size
+                lbl_pos += label.size
+
+        # the index is written last, its presence marks a complete store
+        tmp_path = os.path.join(root, "index.tmp.npz")
+        np.savez(
+            tmp_path,
+            keys=np.array(keys),
+            img_offset=np.array(img_offset, dtype=np.int64),
+            img_shape=np.array(img_shape, dtype=np.int64),
+            lbl_offset=np.array(lbl_offset, dtype=np.int64),
+            lbl_shape=np.array(lbl_shape, dtype=np.int64),
+        )
+        os.replace(tmp_path, os.path.join(root, "index.npz"))
+
+    def get(self, key):
+        if self.images is None:
+            self.images = np.memmap(
+                os.path.join(self.root, "images.bin"), dtype=np.uint8, mode="c"
+            )
+            self.labels = np.memmap(
+                os.path.join(self.root, "labels.bin"), dtype=np.uint8, mode="c"
+            )
+        i = self.keys[key]
+        img_size = int(np.prod(self.img_shape[i]))
+        lbl_size = int(np.prod(self.lbl_shape[i]))
+        image = self.images[self.img_offset[i] : self.img_offset[i] + img_size]
+        label = self.labels[self.lbl_offset[i] : self.lbl_offset[i] + lbl_size]
+        return image.reshape(self.img_shape[i]), label.reshape(self.lbl_shape[i])
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class cached_dset(Dataset):
+    """Serve the samples of ``dset`` (voc_dset / city_dset) from a DecodedStore."""
+
+    def __init__(self, dset, store):
+        self.dset = dset
+        self.store = store
+
+    def __getitem__(self, index):
+        image_path = os.path.join(
+            self.dset.data_root, self.dset.list_sample_new[index][0]
+        )
+        image, label = self.store.get(image_path)
+        image, label = self.dset.transform(image, label)
+        return image[0], label[0, 0].long()
+
+    def __len__(self):
+        return len(self.dset)
+
+
+def build_cached_dset(dset, cache_dir, data_list):
+    """Wrap ``dset`` with a store under ``cache_dir``, decoding it on rank 0 if needed."""
+    logger = logging.getLogger("global")
+    name = hashlib.md5(
+        "{}|{}".format(
+            os.path.abspath(dset.data_root), os.path.abspath(data_list)
+        ).encode()
+    ).hexdigest()
+    root = os.path.join(cache_dir, name)
+
+    rank = dist.get_rank() if dist.is_initialized() else 0
+    if rank == 0 and not DecodedStore.exists(root):
+        logger.info("decoding {} into {}".format(data_list, root))
+        samples = [
+            (
+                os.path.join(dset.data_root, image_path),
+                os.path.join(dset.data_root, label_path),
+            )
+            for image_path, label_path in dict.fromkeys(map(tuple, dset.list_sample))
+        ]
+        DecodedStore.build(root, samples, dset.img_loader)
+    if dist.is_initialized():
+        dist.barrier()
+
+    return cached_dset(dset, DecodedStore(root))
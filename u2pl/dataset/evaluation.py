@@ -0,0 +1,103 @@
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+from .base import BaseDataset
+
+
+def build_color_lut(colormap):
+    """Sorted packed RGB keys of ``colormap`` and the class id of each key."""
+    keys = (colormap.astype(np.int64) * [1 << 16, 1 << 8, 1]).sum(axis=1)
+    order = np.argsort(keys)
+    return keys[order], order
+
+
+def rgb_to_id(rgb, lut):
+    """Map an HxWx3 palette image to class ids, unknown colors become 0."""
+    keys, ids = lut
+    packed = (rgb.astype(np.int64) * [1 << 16, 1 << 8, 1]).sum(axis=2)
+    pos = np.clip(np.searchsorted(keys, packed), 0, len(keys) - 1)
+    return np.where(keys[pos] == packed, ids[pos], 0)
+
+
+class eval_dset(BaseDataset):
+    """Whole validation images for the standalone eval / infer scripts.
+
+    Samples are (normalized CHW image, label, index), plus the raw HxWx3 uint8
+    image with ``return_raw``. The image is resized to ``input_size`` when
+    given. Labels come from the list's label maps, or with ``gt_root`` from
+    ``<gt_root>/<name>.png`` palette images, mapped to ids through ``lut`` when
+    given and returned as RGB otherwise.
+    """
+
+    def __init__(
+        self,
+        data_root,
+        data_list,
+        mean,
+        std,
+        input_size=None,
+        gt_root=None,
+        lut=None,
+        return_raw=False,
+    ):
+        super(eval_dset, self).__init__(data_list)
+        self.data_root = data_root
+        self.mean = np.array(mean, dtype=np.float32)
+        self.std = np.array(std, dtype=np.float32)
+        self.input_size = input_size
+        self.gt_root = gt_root
+        self.lut = lut
+        self.return_raw = return_raw
+
+    def image_path(self, index):
+        return os.path.join(self.data_root, self.list_sample[index][0])
+
+    def __getitem__(self, index):
+        image_path = self.image_path(index)
+        raw = np.asarray(self.img_loader(image_path, "RGB"))
+        image = (raw.astype(np.float32) - self.mean) / self.std
+        image = torch.from_numpy(image).permute(2, 0, 1).contiguous()
+        if self.input_size is not None:
+            image = F.interpolate(
+                image.unsqueeze(0),
+                self.input_size,
+                mode="bilinear",
+                align_corners=True,
+            )[0]
+
+        if self.gt_root is None:
+            label_path = os.path.join(self.data_root, self.list_sample[index][1])
+            label = np.asarray(self.img_loader(label_path, "L"))
+        else:
+            name = os.path.splitext(os.path.basename(image_path))[0]
+            label = np.asarray(
+                self.img_loader(os.path.join(self.gt_root, name + ".png"), "RGB")
+            )
+            if self.lut is not None:
+                label = rgb_to_id(label, self.lut)
+        label = torch.from_numpy(np.ascontiguousarray(label))
+
+        if self.return_raw:
+            return image, label, index, raw
+        return image, label, index
+
+
+def eval_collate(batch):
+    # image sizes differ across a pascal batch, so fields stay lists
+    return tuple(list(field) for field in zip(*batch))
+
+
+def build_evalloader(dset, batch_size=1, workers=4, sampler=None):
+    return DataLoader(
+        dset,
+        batch_size=batch_size,
+        num_workers=workers,
+        sampler=sampler,
+        shuffle=False,
+        pin_memory=True,
+        collate_fn=eval_collate,
+    )
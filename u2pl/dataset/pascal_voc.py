@@ -12,6 +12,8 @@ from torchvision import transforms
 
 from . import augmentation as psp_trsform
 from .base import BaseDataset
+from .cache import build_cached_dset
+from .pseudo_label import build_pseudo_dset
 
 
 class voc_dset(BaseDataset):
@@ -48,6 +50,9 @@ class voc_dset(BaseDataset):
 def build_transfrom(cfg):
     trs_form = []
     mean, std, ignore_label = cfg["mean"], cfg["std"], cfg["ignore_label"]
+    if cfg.get("batch_aug", False):
+        # augmentation runs batched on the training device, see BatchAugment
+        return psp_trsform.Compose([psp_trsform.ToTensorRaw()])
     trs_form.append(psp_trsform.ToTensor())
     trs_form.append(psp_trsform.Normalize(mean=mean, std=std))
     if cfg.get("resize", False):
@@ -83,6 +88,8 @@ def build_vocloader(split, all_cfg, seed=0):
     # build transform
     trs_form = build_transfrom(cfg)
     dset = voc_dset(cfg["data_root"], cfg["data_list"], trs_form, seed, n_sup)
+    if cfg.get("cache", False):
+        dset = build_cached_dset(dset, cfg["cache"], cfg["data_list"])
 
     # build sampler
     sample = DistributedSampler(dset)
@@ -94,7 +101,12 @@ def build_vocloader(split, all_cfg, seed=0):
         sampler=sample,
         shuffle=False,
         pin_memory=False,
+        collate_fn=psp_trsform.pad_collate if cfg.get("batch_aug", False) else None,
     )
+    if cfg.get("batch_aug", False):
+        loader = psp_trsform.BatchAugLoader(
+            loader, psp_trsform.build_batch_augment(cfg)
+        )
     return loader
 
 
@@ -112,6 +124,8 @@ def build_voc_semi_loader(split, all_cfg, seed=0):
     trs_form = build_transfrom(cfg)
     trs_form_unsup = build_transfrom(cfg)
     dset = voc_dset(cfg["data_root"], cfg["data_list"], trs_form, seed, n_sup, split)
+    if cfg.get("cache", False):
+        dset = build_cached_dset(dset, cfg["cache"], cfg["data_list"])
 
     if split == "val":
         # build sampler
@@ -132,7 +146,14 @@ def build_voc_semi_loader(split, all_cfg, seed=0):
         dset_unsup = voc_dset(
             cfg["data_root"], data_list_unsup, trs_form_unsup, seed, n_sup, split
         )
-
+        if cfg.get("pseudo_label", False):
+            # targets come from the offline teacher, see pseudo_label.py
+            assert not cfg.get("batch_aug", False), "pseudo_label needs per-sample aug"
+            dset_unsup = build_pseudo_dset(dset_unsup, cfg["pseudo_label"])
+        elif cfg.get("cache", False):
+            dset_unsup = build_cached_dset(dset_unsup, cfg["cache"], data_list_unsup)
+
+        collate_fn = psp_trsform.pad_collate if cfg.get("batch_aug", False) else None
         sample_sup = DistributedSampler(dset)
         loader_sup = DataLoader(
             dset,
@@ -142,6 +163,7 @@ def build_voc_semi_loader(split, all_cfg, seed=0):
             shuffle=False,
             pin_memory=True,
             drop_last=True,
+            collate_fn=collate_fn,
         )
 
         sample_unsup = DistributedSampler(dset_unsup)
@@ -153,5 +175,10 @@ def build_voc_semi_loader(split, all_cfg, seed=0):
             shuffle=False,
             pin_memory=True,
             drop_last=True,
+            collate_fn=collate_fn,
         )
+        if cfg.get("batch_aug", False):
+            batch_augment = psp_trsform.build_batch_augment(cfg)
+            loader_sup = psp_trsform.BatchAugLoader(loader_sup, batch_augment)
+            loader_unsup = psp_trsform.BatchAugLoader(loader_unsup, batch_augment)
         return loader_sup, loader_unsup
@@ -0,0 +1,133 @@
+import logging
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+IGNORE = 255
+
+
+class PseudoLabelStore(object):
+    """Teacher pseudo-labels written by ``pseudo_label.py``.
+
+    Every image holds an HxWx3 uint8 block in ``planes.bin``: the class id, the
+    confidence (max softmax probability) and the entropy normalized by
+    log(num_classes), the last two quantized to 0..255. ``index.npz`` maps the
+    image paths to offsets and shapes; the file is memory mapped lazily.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        index = np.load(os.path.join(root, "index.npz"))
+        self.keys = {key: i for i, key in enumerate(index["keys"].tolist())}
+        self.offset, self.shape = index["offset"], index["shape"]
+        self.num_classes = int(index["num_classes"])
+        self.planes = None
+
+    @staticmethod
+    def exists(root):
+        return os.path.exists(os.path.join(root, "index.npz"))
+
+    @staticmethod
+    def build(root, items, num_classes):
+        """Write the (image_path, HxWx3 uint8 planes) pairs yielded by ``items``."""
+        os.makedirs(root, exist_ok=True)
+        keys, offset, shape = [], [], []
+        pos = 0
+        with open(os.path.join(root, "planes.bin"), "wb") as f:
+            for key, planes in items:
+                planes = np.ascontiguousarray(planes, dtype=np.uint8)
+                f.write(planes.tobytes())
+                keys.append(key)
+                offset.append(pos)
+                shape.append(planes.shape)
+                pos += planes.size
+
+        # the index is written last, its presence marks a complete store
+        tmp_path = os.path.join(root, "index.tmp.npz")
+        np.savez(
+            tmp_path,
+            keys=np.array(keys),
+            offset=np.array(offset, dtype=np.int64),
+            shape=np.array(shape, dtype=np.int64),
+            num_classes=np.array(num_classes),
+        )
+        os.replace(tmp_path, os.path.join(root, "index.npz"))
+
+    def get(self, key):
+        if self.planes is None:
+            self.planes = np.memmap(
+                os.path.join(self.root, "planes.bin"), dtype=np.uint8, mode="c"
+            )
+        i = self.keys[key]
+        size = int(np.prod(self.shape[i]))
+        planes = self.planes[self.offset[i] : self.offset[i] + size]
+        return planes.reshape(self.shape[i])
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def quantize_prediction(prob):
+    """(C, H, W) softmax on any device -> HxWx3 uint8 planes of the store."""
+    num_classes = prob.shape[0]
+    conf, label = prob.max(dim=0)
+    entropy = -torch.sum(prob * torch.log(prob + 1e-10), dim=0)
+    entropy = entropy / np.log(num_classes)
+    planes = torch.stack(
+        (
+            label.float(),
+            (conf * 255).round(),
+            (entropy.clamp(0, 1) * 255).round(),
+        ),
+        dim=-1,
+    )
+    return planes.byte().cpu().numpy()
+
+
+class pseudo_dset(Dataset):
+    """Unlabeled samples of ``dset`` (voc_dset / city_dset) with stored targets.
+
+    The planes run through the same transform as a label would, the sample
+    target is a float (3, H, W) tensor of pseudo-label (255 = ignored),
+    confidence in [0, 1] and entropy in nats.
+    """
+
+    def __init__(self, dset, store):
+        self.dset = dset
+        self.store = store
+        self.max_entropy = float(np.log(store.num_classes))
+
+    def __getitem__(self, index):
+        image_path = os.path.join(
+            self.dset.data_root, self.dset.list_sample_new[index][0]
+        )
+        image = self.dset.img_loader(image_path, "RGB")
+        planes = self.store.get(image_path).copy()
+        # shift ids by one so that both crop padding (0) and rotation fill
+        # (ignore label) can be told apart from real classes afterwards
+        planes[..., 0] += 1
+        image, planes = self.dset.transform(image, planes)
+        planes = planes[0]
+
+        label = planes[0] - 1
+        label[(planes[0] == 0) | (planes[0] == IGNORE)] = IGNORE
+        target = torch.stack(
+            (label, planes[1] / 255.0, planes[2] / 255.0 * self.max_entropy)
+        )
+        return image[0], target
+
+    def __len__(self):
+        return len(self.dset)
+
+
+def build_pseudo_dset(dset, root):
+    logger = logging.getLogger("global")
+    if not PseudoLabelStore.exists(root):
+        raise FileNotFoundError(
+            "no pseudo-label store in {}, run pseudo_label.py first".format(root)
+        )
+    store = PseudoLabelStore(root)
+    logger.info("pseudo-labels of {} images from {}".format(len(store), root))
+    return pseudo_dset(dset, store)
@@ -67,3 +67,25 @@ class DistributedGivenIterationSampler(Sampler):
         # handled by dataloader
         # return self.total_size - (self.last_iter+1)*self.batch_size
         return self.total_size
+
+
+class DistributedShardSampler(Sampler):
+    """Disjoint strided shards of a dataset, one per rank, for evaluation.
+
+    Unlike DistributedSampler nothing is padded: shards may differ in size by
+    one, so every sample is seen exactly once and reduced metrics stay exact.
+    """
+
+    def __init__(self, dataset, world_size=None, rank=None):
+        if world_size is None:
+            world_size = dist.get_world_size()
+        if rank is None:
+            rank = dist.get_rank()
+        assert rank < world_size
+        self.indices = range(rank, len(dataset), world_size)
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
@@ -1,5 +1,8 @@
+from contextlib import contextmanager
+
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint as cp
 from torch.nn import functional as F
 
 
@@ -8,6 +11,56 @@ def get_syncbn():
     return nn.SyncBatchNorm
 
 
+@contextmanager
+def frozen_bn_stats(module):
+    """Run BN layers of ``module`` on batch statistics without updating their
+    running statistics (momentum 0, ``num_batches_tracked`` restored)."""
+    bns = [
+        m
+        for m in module.modules()
+        if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats
+    ]
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in bns]
+    for m in bns:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches) in zip(bns, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(num_batches)
+
+
+def run_checkpointed(module, *inputs):
+    """``module(*inputs)``, recomputed in backward instead of keeping its
+    activations when ``module.use_checkpoint`` is set (``net.checkpoint``).
+
+    The non-reentrant checkpoint restores the RNG (dropout) and autocast
+    state and works with DDP. BN layers see the same batch in the
+    recomputation, so the outputs match. Their running statistics are only
+    updated by the first pass. A SyncBatchNorm recomputation repeats its
+    collectives inside backward, at the same point of the graph on every
+    rank.
+    """
+    if not (
+        getattr(module, "use_checkpoint", False)
+        and module.training
+        and torch.is_grad_enabled()
+    ):
+        return module(*inputs)
+
+    recompute = [False]
+
+    def run(*inputs):
+        if not recompute[0]:
+            recompute[0] = True
+            return module(*inputs)
+        with frozen_bn_stats(module):
+            return module(*inputs)
+
+    return cp.checkpoint(run, *inputs, use_reentrant=False)
+
+
 class ASPP(nn.Module):
     """
     Reference:
@@ -2,7 +2,7 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as F
 
-from .base import ASPP, get_syncbn
+from .base import ASPP, get_syncbn, run_checkpointed
 
 
 class dec_deeplabv3(nn.Module):
@@ -37,8 +37,8 @@ class dec_deeplabv3(nn.Module):
         )
 
     def forward(self, x):
-        aspp_out = self.aspp(x)
-        res = self.head(aspp_out)
+        aspp_out = run_checkpointed(self.aspp, x)
+        res = run_checkpointed(self.head, aspp_out)
         return res
 
 
@@ -106,19 +106,19 @@ class dec_deeplabv3_plus(nn.Module):
 
     def forward(self, x):
         x1, x2, x3, x4 = x
-        aspp_out = self.aspp(x4)
+        aspp_out = run_checkpointed(self.aspp, x4)
         low_feat = self.low_conv(x1)
-        aspp_out = self.head(aspp_out)
+        aspp_out = run_checkpointed(self.head, aspp_out)
         h, w = low_feat.size()[-2:]
         aspp_out = F.interpolate(
             aspp_out, size=(h, w), mode="bilinear", align_corners=True
         )
         aspp_out = torch.cat((low_feat, aspp_out), dim=1)
 
-        res = {"pred": self.classifier(aspp_out)}
+        res = {"pred": run_checkpointed(self.classifier, aspp_out)}
 
         if self.rep_head:
-            res["rep"] = self.representation(aspp_out)
+            res["rep"] = run_checkpointed(self.representation, aspp_out)
 
         return res
 
@@ -25,6 +25,9 @@ class ModelBuilder(nn.Module):
                 cfg_aux["aux_plane"], self._num_classes, self._sync_bn
             )
 
+        # e.g. [layer3, layer4, aspp, classifier, representation]
+        self._set_checkpoint(net_cfg.get("checkpoint", []))
+
     def _build_encoder(self, enc_cfg):
         enc_cfg["kwargs"].update({"sync_bn": self._sync_bn})
         encoder = self._build_module(enc_cfg["type"], enc_cfg["kwargs"])
@@ -41,6 +44,20 @@ class ModelBuilder(nn.Module):
         decoder = self._build_module(dec_cfg["type"], dec_cfg["kwargs"])
         return decoder
 
+    def _set_checkpoint(self, names):
+        """Recompute the activations of the named encoder stages / decoder
+        modules in backward instead of storing them, see run_checkpointed."""
+        for name in names:
+            if isinstance(getattr(self.encoder, name, None), nn.Module):
+                # residual stages are checkpointed block by block
+                modules = list(getattr(self.encoder, name).children())
+            elif isinstance(getattr(self.decoder, name, None), nn.Module):
+                modules = [getattr(self.decoder, name)]
+            else:
+                raise ValueError("net.checkpoint: unknown module {}".format(name))
+            for module in modules:
+                module.use_checkpoint = True
+
     def _build_module(self, mtype, kwargs):
         module_name, class_name = mtype.rsplit(".", 1)
         module = importlib.import_module(module_name)
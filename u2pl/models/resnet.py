@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
 
-from .base import get_syncbn
+from .base import get_syncbn, run_checkpointed
 
 __all__ = [
     "ResNet",
@@ -276,16 +276,22 @@ class ResNet(nn.Module):
 
         return nn.Sequential(*layers)
 
+    def _forward_layer(self, layer, x):
+        # blocks flagged by net.checkpoint are recomputed one at a time
+        for block in layer:
+            x = run_checkpointed(block, x)
+        return x
+
     def forward(self, x):
         x = self.relu(self.bn1(self.conv1(x)))
         x = self.maxpool(x)
 
-        x = self.layer1(x)
+        x = self._forward_layer(self.layer1, x)
         x1 = x
-        x = self.layer2(x)
+        x = self._forward_layer(self.layer2, x)
         x2 = x
-        x3 = self.layer3(x)
-        x4 = self.layer4(x3)
+        x3 = self._forward_layer(self.layer3, x)
+        x4 = self._forward_layer(self.layer4, x3)
         if self.fpn:
             return [x1, x2, x3, x4]
         else:
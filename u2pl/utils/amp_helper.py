@@ -0,0 +1,36 @@
+import torch
+
+AMP_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+class AMPHelper(object):
+    """Mixed precision switch driven by ``trainer.amp`` (fp16 | bf16 | None).
+
+    ``autocast()`` wraps forwards and losses, ``step(loss, optimizer)`` replaces
+    the zero_grad/backward/step triple and applies loss scaling for fp16.
+    With ``mode=None`` both are no-ops around the plain fp32 path.
+    """
+
+    def __init__(self, mode=None, device_type=None):
+        if mode is not None and mode not in AMP_DTYPES:
+            raise ValueError("unknown amp mode {}".format(mode))
+        if device_type is None:
+            device_type = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device_type = device_type
+        self.dtype = AMP_DTYPES.get(mode)
+        self.enabled = self.dtype is not None
+        # bf16 has the fp32 exponent range and needs no loss scaling
+        self.scaler = torch.cuda.amp.GradScaler(
+            enabled=self.dtype == torch.float16 and device_type == "cuda"
+        )
+
+    def autocast(self):
+        return torch.autocast(
+            device_type=self.device_type, dtype=self.dtype, enabled=self.enabled
+        )
+
+    def step(self, loss, optimizer):
+        optimizer.zero_grad()
+        self.scaler.scale(loss).backward()
+        self.scaler.step(optimizer)
+        self.scaler.update()
@@ -0,0 +1,78 @@
+import os
+import shutil
+import threading
+
+import torch
+
+
+def load_checkpoint(path):
+    """Load ``path`` onto the CPU, memory mapped when torch supports it so that
+    tensors are only read from disk when they are copied into a model."""
+    try:
+        return torch.load(path, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        # torch < 2.1, or a checkpoint in the legacy (non zip) format
+        return torch.load(path, map_location="cpu")
+
+
+def cpu_snapshot(obj):
+    """Copy every tensor of a (nested) state dict to the CPU."""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, cpu_snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return obj
+
+
+class CheckpointSaver(object):
+    """Write checkpoints from a background thread.
+
+    ``save`` takes a CPU snapshot of the state (the only part that blocks
+    training) and serializes it once to ``path``; every path in ``links``
+    receives the same file as a hard link, or a copy where links are not
+    supported, instead of a second serialization. Files are written under a
+    temporary name and renamed, so a crash never leaves a truncated
+    checkpoint. At most one write is in flight, ``close`` waits for it.
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def save(self, state, path, links=()):
+        state = cpu_snapshot(state)
+        self.wait()
+        self.thread = threading.Thread(
+            target=self._write, args=(state, path, list(links)), daemon=True
+        )
+        self.thread.start()
+
+    def _write(self, state, path, links):
+        try:
+            tmp_path = path + ".tmp"
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, path)
+            for link in links:
+                tmp_link = link + ".tmp"
+                if os.path.exists(tmp_link):
+                    os.remove(tmp_link)
+                try:
+                    os.link(path, tmp_link)
+                except OSError:
+                    shutil.copyfile(path, tmp_link)
+                os.replace(tmp_link, link)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("writing a checkpoint failed") from error
+
+    def close(self):
+        self.wait()
@@ -10,12 +10,16 @@ import torch.distributed as dist
 from torch.utils.data.sampler import Sampler
 
 
-def setup_distributed(backend="nccl", port=None):
+def setup_distributed(backend=None, port=None):
     """AdaHessian Optimizer
     Lifted from https://github.com/BIGBALLON/distribuuuu/blob/master/distribuuuu/utils.py
     Originally licensed MIT, Copyright (c) 2020 Wei Li
+
+    Without GPUs the processes run on CPU and talk over gloo instead of nccl.
     """
     num_gpus = torch.cuda.device_count()
+    if backend is None:
+        backend = "nccl" if num_gpus > 0 else "gloo"
 
     if "SLURM_JOB_ID" in os.environ:
         rank = int(os.environ["SLURM_PROCID"])
@@ -30,13 +34,16 @@ def setup_distributed(backend="nccl", port=None):
         if "MASTER_ADDR" not in os.environ:
             os.environ["MASTER_ADDR"] = addr
         os.environ["WORLD_SIZE"] = str(world_size)
-        os.environ["LOCAL_RANK"] = str(rank % num_gpus)
+        os.environ["LOCAL_RANK"] = str(
+            rank % num_gpus if num_gpus > 0 else os.environ.get("SLURM_LOCALID", 0)
+        )
         os.environ["RANK"] = str(rank)
     else:
         rank = int(os.environ["RANK"])
         world_size = int(os.environ["WORLD_SIZE"])
 
-    torch.cuda.set_device(rank % num_gpus)
+    if num_gpus > 0:
+        torch.cuda.set_device(rank % num_gpus)
 
     dist.init_process_group(
         backend=backend,
@@ -46,13 +53,67 @@ def setup_distributed(backend="nccl", port=None):
     return rank, world_size
 
 
+def get_device():
+    """The device of this process: its current GPU, or the CPU without CUDA."""
+    if torch.cuda.is_available():
+        return torch.device("cuda", torch.cuda.current_device())
+    return torch.device("cpu")
+
+
 def gather_together(data):
     world_size = dist.get_world_size()
-    gather_data = [torch.zeros_like(data).cuda() for _ in range(world_size)]
+    gather_data = [torch.zeros_like(data) for _ in range(world_size)]
     dist.all_gather(gather_data, data)
     return gather_data
 
 
+@torch.no_grad()
+def all_gather_packed(keys, counts):
+    """Exchange class-sorted keys between ranks with a single tensor all_gather.
+
+    ``keys`` stores the rows of every class back to back and ``counts`` holds
+    the number of rows per class. Each rank packs a header row carrying its
+    counts followed by its keys, zero-padded to the longest payload of the group
+    (negotiated with a one-element all_reduce). The result is the keys of all
+    ranks, again sorted by class, together with the summed per-class counts.
+    """
+    if not dist.is_available() or not dist.is_initialized():
+        return keys, counts
+    world_size = dist.get_world_size()
+    if world_size == 1:
+        return keys, counts
+
+    num_classes = counts.numel()
+    num_feat = keys.shape[1]
+    assert num_classes <= num_feat, "count header must fit in one key row"
+
+    length = torch.tensor([keys.shape[0]], dtype=torch.long, device=keys.device)
+    dist.all_reduce(length, op=dist.ReduceOp.MAX)
+    max_len = int(length.item())
+
+    # header row + payload; counts are exact in fp32 up to 2 ** 24 keys per class
+    packed = torch.zeros((max_len + 1, num_feat), dtype=torch.float, device=keys.device)
+    packed[0, :num_classes] = counts.float()
+    packed[1 : keys.shape[0] + 1] = keys
+    gathered = packed.new_empty((world_size, max_len + 1, num_feat))
+    dist.all_gather(list(gathered.unbind(0)), packed)
+
+    # (world_size, num_classes)
+    counts_all = gathered[:, 0, :num_classes].round().long()
+    payload = gathered[:, 1:].reshape(world_size * max_len, num_feat)
+
+    # class id of every payload row, padding rows fall into bucket num_classes
+    row_idx = torch.arange(max_len, device=keys.device).expand(world_size, max_len)
+    row_cls = torch.searchsorted(
+        counts_all.cumsum(dim=1), row_idx.contiguous(), right=True
+    ).reshape(-1)
+    valid = row_cls < num_classes
+    row_cls, payload = row_cls[valid], payload[valid]
+    _, order = torch.sort(row_cls, stable=True)
+
+    return payload[order], counts_all.sum(dim=0)
+
+
 class DistributedGivenIterationSampler(Sampler):
     def __init__(
         self, dataset, total_iter, batch_size, world_size=None, rank=None, last_iter=-1
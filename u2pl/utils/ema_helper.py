@@ -0,0 +1,78 @@
+import torch
+
+
+def _float_tensors(tensors):
+    return [t for t in tensors if t.is_floating_point()]
+
+
+class EMATeacher(object):
+    """Mean teacher kept as an exponential moving average of a student.
+
+    All parameters (and, with ``buffers=True``, the floating point buffers such
+    as BN running statistics) are updated in place with multi-tensor foreach
+    ops. With ``update_every=N`` the average is applied once every N steps
+    using ``decay ** N``. ``dtype`` (e.g. ``torch.float16``) only lowers the
+    precision of the forward: calling the EMATeacher runs the teacher under
+    autocast and returns float32 outputs. The average itself stays in the
+    teacher's float32 weights, a half precision accumulator would round
+    ``t * decay`` back to ``t`` for decays close to 1.
+    """
+
+    def __init__(self, student, teacher, update_every=1, buffers=False, dtype=None):
+        self.student = student
+        self.teacher = teacher
+        self.update_every = max(int(update_every), 1)
+        self.dtype = dtype
+        self.num_steps = 0
+
+        self.student_tensors = list(student.parameters())
+        self.teacher_tensors = list(teacher.parameters())
+        if buffers:
+            self.student_tensors += _float_tensors(student.buffers())
+            self.teacher_tensors += _float_tensors(teacher.buffers())
+        assert len(self.student_tensors) == len(self.teacher_tensors)
+
+    @torch.no_grad()
+    def copy_(self):
+        """Overwrite the teacher with the current student weights."""
+        for t_tensor, s_tensor in zip(self.teacher_tensors, self.student_tensors):
+            t_tensor.copy_(s_tensor)
+
+    @torch.no_grad()
+    def update(self, decay):
+        self.num_steps += 1
+        if self.num_steps % self.update_every != 0:
+            return
+
+        decay = decay**self.update_every
+        torch._foreach_mul_(self.teacher_tensors, decay)
+        torch._foreach_add_(self.teacher_tensors, self.student_tensors, alpha=1 - decay)
+
+    def train(self, mode=True):
+        self.teacher.train(mode)
+        return self
+
+    def eval(self):
+        return self.train(False)
+
+    def __call__(self, *args, **kwargs):
+        if self.dtype is None:
+            return self.teacher(*args, **kwargs)
+
+        device_type = self.teacher_tensors[0].device.type
+        with torch.autocast(device_type=device_type, dtype=self.dtype):
+            outs = self.teacher(*args, **kwargs)
+        return {key: value.float() for key, value in outs.items()}
+
+
+def build_ema_teacher(student, teacher, cfg_net):
+    dtype = {None: None, "fp16": torch.float16, "bf16": torch.bfloat16}[
+        cfg_net.get("ema_dtype", None)
+    ]
+    return EMATeacher(
+        student,
+        teacher,
+        update_every=cfg_net.get("ema_every", 1),
+        buffers=cfg_net.get("ema_buffers", False),
+        dtype=dtype,
+    )
@@ -4,7 +4,7 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as F
 
-from .utils import dequeue_and_enqueue
+from .utils import dequeue_and_enqueue, draw_index
 
 
 # def compute_rce_loss(predict, target):
@@ -27,23 +27,195 @@ from .utils import dequeue_and_enqueue
 #     return rce.sum() / (target != 255).sum()
 
 
-def compute_unsupervised_loss(predict, target, percent, pred_teacher):
-    batch_size, num_class, h, w = predict.shape
+def compute_entropy(prob):
+    # kept in fp32 under autocast, log(prob + 1e-10) underflows in half precision
+    prob = prob.float()
+    return -torch.sum(prob * torch.log(prob + 1e-10), dim=1)
+
+
+@torch.no_grad()
+def compute_percentiles(entropy, valid, percents, mode="exact", bins=1000):
+    """Percentiles (0-100) of ``entropy[valid]`` computed on device.
+
+    ``mode="exact"`` matches ``np.percentile`` (linear interpolation) with a
+    single sort, ``mode="hist"`` reads them off a ``bins``-bin histogram.
+    All requested percentiles come from the same pass and no value is copied
+    to the host, so the result stays a tensor of shape (len(percents),).
+    """
+    entropy = entropy.flatten().float()
+    valid = valid.flatten()
+    num_valid = valid.sum()
+    percents = torch.tensor(percents, dtype=torch.float, device=entropy.device)
+    rank = percents / 100 * (num_valid - 1).clamp(min=0)
+
+    if mode == "exact":
+        # invalid pixels are sorted behind every valid one
+        values, _ = torch.sort(torch.where(valid, entropy, entropy.new_tensor(1e10)))
+        lower = rank.floor().long()
+        upper = rank.ceil().long()
+        frac = rank - lower
+        return values[lower] + (values[upper] - values[lower]) * frac
+    elif mode == "hist":
+        # bins span [0, max valid entropy], invalid pixels are counted with weight 0
+        hi = torch.where(valid, entropy, entropy.new_tensor(0.0)).max().clamp(min=1e-6)
+        bin_idx = (entropy / hi * bins).long().clamp(0, bins - 1)
+        hist = torch.zeros(bins, device=entropy.device)
+        hist.index_add_(0, bin_idx, valid.float())
+        cdf = hist.cumsum(0)
+        idx = torch.searchsorted(cdf, rank + 1).clamp(max=bins - 1)
+        count = hist[idx].clamp(min=1)
+        frac = ((rank + 1 - (cdf[idx] - hist[idx])) / count).clamp(0, 1)
+        return (idx.float() + frac) * hi / bins
+    else:
+        raise ValueError("unknown percentile mode {}".format(mode))
+
+
+def _bilinear_index(in_size, out_size, align_corners):
+    # source rows/columns of torch's bilinear kernel, computed on the host
+    dst = torch.arange(out_size, dtype=torch.float32)
+    if align_corners:
+        scale = (in_size - 1) / (out_size - 1) if out_size > 1 else 0.0
+        src = dst * torch.tensor(scale, dtype=torch.float32)
+    else:
+        scale = torch.tensor(in_size / out_size, dtype=torch.float32)
+        src = ((dst + 0.5) * scale - 0.5).clamp(min=0)
+    idx0 = src.floor().long().clamp(max=in_size - 1)
+    idx1 = (idx0 + 1).clamp(max=in_size - 1)
+    return idx0, idx1, src - idx0
+
+
+def _upsample_tiles(logits, target, align_corners, chunk_rows):
+    """Split the upsampled map into bands of ``chunk_rows`` output rows, each
+    with the slice of source rows it reads and its target rows."""
+    (in_h, in_w), (out_h, out_w) = logits.shape[2:], target.shape[1:]
+    device = logits.device
+    row0, row1, row_w = _bilinear_index(in_h, out_h, align_corners)
+    col0, col1, col_w = _bilinear_index(in_w, out_w, align_corners)
+    cols = (col0.to(device), col1.to(device), col_w.to(device))
+    for start in range(0, out_h, chunk_rows):
+        end = min(start + chunk_rows, out_h)
+        src_start, src_end = int(row0[start]), int(row1[end - 1]) + 1
+        rows = (
+            (row0[start:end] - src_start).to(device),
+            (row1[start:end] - src_start).to(device),
+            row_w[start:end].to(device),
+        )
+        yield src_start, src_end, rows, cols, target[:, start:end]
+
+
+def _loss_dtype(logits):
+    # half precision logits are upsampled and reduced in float32
+    return torch.promote_types(logits.dtype, torch.float32)
+
+
+def _tile_loss(logits, rows, cols, target, weight, ignore_index):
+    row0, row1, row_w = rows
+    col0, col1, col_w = cols
+    logits = logits.to(_loss_dtype(logits))
+    if weight is not None:
+        weight = weight.to(logits.dtype)
+    row_w = row_w.view(1, 1, -1, 1)
+    up = logits.index_select(2, row0) * (1 - row_w)
+    up = up + logits.index_select(2, row1) * row_w
+    col_w = col_w.view(1, 1, 1, -1)
+    up = up.index_select(3, col0) * (1 - col_w) + up.index_select(3, col1) * col_w
+    return F.cross_entropy(
+        up, target, weight=weight, ignore_index=ignore_index, reduction="sum"
+    )
+
+
+class UpsampleCrossEntropy(torch.autograd.Function):
+    """Bilinear upsampling of the logits to the target size followed by a mean
+    cross entropy, evaluated in bands of output rows.
+
+    Neither the full-size logits nor their gradient are ever materialized:
+    forward only keeps the loss sums, backward recomputes every band and
+    accumulates its gradient straight into the low-resolution logits.
+    """
+
+    @staticmethod
+    def forward(ctx, logits, target, weight, ignore_index, align_corners, chunk_rows):
+        valid = target != ignore_index
+        if weight is None:
+            denom = valid.sum().to(_loss_dtype(logits))
+        else:
+            denom = (weight[target.masked_fill(~valid, 0)] * valid).sum()
+            denom = denom.to(_loss_dtype(logits))
+
+        loss = logits.new_zeros((), dtype=_loss_dtype(logits))
+        for src_start, src_end, rows, cols, tile in _upsample_tiles(
+            logits, target, align_corners, chunk_rows
+        ):
+            band = logits[:, :, src_start:src_end]
+            loss += _tile_loss(band, rows, cols, tile, weight, ignore_index)
+
+        ctx.save_for_backward(logits, target, weight, denom)
+        ctx.ignore_index = ignore_index
+        ctx.align_corners = align_corners
+        ctx.chunk_rows = chunk_rows
+        return loss / denom
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        logits, target, weight, denom = ctx.saved_tensors
+        scale = grad_output.to(_loss_dtype(logits)) / denom
+        grad = torch.zeros_like(logits, dtype=_loss_dtype(logits))
+        for src_start, src_end, rows, cols, tile in _upsample_tiles(
+            logits, target, ctx.align_corners, ctx.chunk_rows
+        ):
+            with torch.enable_grad():
+                band = logits[:, :, src_start:src_end].detach().requires_grad_()
+                loss = _tile_loss(band, rows, cols, tile, weight, ctx.ignore_index)
+                (band_grad,) = torch.autograd.grad(loss, band, scale)
+            # neighbouring bands share a source row
+            grad[:, :, src_start:src_end] += band_grad
+        return grad.to(logits.dtype), None, None, None, None, None
+
+
+def upsample_cross_entropy(
+    logits, target, weight=None, ignore_index=255, align_corners=True, chunk_rows=64
+):
+    """``F.cross_entropy(F.interpolate(logits, target.shape[1:], mode="bilinear"),
+    target)`` with the memory of a ``chunk_rows`` high band of the output."""
+    return UpsampleCrossEntropy.apply(
+        logits, target, weight, ignore_index, align_corners, int(chunk_rows)
+    )
+
+
+def resize_logits(pred, size, chunked=False):
+    """Logits as the losses take them: upsampled to ``size``, or kept at their
+    own resolution with ``chunked`` for the losses to upsample band by band."""
+    if chunked:
+        return pred
+    return F.interpolate(pred, size, mode="bilinear", align_corners=True)
+
+
+def compute_unsupervised_loss(
+    predict, target, percent, pred_teacher, entropy=None, thresh=None, chunk_rows=64
+):
+    # ``predict`` may be smaller than ``target``, it is then upsampled band by
+    # band inside the loss, see upsample_cross_entropy
+    batch_size, h, w = target.shape
 
     with torch.no_grad():
         # drop pixels with high entropy
-        prob = torch.softmax(pred_teacher, dim=1)
-        entropy = -torch.sum(prob * torch.log(prob + 1e-10), dim=1)
+        if entropy is None:
+            prob = torch.softmax(pred_teacher, dim=1)
+            entropy = compute_entropy(prob)
 
-        thresh = np.percentile(
-            entropy[target != 255].detach().cpu().numpy().flatten(), percent
-        )
+        if thresh is None:
+            thresh = compute_percentiles(entropy, target != 255, [percent])[0]
         thresh_mask = entropy.ge(thresh).bool() * (target != 255).bool()
 
         target[thresh_mask] = 255
         weight = batch_size * h * w / torch.sum(target != 255)
 
-    loss = weight * F.cross_entropy(predict, target, ignore_index=255)  # [10, 321, 321]
+    if predict.shape[2:] != target.shape[1:]:
+        loss = weight * upsample_cross_entropy(predict, target, chunk_rows=chunk_rows)
+    else:
+        loss = weight * F.cross_entropy(
+            predict.float(), target, ignore_index=255
+        )  # [10, 321, 321]
 
     return loss
 
@@ -58,12 +230,15 @@ def compute_contra_memobank_loss(
     high_mask,
     cfg,
     memobank,
-    queue_prtlis,
-    queue_size,
     rep_teacher,
     momentum_prototype=None,
     i_iter=0,
+    draw_index=draw_index,
 ):
+    # draw_index(high, num) picks the anchor and memory bank samples, see
+    # u2pl.utils.utils.draw_index
+    # label_l / label_u: integer label maps at the feature resolution (255 is
+    # ignored), low_mask / high_mask: boolean maps of the same size
     # current_class_threshold: delta_p (0.3)
     # current_class_negative_threshold: delta_n (1)
     current_class_threshold = cfg["current_class_threshold"]
@@ -74,165 +249,140 @@ def compute_contra_memobank_loss(
     num_negatives = cfg["num_negatives"]
 
     num_feat = rep.shape[1]
-    num_labeled = label_l.shape[0]
-    num_segments = label_l.shape[1]
-
-    low_valid_pixel = torch.cat((label_l, label_u), dim=0) * low_mask
-    high_valid_pixel = torch.cat((label_l, label_u), dim=0) * high_mask
-
-    rep = rep.permute(0, 2, 3, 1)
-    rep_teacher = rep_teacher.permute(0, 2, 3, 1)
-
-    seg_feat_all_list = []
-    seg_feat_low_entropy_list = []  # candidate anchor pixels
-    seg_num_list = []  # the number of low_valid pixels in each class
-    seg_proto_list = []  # the center of each class
+    num_segments = prob_l.shape[1]
+
+    # flatten every map to (num_pixels, num_cls) so that all classes are handled
+    # by the same kernels instead of one python iteration per class
+    def flatten(x):
+        return x.permute(0, 2, 3, 1).reshape(-1, x.shape[1])
+
+    # (num_pixels, num_cls) one-hot of the labels, ignored pixels match no class
+    classes = torch.arange(num_segments, device=label_l.device)
+    label_mask = torch.cat((label_l, label_u), dim=0).reshape(-1, 1) == classes
+    low_valid_pixel = label_mask & low_mask.reshape(-1, 1).bool()
+    high_valid_pixel = label_mask & high_mask.reshape(-1, 1).bool()
+    rep = flatten(rep)
+    rep_teacher = flatten(rep_teacher).detach().float()
+    prob = flatten(torch.cat((prob_l, prob_u), dim=0)).float()
 
     _, prob_indices_l = torch.sort(prob_l, 1, True)
-    prob_indices_l = prob_indices_l.permute(0, 2, 3, 1)  # (num_labeled, h, w, num_cls)
+    prob_indices_l = flatten(prob_indices_l)  # (num_labeled * h * w, num_cls)
 
     _, prob_indices_u = torch.sort(prob_u, 1, True)
-    prob_indices_u = prob_indices_u.permute(
-        0, 2, 3, 1
-    )  # (num_unlabeled, h, w, num_cls)
-
-    prob = torch.cat((prob_l, prob_u), dim=0)  # (batch_size, num_cls, h, w)
-
-    valid_classes = []
-    new_keys = []
-    for i in range(num_segments):
-        low_valid_pixel_seg = low_valid_pixel[:, i]  # select binary mask for i-th class
-        high_valid_pixel_seg = high_valid_pixel[:, i]
-
-        prob_seg = prob[:, i, :, :]
-        rep_mask_low_entropy = (
-            prob_seg > current_class_threshold
-        ) * low_valid_pixel_seg.bool()
-        rep_mask_high_entropy = (
-            prob_seg < current_class_negative_threshold
-        ) * high_valid_pixel_seg.bool()
-
-        seg_feat_all_list.append(rep[low_valid_pixel_seg.bool()])
-        seg_feat_low_entropy_list.append(rep[rep_mask_low_entropy])
-
-        # positive sample: center of the class
-        seg_proto_list.append(
-            torch.mean(
-                rep_teacher[low_valid_pixel_seg.bool()].detach(), dim=0, keepdim=True
-            )
-        )
-
-        # generate class mask for unlabeled data
-        # prob_i_classes = prob_indices_u[rep_mask_high_entropy[num_labeled :]]
-        class_mask_u = torch.sum(
-            prob_indices_u[:, :, :, low_rank:high_rank].eq(i), dim=3
-        ).bool()
-
-        # generate class mask for labeled data
-        # label_l_mask = rep_mask_high_entropy[: num_labeled] * (label_l[:, i] == 0)
-        # prob_i_classes = prob_indices_l[label_l_mask]
-        class_mask_l = torch.sum(prob_indices_l[:, :, :, :low_rank].eq(i), dim=3).bool()
-
-        class_mask = torch.cat(
-            (class_mask_l * (label_l[:, i] == 0), class_mask_u), dim=0
-        )
-
-        negative_mask = rep_mask_high_entropy * class_mask
-
-        keys = rep_teacher[negative_mask].detach()
-        new_keys.append(
-            dequeue_and_enqueue(
-                keys=keys,
-                queue=memobank[i],
-                queue_ptr=queue_prtlis[i],
-                queue_size=queue_size[i],
-            )
-        )
+    prob_indices_u = flatten(prob_indices_u)  # (num_unlabeled * h * w, num_cls)
+
+    rep_mask_low_entropy = (prob > current_class_threshold) * low_valid_pixel
+    rep_mask_high_entropy = (prob < current_class_negative_threshold) * high_valid_pixel
+
+    # generate class mask for unlabeled data
+    class_mask_u = torch.zeros_like(prob_indices_u, dtype=torch.bool)
+    class_mask_u.scatter_(1, prob_indices_u[:, low_rank:high_rank], True)
+
+    # generate class mask for labeled data
+    class_mask_l = torch.zeros_like(prob_indices_l, dtype=torch.bool)
+    class_mask_l.scatter_(1, prob_indices_l[:, :low_rank], True)
+    class_mask_l &= ~label_mask[: class_mask_l.shape[0]]
+
+    class_mask = torch.cat((class_mask_l, class_mask_u), dim=0)
+    negative_mask = rep_mask_high_entropy * class_mask
+
+    # exchange and store the negative keys of all classes at once,
+    # nonzero on the transposed mask keeps them sorted by class
+    _, key_idx = negative_mask.t().nonzero(as_tuple=True)
+    new_keys = dequeue_and_enqueue(
+        keys=rep_teacher[key_idx],
+        counts=negative_mask.sum(dim=0),
+        memobank=memobank,
+    )
 
-        if low_valid_pixel_seg.sum() > 0:
-            seg_num_list.append(int(low_valid_pixel_seg.sum().item()))
-            valid_classes.append(i)
+    # the number of low_valid pixels and of candidate anchor pixels in each class
+    seg_num = low_valid_pixel.sum(dim=0)
+    low_entropy_num = rep_mask_low_entropy.sum(dim=0)
+    seg_num_list, low_entropy_num_list = torch.stack(
+        (seg_num, low_entropy_num)
+    ).tolist()
+    valid_classes = [i for i in range(num_segments) if seg_num_list[i] > 0]
+    valid_seg = len(valid_classes)  # number of valid classes
 
     if (
-        len(seg_num_list) <= 1
+        valid_seg <= 1
     ):  # in some rare cases, a small mini-batch might only contain 1 or no semantic class
         if momentum_prototype is None:
             return new_keys, torch.tensor(0.0) * rep.sum()
         else:
             return momentum_prototype, new_keys, torch.tensor(0.0) * rep.sum()
 
+    prototype = torch.zeros((num_segments, num_queries, 1, num_feat), device=rep.device)
+
+    # the i-th valid slot takes its anchors and positive from class i and its
+    # negatives from class valid_classes[i], exactly like the former per-class loop
+    query_slots = [
+        i
+        for i in range(valid_seg)
+        if low_entropy_num_list[i] > 0 and memobank.size(valid_classes[i]) > 0
+    ]
+    if len(query_slots) == 0:
+        # in some rare cases, all queries in the current query class are easy
+        reco_loss = 0 * rep.sum()
     else:
-        reco_loss = torch.tensor(0.0).cuda()
-        seg_proto = torch.cat(seg_proto_list)  # shape: [valid_seg, 256]
-        valid_seg = len(seg_num_list)  # number of valid classes
-
-        prototype = torch.zeros(
-            (prob_indices_l.shape[-1], num_queries, 1, num_feat)
-        ).cuda()
-
-        for i in range(valid_seg):
-            if (
-                len(seg_feat_low_entropy_list[i]) > 0
-                and memobank[valid_classes[i]][0].shape[0] > 0
-            ):
-                # select anchor pixel
-                seg_low_entropy_idx = torch.randint(
-                    len(seg_feat_low_entropy_list[i]), size=(num_queries,)
-                )
-                anchor_feat = (
-                    seg_feat_low_entropy_list[i][seg_low_entropy_idx].clone().cuda()
-                )
-            else:
-                # in some rare cases, all queries in the current query class are easy
-                reco_loss = reco_loss + 0 * rep.sum()
-                continue
+        num_slots = len(query_slots)
+        query_classes = [valid_classes[i] for i in query_slots]
+        slots = torch.tensor(query_slots, dtype=torch.long, device=rep.device)
+
+        # select anchor pixels of all slots with one indexed gather
+        _, anchor_idx = rep_mask_low_entropy.t().nonzero(as_tuple=True)
+        anchor_start = low_entropy_num.cumsum(0) - low_entropy_num
+        seg_low_entropy_idx = draw_index(low_entropy_num[slots], num_queries)
+        # the logits are computed in fp32 even under autocast, they are divided by
+        # a small temperature before the softmax
+        anchor_feat = rep[
+            anchor_idx[anchor_start[slots].unsqueeze(1) + seg_low_entropy_idx]
+        ].float()  # (num_slots, num_queries, num_feat)
+
+        # apply negative key sampling from memory bank (with no gradients)
+        with torch.no_grad():
+            negative_feat = memobank.sample(
+                query_classes, num_queries * num_negatives, draw_index
+            ).reshape(num_slots, num_queries, num_negatives, num_feat)
+
+            # positive sample: center of the class
+            seg_proto = (
+                low_valid_pixel.t().float() @ rep_teacher.float()
+            ) / seg_num.clamp(min=1).unsqueeze(1)
+            positive_feat = (
+                seg_proto[slots]
+                .reshape(num_slots, 1, 1, num_feat)
+                .expand(num_slots, num_queries, 1, num_feat)
+            )
 
-            # apply negative key sampling from memory bank (with no gradients)
-            with torch.no_grad():
-                negative_feat = memobank[valid_classes[i]][0].clone().cuda()
+            if momentum_prototype is not None:
+                if not (momentum_prototype == 0).all():
+                    ema_decay = min(1 - 1 / i_iter, 0.999)
+                    positive_feat = (
+                        1 - ema_decay
+                    ) * positive_feat + ema_decay * momentum_prototype[query_classes]
 
-                high_entropy_idx = torch.randint(
-                    len(negative_feat), size=(num_queries * num_negatives,)
-                )
-                negative_feat = negative_feat[high_entropy_idx]
-                negative_feat = negative_feat.reshape(
-                    num_queries, num_negatives, num_feat
-                )
-                positive_feat = (
-                    seg_proto[i]
-                    .unsqueeze(0)
-                    .unsqueeze(0)
-                    .repeat(num_queries, 1, 1)
-                    .cuda()
-                )  # (num_queries, 1, num_feat)
-
-                if momentum_prototype is not None:
-                    if not (momentum_prototype == 0).all():
-                        ema_decay = min(1 - 1 / i_iter, 0.999)
-                        positive_feat = (
-                            1 - ema_decay
-                        ) * positive_feat + ema_decay * momentum_prototype[
-                            valid_classes[i]
-                        ]
-
-                    prototype[valid_classes[i]] = positive_feat.clone()
-
-                all_feat = torch.cat(
-                    (positive_feat, negative_feat), dim=1
-                )  # (num_queries, 1 + num_negative, num_feat)
-
-            seg_logits = torch.cosine_similarity(
-                anchor_feat.unsqueeze(1), all_feat, dim=2
-            )
+                prototype[query_classes] = positive_feat.clone()
 
-            reco_loss = reco_loss + F.cross_entropy(
-                seg_logits / temp, torch.zeros(num_queries).long().cuda()
-            )
+            all_feat = torch.cat(
+                (positive_feat, negative_feat), dim=2
+            )  # (num_slots, num_queries, 1 + num_negative, num_feat)
 
-        if momentum_prototype is None:
-            return new_keys, reco_loss / valid_seg
-        else:
-            return prototype, new_keys, reco_loss / valid_seg
+        seg_logits = torch.cosine_similarity(
+            anchor_feat.unsqueeze(2), all_feat, dim=3
+        )  # (num_slots, num_queries, 1 + num_negative)
+
+        # every slot has num_queries anchors, so the mean over all of them is the
+        # mean of the per-class losses
+        reco_loss = num_slots * F.cross_entropy(
+            seg_logits.reshape(num_slots * num_queries, -1) / temp,
+            torch.zeros(num_slots * num_queries, dtype=torch.long, device=rep.device),
+        )
+
+    if momentum_prototype is None:
+        return new_keys, reco_loss / valid_seg
+    else:
+        return prototype, new_keys, reco_loss / valid_seg
 
 
 def get_criterion(cfg):
@@ -243,27 +393,35 @@ def get_criterion(cfg):
         else 0
     )
     ignore_index = cfg["dataset"]["ignore_label"]
+    chunk_rows = cfg["trainer"].get("chunked_upsample", 0)
     # for Cityscapes
     if cfg_criterion["type"] == "ohem":
+        if chunk_rows:
+            # the hard example mining needs the full-size probabilities
+            raise ValueError("trainer.chunked_upsample does not support ohem")
         criterion = CriterionOhem(
             aux_weight, ignore_index=ignore_index, **cfg_criterion["kwargs"]
         )
     # for Pascal
     else:
         criterion = Criterion(
-            aux_weight, ignore_index=ignore_index, **cfg_criterion["kwargs"]
+            aux_weight,
+            ignore_index=ignore_index,
+            chunk_rows=chunk_rows or 64,
+            **cfg_criterion["kwargs"]
         )
 
     return criterion
 
 
 class Criterion(nn.Module):
-    def __init__(self, aux_weight, ignore_index=255, use_weight=False):
+    def __init__(self, aux_weight, ignore_index=255, use_weight=False, chunk_rows=64):
         super(Criterion, self).__init__()
 
         # Only for cityscapes
         self._aux_weight = aux_weight
         self._ignore_index = ignore_index
+        self._chunk_rows = chunk_rows
         self.use_weight = use_weight
 
         if not use_weight:
@@ -291,12 +449,24 @@ class Criterion(nn.Module):
                     1.0,
                     1.0,
                 ]
-            ).cuda()
+            )
             self._criterion = nn.CrossEntropyLoss(ignore_index=ignore_index)
             self._criterion1 = nn.CrossEntropyLoss(
                 ignore_index=ignore_index, weight=weights
             )
 
+    def _ce(self, criterion, pred, target):
+        # smaller logits are upsampled band by band, see upsample_cross_entropy
+        if pred.shape[2:] != target.shape[1:]:
+            return upsample_cross_entropy(
+                pred,
+                target,
+                weight=criterion.weight,
+                ignore_index=self._ignore_index,
+                chunk_rows=self._chunk_rows,
+            )
+        return criterion(pred, target)
+
     def forward(self, preds, target):
         h, w = target.size(1), target.size(2)
         if self._aux_weight > 0:  # require aux loss
@@ -307,21 +477,21 @@ class Criterion(nn.Module):
                 len(preds) == 2
                 and main_h == aux_h
                 and main_w == aux_w
-                and main_h == h
-                and main_w == w
+                and main_h <= h
+                and main_w <= w
             )
             if self.use_weight:
-                loss1 = self._criterion(main_pred, target) + self._criterion1(
-                    main_pred, target
+                loss1 = self._ce(self._criterion, main_pred, target) + self._ce(
+                    self._criterion1, main_pred, target
                 )
             else:
-                loss1 = self._criterion(main_pred, target)
-            loss2 = self._criterion(aux_pred, target)
+                loss1 = self._ce(self._criterion, main_pred, target)
+            loss2 = self._ce(self._criterion, aux_pred, target)
             loss = loss1 + self._aux_weight * loss2
         else:
             pred_h, pred_w = preds.size(2), preds.size(3)
-            assert pred_h == h and pred_w == w
-            loss = self._criterion(preds, target)
+            assert pred_h <= h and pred_w <= w
+            loss = self._ce(self._criterion, preds, target)
         return loss
 
 
@@ -333,13 +503,24 @@ class CriterionOhem(nn.Module):
         min_kept=100000,
         ignore_index=255,
         use_weight=False,
+        impl="tensor",
+        stride=1,
     ):
         super(CriterionOhem, self).__init__()
         self._aux_weight = aux_weight
-        self._criterion1 = OhemCrossEntropy2dTensor(
-            ignore_index, thresh, min_kept, use_weight
-        )
-        self._criterion2 = OhemCrossEntropy2dTensor(ignore_index, thresh, min_kept)
+        if impl == "kth":
+            # on-device selection, see OhemCrossEntropy2dKth
+            self._criterion1 = OhemCrossEntropy2dKth(
+                ignore_index, thresh, min_kept, use_weight, stride=stride
+            )
+            self._criterion2 = OhemCrossEntropy2dKth(
+                ignore_index, thresh, min_kept, stride=stride
+            )
+        else:
+            self._criterion1 = OhemCrossEntropy2dTensor(
+                ignore_index, thresh, min_kept, use_weight
+            )
+            self._criterion2 = OhemCrossEntropy2dTensor(ignore_index, thresh, min_kept)
 
     def forward(self, preds, target):
         h, w = target.size(1), target.size(2)
@@ -433,7 +614,7 @@ class OhemCrossEntropy2d(nn.Module):
         new_target = (
             torch.from_numpy(input_label.reshape(target.size()))
             .long()
-            .cuda(target.get_device())
+            .to(target.device)
         )
 
         return new_target
@@ -453,6 +634,30 @@ class OhemCrossEntropy2d(nn.Module):
         return self.criterion(predict, target)
 
 
+# cityscapes class weights of the OHEM criteria (use_weight)
+OHEM_CLASS_WEIGHT = [
+    0.8373,
+    0.918,
+    0.866,
+    1.0345,
+    1.0166,
+    0.9969,
+    0.9754,
+    1.0489,
+    0.8786,
+    1.0023,
+    0.9539,
+    0.9843,
+    1.1116,
+    0.9037,
+    1.0865,
+    1.0955,
+    1.0865,
+    1.1529,
+    1.0507,
+]
+
+
 class OhemCrossEntropy2dTensor(nn.Module):
     """
     Ohem Cross Entropy Tensor Version
@@ -466,29 +671,7 @@ class OhemCrossEntropy2dTensor(nn.Module):
         self.thresh = float(thresh)
         self.min_kept = int(min_kept)
         if use_weight:
-            weight = torch.FloatTensor(
-                [
-                    0.8373,
-                    0.918,
-                    0.866,
-                    1.0345,
-                    1.0166,
-                    0.9969,
-                    0.9754,
-                    1.0489,
-                    0.8786,
-                    1.0023,
-                    0.9539,
-                    0.9843,
-                    1.1116,
-                    0.9037,
-                    1.0865,
-                    1.0955,
-                    1.0865,
-                    1.1529,
-                    1.0507,
-                ]
-            ).cuda()
+            weight = torch.FloatTensor(OHEM_CLASS_WEIGHT)
             # weight = torch.FloatTensor(
             #    [0.4762, 0.5, 0.4762, 1.4286, 1.1111, 0.4762, 0.8333, 0.5, 0.5, 0.8333, 0.5263, 0.5882,
             #    1.4286, 0.5, 3.3333,5.0, 10.0, 2.5, 0.8333]).cuda()
@@ -534,3 +717,49 @@ class OhemCrossEntropy2dTensor(nn.Module):
         target = target.view(b, h, w)
 
         return self.criterion(pred, target)
+
+
+class OhemCrossEntropy2dKth(nn.Module):
+    """OHEM cross entropy that stays on device.
+
+    Same selection rule as OhemCrossEntropy2dTensor: keep the valid pixels
+    whose ground-truth probability is at most max(thresh, p_k), p_k being the
+    ``min_kept``-th smallest one. p_k comes from ``kthvalue`` on a spatially
+    ``stride``-subsampled map (k scaled accordingly) instead of a full sort,
+    without any host sync, and the log-softmax is shared with the loss.
+    """
+
+    def __init__(
+        self, ignore_index=255, thresh=0.7, min_kept=256, use_weight=False, stride=1
+    ):
+        super(OhemCrossEntropy2dKth, self).__init__()
+        self.ignore_index = ignore_index
+        self.thresh = float(thresh)
+        self.min_kept = int(min_kept)
+        self.stride = int(stride)
+        weight = torch.FloatTensor(OHEM_CLASS_WEIGHT) if use_weight else None
+        self.register_buffer("weight", weight)
+
+    def forward(self, pred, target):
+        log_prob = F.log_softmax(pred.float(), dim=1)
+        valid = target.ne(self.ignore_index)
+
+        with torch.no_grad():
+            gt_prob = log_prob.gather(
+                1, target.masked_fill(~valid, 0).unsqueeze(1)
+            ).squeeze(1)
+            # ignored pixels sort last, if fewer than min_kept pixels are valid
+            # the threshold becomes 1 and every valid pixel is kept
+            gt_prob = gt_prob.exp().masked_fill(~valid, 1.0)
+            threshold = gt_prob.new_tensor(self.thresh)
+            if self.min_kept > 0:
+                sample = gt_prob[:, :: self.stride, :: self.stride].flatten()
+                k = -(-self.min_kept // (self.stride * self.stride))
+                k = min(k, sample.numel())
+                threshold = torch.max(threshold, sample.kthvalue(k).values)
+            kept = valid & gt_prob.le(threshold)
+
+        target = target.masked_fill(~kept, self.ignore_index)
+        return F.nll_loss(
+            log_prob, target, weight=self.weight, ignore_index=self.ignore_index
+        )
@@ -12,6 +12,9 @@ from PIL import Image
 # from skimage.filters import gaussian
 from skimage.measure import label, regionprops
 
+from .ckpt_helper import load_checkpoint
+from .dist_helper import all_gather_packed, get_device
+
 
 @torch.no_grad()
 def gather_together(data):
@@ -24,32 +27,108 @@ def gather_together(data):
     return gather_data
 
 
-@torch.no_grad()
-def dequeue_and_enqueue(keys, queue, queue_ptr, queue_size):
-    # gather keys before updating queue
-    keys = keys.detach().clone().cpu()
-    gathered_list = gather_together(keys)
-    keys = torch.cat(gathered_list, dim=0).cuda()
+def draw_index(high, num_samples):
+    """(len(high), num_samples) indices drawn uniformly below each ``high``
+    (a long tensor of shape (n,)) with a single ``rand`` call."""
+    high = high.unsqueeze(1)
+    idx = (torch.rand((high.shape[0], num_samples), device=high.device) * high).long()
+    return torch.minimum(idx, high - 1)
 
-    batch_size = keys.shape[0]
 
-    ptr = int(queue_ptr)
+class MemoryBank(object):
+    """Class-wise ring buffer of negative keys, preallocated on the training device.
+
+    Every class owns a fixed-capacity slice of one flat buffer together with a
+    write pointer and a fill count, so enqueueing only writes the new keys in
+    place and sampling is a plain index gather.
+    """
+
+    def __init__(self, queue_size, num_feat=256, device="cuda"):
+        self.queue_size = list(queue_size)
+        self.num_classes = len(self.queue_size)
+        self.offset = [0] * self.num_classes
+        for i in range(1, self.num_classes):
+            self.offset[i] = self.offset[i - 1] + self.queue_size[i - 1]
+        self.queue = torch.zeros(
+            (sum(self.queue_size), num_feat), dtype=torch.float, device=device
+        )
+        self.queue_ptr = [0] * self.num_classes
+        self.queue_fill = [0] * self.num_classes
+
+        self._size = torch.tensor(self.queue_size, dtype=torch.long, device=device)
+        self._offset = torch.tensor(self.offset, dtype=torch.long, device=device)
+
+    def __len__(self):
+        return self.num_classes
+
+    def size(self, idx):
+        return self.queue_fill[idx]
+
+    @torch.no_grad()
+    def enqueue(self, keys, counts):
+        """Write class-sorted ``keys`` with per-class lengths ``counts`` (list)."""
+        num_keys = keys.shape[0]
+        if num_keys == 0:
+            return
+        device = self.queue.device
+
+        counts_t = torch.tensor(counts, dtype=torch.long, device=device)
+        ptr_t = torch.tensor(self.queue_ptr, dtype=torch.long, device=device)
+        start = counts_t.cumsum(0) - counts_t
+        # only the latest keys survive a full lap of the ring
+        skip = (counts_t - self._size).clamp(min=0)
+
+        cls = torch.repeat_interleave(
+            torch.arange(self.num_classes, device=device),
+            counts_t,
+            output_size=num_keys,
+        )
+        rank = torch.arange(num_keys, device=device) - start[cls] - skip[cls]
+        keep = rank >= 0
+        dst = self._offset[cls] + (ptr_t[cls] + rank) % self._size[cls]
+        self.queue.index_copy_(0, dst[keep], keys[keep].to(self.queue.dtype))
+
+        for idx, num in enumerate(counts):
+            num = min(num, self.queue_size[idx])
+            self.queue_ptr[idx] = (self.queue_ptr[idx] + num) % self.queue_size[idx]
+            self.queue_fill[idx] = min(self.queue_fill[idx] + num, self.queue_size[idx])
+
+    @torch.no_grad()
+    def sample(self, classes, num_samples, draw_index=draw_index):
+        """Draw ``num_samples`` stored keys for each of ``classes`` (list) at once.
+
+        ``draw_index(fill, num_samples)`` picks positions in insertion order
+        (0 is the oldest stored key of a class), as in the former list queue.
+        """
+        device = self.queue.device
+        cls = torch.tensor(classes, dtype=torch.long, device=device)
+        fill, ptr = torch.tensor(
+            [[self.queue_fill[idx], self.queue_ptr[idx]] for idx in classes],
+            dtype=torch.long,
+            device=device,
+        ).unbind(1)
+        pos = draw_index(fill, num_samples)
+        # the oldest key of a class sits at its write pointer once the ring is full
+        size = self._size[cls].unsqueeze(1)
+        slot = (ptr - fill).unsqueeze(1) % size
+        slot = (slot + pos) % size
+        return self.queue[self._offset[cls].unsqueeze(1) + slot]
 
-    queue[0] = torch.cat((queue[0], keys.cpu()), dim=0)
-    if queue[0].shape[0] >= queue_size:
-        queue[0] = queue[0][-queue_size:, :]
-        ptr = queue_size
-    else:
-        ptr = (ptr + batch_size) % queue_size  # move pointer
 
-    queue_ptr[0] = ptr
+@torch.no_grad()
+def dequeue_and_enqueue(keys, counts, memobank):
+    # gather keys of all classes from all ranks in one collective
+    keys, counts = all_gather_packed(keys.detach(), counts)
+    counts = counts.tolist()
+
+    memobank.enqueue(keys, counts)
 
-    return batch_size
+    return counts
 
 
 def label_onehot(inputs, num_segments):
     batch_size, im_h, im_w = inputs.shape
-    outputs = torch.zeros((num_segments, batch_size, im_h, im_w)).cuda()
+    outputs = torch.zeros((num_segments, batch_size, im_h, im_w), device=inputs.device)
 
     inputs_temp = inputs.clone()
     inputs_temp[inputs == 255] = 0
@@ -59,6 +138,35 @@ def label_onehot(inputs, num_segments):
     return outputs.permute(1, 0, 2, 3)
 
 
+def downsample_label(label, size):
+    """Resize the last two dims of ``label`` (any dtype) to ``size`` by picking
+    the same pixels as ``F.interpolate(..., mode="nearest")``."""
+    in_h, in_w = label.shape[-2:]
+    out_h, out_w = size
+    if (in_h, in_w) == (out_h, out_w):
+        return label
+    idx_h = nearest_index(in_h, out_h, label.device)
+    idx_w = nearest_index(in_w, out_w, label.device)
+    return label.index_select(-2, idx_h).index_select(-1, idx_w)
+
+
+def nearest_index(in_size, out_size, device):
+    # the float32 source index computation of torch's nearest kernels
+    scale = torch.tensor(in_size / out_size, dtype=torch.float32)
+    idx = torch.arange(out_size, dtype=torch.float32) * scale
+    return idx.floor().long().clamp_(max=in_size - 1).to(device)
+
+
+def get_loss_size(loss_stride, image_size, logit_size):
+    """Resolution the losses are computed at (``trainer.loss_stride``): the
+    image size by default, the logit size for "logits", else image / stride."""
+    if loss_stride is None:
+        return tuple(image_size)
+    if loss_stride == "logits":
+        return tuple(logit_size)
+    return tuple(-(-size // int(loss_stride)) for size in image_size)
+
+
 def get_world_size():
     if not dist.is_available():
         return 1
@@ -301,7 +409,7 @@ def generate_cutmix_mask(
         )
     y0, x0, y1, x1 = rectangles
     valid_mask[int(y0) : int(y1), int(x0) : int(x1)] = 1
-    valid_mask = torch.from_numpy(valid_mask).long().cuda()
+    valid_mask = torch.from_numpy(valid_mask).long().to(get_device())
 
     return valid_mask
 
@@ -580,25 +688,79 @@ def intersectionAndUnion(output, target, K, ignore_index=255):
     return area_intersection, area_union, area_target
 
 
-def load_state(path, model, optimizer=None, key="state_dict"):
-    rank = dist.get_rank()
+class SegMetric(object):
+    """Streaming K x K confusion matrix (rows: target, cols: prediction).
+
+    ``update`` adds a batch with a single bincount on the prediction's device,
+    ``all_reduce`` sums the matrix over all ranks once at the end.
+    """
+
+    def __init__(self, num_classes, ignore_index=255, device="cpu"):
+        self.num_classes = num_classes
+        self.ignore_index = ignore_index
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.mat = torch.zeros(
+            (self.num_classes, self.num_classes), dtype=torch.long, device=self.device
+        )
 
-    def map_func(storage, location):
-        return storage.cuda()
+    @torch.no_grad()
+    def update(self, pred, target):
+        num_classes = self.num_classes
+        pred = pred.flatten().long().to(self.mat.device)
+        target = target.flatten().long().to(self.mat.device)
+        # ignored pixels fall into an extra bin that is dropped afterwards
+        valid = (target != self.ignore_index) & (target >= 0) & (target < num_classes)
+        idx = torch.where(
+            valid, target * num_classes + pred, torch.full_like(pred, num_classes**2)
+        )
+        self.mat += torch.bincount(idx, minlength=num_classes**2 + 1)[
+            : num_classes**2
+        ].view(num_classes, num_classes)
+
+    def all_reduce(self):
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.mat)
+
+    def iou(self):
+        mat = self.mat.double()
+        intersection = mat.diag()
+        union = mat.sum(0) + mat.sum(1) - intersection
+        return intersection / (union + 1e-10)
+
+    def accuracy(self):
+        mat = self.mat.double()
+        return mat.diag().sum() / (mat.sum() + 1e-10)
+
+    def fwiou(self):
+        mat = self.mat.double()
+        freq = mat.sum(1) / (mat.sum() + 1e-10)
+        return (freq * self.iou()).sum()
+
+
+def load_state(path, model, optimizer=None, key="state_dict", checkpoint=None):
+    """Load ``checkpoint[key]`` into ``model``; pass an already loaded
+    ``checkpoint`` to restore several models from one read of ``path``."""
+    rank = dist.get_rank()
 
-    if os.path.isfile(path):
+    if checkpoint is not None or os.path.isfile(path):
         if rank == 0:
             print("=> loading checkpoint '{}'".format(path))
 
-        checkpoint = torch.load(path, map_location=map_func)
+        # load_state_dict copies the tensors to wherever the model lives
+        if checkpoint is None:
+            checkpoint = load_checkpoint(path)
 
         # fix size mismatch error
         ignore_keys = []
-        state_dict = checkpoint[key]
+        state_dict = dict(checkpoint[key])
+        own_state = model.state_dict()
 
         for k, v in state_dict.items():
-            if k in model.state_dict().keys():
-                v_dst = model.state_dict()[k]
+            if k in own_state:
+                v_dst = own_state[k]
                 if v.shape != v_dst.shape:
                     ignore_keys.append(k)
                     if rank == 0:
@@ -609,13 +771,13 @@ def load_state(path, model, optimizer=None, key="state_dict"):
                         )
 
         for k in ignore_keys:
-            checkpoint.pop(k)
+            state_dict.pop(k)
 
         model.load_state_dict(state_dict, strict=False)
 
         if rank == 0:
             ckpt_keys = set(state_dict.keys())
-            own_keys = set(model.state_dict().keys())
+            own_keys = set(own_state.keys())
             missing_keys = own_keys - ckpt_keys
             for k in missing_keys:
                 print("caution: missing keys from checkpoint {}: {}".format(path, k))
@@ -0,0 +1,67 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from PIL import Image
+
+from .utils import colorize
+
+
+def save_prediction(gray, colormap, gray_path=None, color_path=None):
+    """Write the uint8 label map and/or its colorized version as PNGs."""
+    if gray_path is not None:
+        Image.fromarray(gray).save(gray_path)
+    if color_path is not None:
+        colorize(gray, colormap).save(color_path)
+
+
+class AsyncWriter(object):
+    """Run output jobs (colorizing, PNG encoding, figure rendering) on a pool
+    while the caller keeps predicting.
+
+    ``submit`` blocks once ``max_pending`` jobs are in flight, which bounds the
+    memory held by queued predictions. ``close`` waits for every job and raises
+    if any of them failed. Use processes for GIL-bound jobs such as matplotlib
+    figures; job functions and arguments must then be picklable.
+    """
+
+    def __init__(self, workers=4, max_pending=16, processes=False):
+        executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        self.executor = executor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.errors = []
+
+    def submit(self, fn, *args, **kwargs):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        self.slots.release()
+        error = future.exception()
+        if error is not None:
+            with self.lock:
+                self.errors.append(error)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.errors:
+            raise RuntimeError(
+                "{} write job(s) failed, first error: {!r}".format(
+                    len(self.errors), self.errors[0]
+                )
+            ) from self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # keep the original exception, just drain the pool
+            self.executor.shutdown(wait=True)